@@ -15,6 +15,7 @@ import zmq
 from zmq.utils import jsonapi
 
 from .protocol import *
+from .shm import SharedMemorySlab
 from .decentralizedworker import *
 
 __all__ = ['__version__', 'WKRClient', 'ConcurrentWKRClient', 'WKRWorker', 'WKRDecentralizeCenter']
@@ -36,7 +37,9 @@ class WKRClient(object):
                  show_server_config=False, identity=None, 
                  check_version=True, check_length=False,
                  ignore_all_checks=False,
-                 timeout=15*60*1000): # 4*60*1000 timeout after 4m, default is -1, mean forever
+                 timeout=15*60*1000, # 4*60*1000 timeout after 4m, default is -1, mean forever
+                 shm=False, shm_threshold=64*1024, shm_slot_size=8*1024*1024, shm_num_slots=32,
+                 model=None):
 
         """ A client object connected to a TTSServer
 
@@ -61,12 +64,14 @@ class WKRClient(object):
         :type identity: str
         :type show_server_config: bool
         :type output_fmt: str
-        :type port_out: int
+        :type port_out: int or list[int]
         :type port: int
         :type ip: str
         :param ip: the ip address of the server
         :param port: port for pushing data from client to server, must be consistent with the server side config
-        :param port_out: port for publishing results from server to client, must be consistent with the server side config
+        :param port_out: port for publishing results from server to client, must be consistent with the server side config.
+            A server with several sinks on their own port ("-sink_publish per_shard") tells the client the other ports,
+            a list of all of them may also be given when `ignore_all_checks=True`
         :param output_fmt: the output format of the sentence encodes, either in numpy array or python List[List[float]] (ndarray/list)
         :param show_server_config: whether to show server configs when first connected
         :param identity: the UUID of this client
@@ -74,6 +79,12 @@ class WKRClient(object):
         :param check_length: check if server `max_seq_len` is less than the sentence length before sent
         :param ignore_all_checks: ignore all checks, set it to True if you are not sure whether the server is ready when constructing WKRClient()
         :param timeout: set the timeout (milliseconds) for receive operation on the client, -1 means no timeout and wait until result returns
+        :param shm: only for a client on the same host as the server, pass payloads above `shm_threshold` bytes through
+            shared memory instead of the socket, and accept results the same way from a server started with "-shm"
+        :param shm_threshold: minimum payload size (bytes) sent through shared memory
+        :param shm_slot_size: size (bytes) of one shared memory slot, larger payloads are sent inline
+        :param shm_num_slots: number of payloads that can be in flight through shared memory, others are sent inline
+        :param model: name of the model requests go to when the server hosts several models, None is the first model of the server
         """
 
         self.context = zmq.Context()
@@ -85,28 +96,39 @@ class WKRClient(object):
         self.receiver = self.context.socket(zmq.SUB)
         self.receiver.setsockopt(zmq.LINGER, 0)
         self.receiver.setsockopt(zmq.SUBSCRIBE, self.identity)
-        self.receiver.connect('tcp://%s:%d' % (ip, port_out))
+        self.sink_ports = list(port_out) if isinstance(port_out, (list, tuple)) else [port_out]
+        for sink_port in self.sink_ports:
+            self.receiver.connect('tcp://%s:%d' % (ip, sink_port))
 
         self.request_id = 0
         self.timeout = timeout
         self.pending_request = set()
         self.pending_response = {}
+        # chunks of streamed outputs by request id, then by sequence number
+        self.pending_chunks = {}
 
         if protocol not in ['obj', 'numpy']:
             raise AttributeError('"protocol" must be "obj" or "numpy"')
 
         self.protocol = protocol
+        self.model = model
+        self.shm_slab = SharedMemorySlab(shm_slot_size, shm_num_slots, threshold=shm_threshold) if shm else None
 
         self.port = port
-        self.port_out = port_out
+        self.port_out = self.sink_ports[0]
         self.ip = ip
         self.length_limit = 0
         self.token_info_available = False
 
         if not ignore_all_checks:
             s_status = self.server_status
+            self._connect_sink_ports(s_status.get('sink_ports', []))
             if s_status['protocol'] != self.protocol:
                 raise AttributeError('Protocol mismatch. Target server using protocol "{}" while this client use "{}"'.format(s_status['protocol'], self.protocol))
+            if self.shm_slab is not None and not s_status.get('shm'):
+                warnings.warn('the server is not started with "-shm", payloads are sent inline')
+                self.shm_slab.close()
+                self.shm_slab = None
 
         if not ignore_all_checks and (check_version or show_server_config or check_length):
             if check_version and s_status['server_version'] != self.status['client_version']:
@@ -134,16 +156,21 @@ class WKRClient(object):
         self.sender.close(0)
         self.receiver.close(0)
         self.context.term()
+        if self.shm_slab is not None:
+            self.shm_slab.close()
 
-    def _send(self, msg, target_request_id=None):
+    def _send(self, msg, target_request_id=None, info=None):
         self.request_id += 1
         req_id = target_request_id if target_request_id else self.request_id
         req_id = str(req_id)
 
-        if msg in [ServerCmd.terminate, ServerCmd.show_config]:
+        if isinstance(msg, bytes) and msg in [ServerCmd.terminate, ServerCmd.show_config]:
             send_to_next_raw(self.identity, req_id, msg, jsonapi.dumps('{}'), self.sender)
         else:
-            send_to_next(self.protocol, self.identity, req_id, msg, self.sender)
+            if self.shm_slab is not None:
+                # results may come back as handles on the worker slabs
+                info = dict(info or {}, shm_ok=1)
+            send_to_next(self.protocol, self.identity, req_id, msg, self.sender, info=info, slab=self.shm_slab)
 
         # print(req_id)
         self.pending_request.add(req_id)
@@ -167,12 +194,16 @@ class WKRClient(object):
                 try:
                     client, req_id, msg, msg_info = recv_from_prev(protocol, self.receiver)
                 except ProcessingError as e:
-                    client, req_id, msg = e.client_id, e.req_id, e.raw_msg
-                    raised_error = True
+                    client, req_id, msg, msg_info = e.client_id, e.req_id, e.raw_msg, None
+                    raised_error = e.error_code
                 except Exception as e:
                     raise e
 
                 request_id = str(req_id)
+                if isinstance(msg_info, dict) and 'seq' in msg_info:
+                    # a chunk of a stream, read by its own iterator
+                    self.pending_chunks.setdefault(request_id, {})[msg_info['seq']] = (msg, msg_info)
+                    continue
 
                 # print(request_id)
                 # if not wait for particular response then simply return
@@ -193,7 +224,7 @@ class WKRClient(object):
     def _recv_ndarray(self, wait_for_req_id=None):
         request_id, response, error_raised = self._recv(wait_for_req_id)
         if error_raised:
-            return Response(request_id, None, 1, response)
+            return Response(request_id, None, error_raised, response)
         else:
             return Response(request_id, response, 0, 'success')
 
@@ -214,6 +245,7 @@ class WKRClient(object):
             'pending_request': self.pending_request,
             'port': self.port,
             'port_out': self.port_out,
+            'sink_ports': self.sink_ports,
             'server_ip': self.ip,
             'client_version': __version__,
             'timeout': self.timeout
@@ -248,6 +280,15 @@ class WKRClient(object):
 
         return arg_wrapper
 
+    def _connect_sink_ports(self, ports):
+        # results come from the sink shard of this client, which may publish on a port of its own
+        new_ports = [p for p in ports if p not in self.sink_ports]
+        for sink_port in new_ports:
+            self.receiver.connect('tcp://%s:%d' % (self.ip, sink_port))
+            self.sink_ports.append(sink_port)
+        if new_ports:
+            time.sleep(0.1)  # dirty fix of slow-joiner: sleep so that the subscription reaches the new ports.
+
     @property
     @_timeout
     def server_status(self):
@@ -262,10 +303,24 @@ class WKRClient(object):
         data = self._recv(req_id, force_protocol='obj')
         return data.content
 
-    @_timeout
-    def encode(self, data, blocking=True, target_request_id=None):
-        
-        req_id = self._send(data, target_request_id=target_request_id)
+    @staticmethod
+    def _job_info(priority=0, deadline=None, batch=False, model=None):
+        info = {}
+        if model:
+            info['model'] = model
+        if priority:
+            info['priority'] = int(priority)
+        if deadline is not None and deadline > 0:
+            info['deadline'] = time.time() + deadline/1000
+        if batch:
+            info['batch'] = 1
+        return info
+
+    def _encode(self, data, blocking=True, target_request_id=None, priority=0, deadline=None, batch=False, model=None):
+        if deadline is None and blocking and self.timeout > 0:
+            deadline = self.timeout
+        info = self._job_info(priority, deadline, batch, model or self.model)
+        req_id = self._send(data, target_request_id=target_request_id, info=info)
 
         if not blocking:
             return None
@@ -273,8 +328,91 @@ class WKRClient(object):
         r = self._recv_ndarray(req_id)
         if r.error_code == 0:
             return r.embedding
-        else:
-            raise Exception(r.error_message)
+        self._raise_error(r)
+
+    def _raise_error(self, r):
+        for error_cls in (ServerOverloadedError, DeadlineExceededError, WorkerLostError):
+            if r.error_code == error_cls.error_code:
+                raise error_cls(r.error_message, self.identity, r.id)
+        raise Exception(r.error_message)
+
+    @_timeout
+    def encode(self, data, blocking=True, target_request_id=None, priority=0, deadline=None, model=None):
+        """ Send data to the server for processing
+
+        :param priority: scheduling class of this request, higher is served first when the server uses "-schedule_policy priority"
+        :param deadline: time budget (milliseconds) of this request, the server drops the request once it is exceeded.
+            Defaults to the client `timeout` for blocking calls, -1 disables it.
+            Client and server clocks are expected to be in sync.
+        :param model: name of the model this request goes to, defaults to the `model` of the client
+        """
+        return self._encode(data, blocking=blocking, target_request_id=target_request_id, priority=priority, deadline=deadline, model=model)
+
+    @_timeout
+    def encode_batch(self, data, blocking=True, target_request_id=None, priority=0, deadline=None, model=None):
+        """ Send many inputs as one request, the server splits it into parts of its worker `batch_size`,
+        spreads the parts over all workers and replies with the outputs gathered in the original order
+
+        :param data: a list of inputs for "obj" protocol, an ndarray stacked on the first axis for "numpy" protocol
+        :return: list of outputs for "obj" protocol, outputs stacked on the first axis for "numpy" protocol
+        """
+        return self._encode(data, blocking=blocking, target_request_id=target_request_id, priority=priority, deadline=deadline, batch=True, model=model)
+
+    def encode_stream(self, data, priority=0, deadline=None, model=None):
+        """ Send data to a server whose worker `predict` is a generator, and iterate over the chunks of the output
+        as the worker yields them. The client `timeout` applies to the wait for each chunk.
+
+        .. highlight:: python
+        .. code-block:: python
+
+            for chunk in bc.encode_stream(data):
+                print(chunk)
+
+        :param deadline: time budget (milliseconds) of the whole stream, no deadline by default
+        :return: an iterator over the chunks, raises the server error if the stream ends with one
+        :rtype: Iterator
+        """
+        info = self._job_info(priority, deadline, False, model or self.model)
+        info['stream'] = 1
+        req_id = self._send(data, info=info)
+        return self._iter_stream(req_id)
+
+    def _iter_stream(self, req_id):
+        chunks = self.pending_chunks.setdefault(req_id, {})
+        next_seq = 0
+        try:
+            while True:
+                if next_seq in chunks:
+                    # chunks are numbered, they are given in order whatever the order they came in
+                    msg, msg_info = chunks.pop(next_seq)
+                    next_seq += 1
+                    if msg_info.get('eos'):
+                        return
+                    yield msg
+                    continue
+                if req_id in self.pending_response:
+                    # the stream ended with an error instead of an end of stream marker
+                    msg, raised_error = self.pending_response.pop(req_id)
+                    self._raise_error(Response(req_id, None, raised_error, msg))
+                self.receiver.setsockopt(zmq.RCVTIMEO, self.timeout)
+                try:
+                    client, request_id, msg, msg_info = recv_from_prev(self.protocol, self.receiver)
+                except ProcessingError as e:
+                    self.pending_response[str(e.req_id)] = e.raw_msg, e.error_code
+                    continue
+                except zmq.error.Again:
+                    raise TimeoutError('no chunk from the server within "timeout"={} ms, request id: {}#{}'.format(
+                        self.timeout, self.identity, req_id))
+                finally:
+                    self.receiver.setsockopt(zmq.RCVTIMEO, -1)
+                request_id = str(request_id)
+                if isinstance(msg_info, dict) and 'seq' in msg_info:
+                    self.pending_chunks.setdefault(request_id, {})[msg_info['seq']] = (msg, msg_info)
+                else:
+                    self.pending_response[request_id] = msg, False
+        finally:
+            self.pending_chunks.pop(req_id, None)
+            self.pending_request.discard(req_id)
 
     def fetch(self, delay=.0):
         """ Fetch the encoded vectors from server, use it with `encode(blocking=False)`
@@ -313,7 +451,7 @@ class WKRClient(object):
 
             # check for exception
             for t in tmp:
-                if t.error_code == 1:
+                if t.error_code != 0:
                     warnings.warn("Request with id: {}\nRaised an error from server with message:\n{}".format(t.id, t.error_message))
 
             if sort:
@@ -450,6 +588,21 @@ class ConcurrentWKRClient(WKRClient):
     def encode(self, **kwargs):
         pass
 
+    @_concurrent
+    def encode_batch(self, **kwargs):
+        pass
+
+    def encode_stream(self, *args, **kwargs):
+        # the client is held until the stream is over
+        try:
+            with BCManager(self.available_bc, retry=self.retry, retry_gap=self.retry_gap) as bc:
+                for chunk in bc.encode_stream(*args, **kwargs):
+                    yield chunk
+        except IndexError:
+            raise RuntimeError('Too many concurrent connections!'
+                               'Try to increase the value of "max_concurrency", '
+                               'currently =%d' % self.max_concurrency)
+
     @property
     @_concurrent
     def server_status(self):
@@ -4,7 +4,9 @@ import numpy as np
 import zmq
 from zmq.utils import jsonapi
 
-__all__ = ['ServerCmd', 'ProcessingError', 
+from .shm import read_shm, release_shm
+
+__all__ = ['ServerCmd', 'ProcessingError', 'ServerOverloadedError', 'DeadlineExceededError', 'WorkerLostError', 
            'send_to_next', 'recv_from_prev',
            'to_bytes', 'to_str', 
            'send_object', 'recv_object', 'send_ndarray', 'decode_ndarray', 'decode_object', 'send_to_next_raw']
@@ -16,6 +18,9 @@ class ServerCmd:
     show_config = b'SHOW_CONFIG'
     switch_server = b'SWITCH'
     exception = b'EXCEPTION'
+    overloaded = b'OVERLOADED'
+    deadline_exceeded = b'DEADLINE_EXCEEDED'
+    worker_lost = b'WORKER_LOST'
 
     @staticmethod
     def is_valid(cmd):
@@ -23,19 +28,43 @@ class ServerCmd:
 
 class ProcessingError(Exception):
     "Raised when eception happend on server side"
+    error_code = 1
+
     def __init__(self, msg, client_id, req_id):
         super(ProcessingError, self).__init__(msg)
         self.client_id = client_id
         self.req_id = req_id
         self.raw_msg = msg
 
-def send_to_next(protocol, client, job_id, msg, dst, flags=0):
+class ServerOverloadedError(ProcessingError):
+    "Raised when the server rejected a request because its backlog is full, retry later or on another server"
+    error_code = 2
+
+class DeadlineExceededError(ProcessingError):
+    "Raised when the server dropped a request because its deadline passed before the result was ready"
+    error_code = 3
+
+class WorkerLostError(ProcessingError):
+    "Raised when the worker processing a request died and the request was not retried"
+    error_code = 4
+
+def raise_for_reply(client, req_id, msg, msg_info):
+    if msg_info == ServerCmd.exception:
+        raise ProcessingError(to_str(msg), to_str(client), to_str(req_id))
+    elif msg_info == ServerCmd.overloaded:
+        raise ServerOverloadedError(to_str(msg), to_str(client), to_str(req_id))
+    elif msg_info == ServerCmd.deadline_exceeded:
+        raise DeadlineExceededError(to_str(msg), to_str(client), to_str(req_id))
+    elif msg_info == ServerCmd.worker_lost:
+        raise WorkerLostError(to_str(msg), to_str(client), to_str(req_id))
+
+def send_to_next(protocol, client, job_id, msg, dst, flags=0, info=None, slab=None):
     assert protocol in ['obj', 'numpy'], "{} is an invalid transfer protocol, must be 'obj' or 'numpy'".format(protocol)
     
     if protocol == 'obj':
-        send_object(dst, client, job_id, msg, flags=flags)
+        send_object(dst, client, job_id, msg, flags=flags, info=info, slab=slab)
     else:
-        send_ndarray(dst, client, job_id, msg, flags=flags)
+        send_ndarray(dst, client, job_id, msg, flags=flags, info=info, slab=slab)
 
 def recv_from_prev(protocol, src):
     assert protocol in ['obj', 'numpy'], "{} is an invalid transfer protocol, must be 'obj' or 'numpy'".format(protocol)
@@ -50,39 +79,54 @@ def recv_from_prev(protocol, src):
 def send_to_next_raw(client, req_id, msg, msg_info, dst, flags=0, copy=True, track=False):
     dst.send_multipart([to_bytes(client), to_bytes(req_id), msg, msg_info], flags, copy=copy, track=track)
 
-def send_ndarray(dst, client, job_id, array, flags=0, copy=True, track=False):
-    md = dict(dtype=str(array.dtype), shape=array.shape)
+def send_ndarray(dst, client, job_id, array, flags=0, copy=True, track=False, info=None, slab=None):
+    md = dict(dtype=str(array.dtype), shape=array.shape, **(info or {}))
+    # large payloads go through the shared memory slab, only the handle is sent
+    handle = slab.put(array) if slab is not None else None
+    if handle is not None:
+        array, md['shm'] = handle, 1
     msg_info = jsonapi.dumps(md)
     send_to_next_raw(client, job_id, array, msg_info, dst, flags=flags, copy=copy, track=track )
 
 def recv_ndarray(src):
     msg = src.recv_multipart()
     client, req_id, msg, msg_info = msg
-    if msg_info == ServerCmd.exception:
-        raise ProcessingError(to_str(msg), to_str(client), to_str(req_id))
+    raise_for_reply(client, req_id, msg, msg_info)
     arr_info, arr_val = jsonapi.loads(msg_info), msg
-    array = decode_ndarray(arr_val, arr_info)
+    if arr_info.get('shm'):
+        # result left in the worker slab, copy it out and give the slot back
+        array = decode_ndarray(read_shm(arr_val), arr_info).copy()
+        release_shm(arr_val)
+    else:
+        array = decode_ndarray(arr_val, arr_info)
     return to_str(client), to_str(req_id), array, arr_info
 
 def decode_ndarray(buffer, info):
     return np.frombuffer(memoryview(buffer), dtype=info['dtype']).reshape(info['shape'])
 
-def send_object(dst, client, job_id, obj, flags=0, copy=True, track=False, protocol=-1, need_compress=0):
+def send_object(dst, client, job_id, obj, flags=0, copy=True, track=False, protocol=-1, need_compress=0, info=None, slab=None):
     if need_compress == 1:
         p = pickle.dumps(obj, protocol)
         z = zlib.compress(p)
     else:
         z = pickle.dumps(obj, protocol)
-    obj_info = jsonapi.dumps(dict(protocol=protocol, compress=need_compress))
+    obj_info = dict(protocol=protocol, compress=need_compress, **(info or {}))
+    handle = slab.put(z) if slab is not None else None
+    if handle is not None:
+        z, obj_info['shm'] = handle, 1
+    obj_info = jsonapi.dumps(obj_info)
     send_to_next_raw(client, job_id, z, obj_info, dst, flags=flags, copy=copy, track=track )
 
 def recv_object(src):
     msg = src.recv_multipart()
     client, req_id, msg, msg_info = msg
-    if msg_info == ServerCmd.exception:
-        raise ProcessingError(to_str(msg), to_str(client), to_str(req_id))
+    raise_for_reply(client, req_id, msg, msg_info)
     obj_info, obj_buffer = jsonapi.loads(msg_info), msg
-    obj = decode_object(obj_buffer, obj_info)
+    if obj_info.get('shm'):
+        obj = decode_object(read_shm(obj_buffer), obj_info)
+        release_shm(obj_buffer)
+    else:
+        obj = decode_object(obj_buffer, obj_info)
     return to_str(client), to_str(req_id), obj, obj_info
 
 def decode_object(buffer, info):
@@ -0,0 +1,10 @@
+import os
+import sys
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SERVER_DIR)
+
+import wkr_serving  # noqa: E402
+
+# the client is a distribution of its own, installed into the same package as the server
+wkr_serving.__path__.append(os.path.join(os.path.dirname(SERVER_DIR), 'client', 'wkr_serving'))
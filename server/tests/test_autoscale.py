@@ -0,0 +1,85 @@
+from types import SimpleNamespace
+
+from wkr_serving.server.autoscale import IdleScaler, SLOAutoscaler
+from wkr_serving.server.scheduler import JobScheduler
+
+
+def make_scaler(num_pending=0, **kwargs):
+    pending = JobScheduler()
+    for k in range(num_pending):
+        pending.push(k)
+    pools = {'p': SimpleNamespace(pending_jobs=pending, batch_size=2)}
+    return SLOAutoscaler(pools, **kwargs)
+
+
+def workers(num_worker, min_worker=1, max_worker=4):
+    return {'p': {'num_worker': num_worker, 'min_worker': min_worker, 'max_worker': max_worker, 'startup_ms': 0}}
+
+
+def test_expand_on_a_deep_queue():
+    scaler = make_scaler(num_pending=10, expand_ms=0)
+    event, = scaler.evaluate(workers(1))
+    assert event['action'] == 'expand' and event['reason'] == 'queue_depth'
+    assert event['pressure'] == 5
+
+
+def test_expand_needs_a_sustained_pressure():
+    scaler = make_scaler(num_pending=10, expand_ms=60000)
+    event, = scaler.evaluate(workers(1))
+    assert event['action'] == 'hold'
+
+
+def test_hold_at_max_worker():
+    scaler = make_scaler(num_pending=10, expand_ms=0)
+    event, = scaler.evaluate(workers(4))
+    assert event['action'] == 'hold' and event['reason'].startswith('at max_worker')
+
+
+def test_latency_target():
+    scaler = make_scaler(expand_ms=0, latency_ms=100)
+    scaler.observe_pool('p', 0, {'latency': [50, 300, 400], 'inflight': 0})
+    event, = scaler.evaluate(workers(1))
+    assert event['action'] == 'expand' and event['reason'] == 'latency'
+
+
+def test_squeeze_an_idle_pool_down_to_min_worker():
+    scaler = make_scaler(squeeze_ms=0)
+    event, = scaler.evaluate(workers(3))
+    assert event['action'] == 'squeeze'
+    scaler.log(dict(event, done=True))
+    assert scaler.status['p']['num_squeeze'] == 1
+    event, = scaler.evaluate(workers(1))
+    assert event['action'] == 'hold'
+
+
+def test_trend():
+    assert SLOAutoscaler.trend([(0, 0)]) == 0
+    assert abs(SLOAutoscaler.trend([(0, 0), (1, 2), (2, 4)]) - 2) < 1e-9
+
+
+def test_idle_scaler_cycle():
+    scaler = IdleScaler(['p'], idle_ms=0)
+    assert scaler.idle_pools({'p': 1}) == []
+    scaler.observe_pool('p', 0, {'inflight': 2})
+    assert scaler.idle_pools({'p': 0}) == []
+    scaler.observe_pool('p', 0, {'inflight': 0})
+    assert scaler.idle_pools({'p': 0}) == ['p']
+
+    scaler.scaled_to_zero('p')
+    assert scaler.at_zero('p') and not scaler.serving('p')
+    assert scaler.wake('p') >= 0
+    assert scaler.starting_pools() == ['p']
+    assert scaler.started('p') >= 0
+    assert scaler.serving('p')
+
+    status = scaler.status['p']
+    assert status['num_scale_to_zero'] == 1 and status['num_cold_start'] == 1
+
+
+def test_idle_scaler_failed_start_goes_back_to_zero():
+    scaler = IdleScaler(['p'], idle_ms=0)
+    scaler.scaled_to_zero('p')
+    scaler.wake('p')
+    scaler.failed_start('p')
+    assert scaler.at_zero('p') and scaler.starting_pools() == []
+    assert scaler.status['p']['num_failed_cold_start'] == 1
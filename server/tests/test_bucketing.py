@@ -0,0 +1,53 @@
+import numpy as np
+
+from wkr_serving.server.bucketing import BatchBufferPool, bucket_key, pad_batch, unpad
+
+
+def test_bucket_key():
+    a, b = np.zeros((3, 2), np.float32), np.zeros((7, 2), np.float32)
+    assert bucket_key('none', a) is None
+    assert bucket_key('shape', a) != bucket_key('shape', b)
+    assert bucket_key('length', a, [4, 8]) != bucket_key('length', b, [4, 8])
+    assert bucket_key('length', a, [8]) == bucket_key('length', b, [8])
+
+
+def test_pad_batch():
+    arrays = [np.ones(2, np.int64), np.ones(4, np.int64)]
+    batch, mask, padding_waste = pad_batch(arrays, pad_value=-1)
+    assert batch.tolist() == [[1, 1, -1, -1], [1, 1, 1, 1]]
+    assert mask.sum() == 6
+    assert padding_waste == 0.25
+
+
+def test_pad_batch_in_pool_buffers():
+    pool = BatchBufferPool(4)
+    batch, mask, _ = pad_batch([np.ones((2, 3)), np.ones((1, 3))], pool=pool)
+    assert batch.shape == (2, 2, 3) and pool.owns(batch)
+    assert mask[1].sum() == 3
+
+
+def test_unpad():
+    output = np.arange(8).reshape(2, 4)
+    assert unpad(output[0], (2,), (4,)).tolist() == [0, 1]
+    # the model reduced the padded axis, nothing to cut
+    assert unpad(np.float32(3), (2,), (4,)) == 3
+    assert unpad(np.zeros(5), (2,), (4,)).shape == (5,)
+
+
+def test_buffer_pool_reuses_its_slots():
+    pool = BatchBufferPool(4, num_slots=2)
+    arrays = [np.full(3, k, np.float32) for k in range(4)]
+    first = pool.stack(arrays)
+    second = pool.stack(arrays[:2])
+    third = pool.stack(arrays[:3])
+    assert pool.num_alloc == 2
+    assert np.may_share_memory(first, third) and not np.may_share_memory(first, second)
+    assert third[:, 0].tolist() == [0, 1, 2]
+
+
+def test_buffer_pool_detach_copies_views():
+    pool = BatchBufferPool(2)
+    batch = pool.stack([np.zeros(2), np.ones(2)])
+    own = np.ones(2)
+    detached = pool.detach([batch[0], own])
+    assert not pool.owns(detached[0]) and detached[1] is own
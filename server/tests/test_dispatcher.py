@@ -0,0 +1,70 @@
+import time
+
+import pytest
+import zmq
+
+from wkr_serving.server.dispatcher import CreditDispatcher
+from wkr_serving.server.protocol import ServerCmd
+
+
+@pytest.fixture
+def ctx():
+    ctx = zmq.Context()
+    yield ctx
+    ctx.destroy(linger=0)
+
+
+def connect_worker(ctx, dispatcher, worker_id):
+    sock = ctx.socket(zmq.DEALER)
+    sock.setsockopt(zmq.IDENTITY, worker_id)
+    sock.connect(dispatcher.addresses[0])
+    return sock
+
+
+def grant(dispatcher, sock, num, *job_ids):
+    sock.send_multipart([ServerCmd.credit, str(num).encode(), *job_ids])
+    deadline = time.time() + 5
+    while time.time() < deadline:
+        if dispatcher.handle({dispatcher.sock: zmq.POLLIN}):
+            return
+        time.sleep(0.01)
+    raise TimeoutError('no credit received')
+
+
+def test_dispatch_follows_credits(ctx):
+    dispatcher = CreditDispatcher(ctx)
+    w1, w2 = connect_worker(ctx, dispatcher, b'w1'), connect_worker(ctx, dispatcher, b'w2')
+    assert not dispatcher.has_capacity()
+    grant(dispatcher, w1, 1)
+    grant(dispatcher, w2, 2)
+
+    assert dispatcher.dispatch(b'c', b'1', b'x', b'{}', job='job1')
+    assert w2.recv_multipart() == [b'c', b'1', b'x', b'{}']
+    assert dispatcher.dispatch(b'c', b'2', b'x', b'{}', job='job2')
+    assert dispatcher.dispatch(b'c', b'3', b'x', b'{}', job='job3')
+    assert not dispatcher.dispatch(b'c', b'4', b'x', b'{}')
+    # equal credits, the worker with the fewest jobs outstanding goes first
+    assert w1.recv_multipart()[1] == b'2'
+    assert w2.recv_multipart()[1] == b'3'
+
+    # the jobs not yet reported done are handed back when the worker goes away
+    grant(dispatcher, w2, 1, b'c#1')
+    assert dispatcher.remove_worker('w2') == ['job3']
+    dispatcher.close()
+
+
+def test_parked_worker_gets_no_job(ctx):
+    dispatcher = CreditDispatcher(ctx)
+    w1 = connect_worker(ctx, dispatcher, b'w1')
+    grant(dispatcher, w1, 2)
+    dispatcher.park_worker('w1')
+    assert not dispatcher.has_capacity()
+    # credits given back meanwhile are kept aside too
+    grant(dispatcher, w1, 1)
+    assert not dispatcher.dispatch(b'c', b'1', b'x', b'{}')
+    assert dispatcher.status['workers']['w1']['parked']
+
+    dispatcher.unpark_worker('w1')
+    assert dispatcher.status['workers']['w1']['free_credit'] == 3
+    assert dispatcher.dispatch(b'c', b'1', b'x', b'{}')
+    dispatcher.close()
@@ -0,0 +1,48 @@
+from wkr_serving.server.jobs import JobTable
+
+
+def make_old(table, key):
+    table._jobs[key]['arrival'] -= 100
+
+
+def test_register_and_pop():
+    jobs = JobTable(ttl=10)
+    job = jobs.register(('c', '1'), model='m')
+    assert ('c', '1') in jobs and jobs.get(('c', '1')) is job
+    assert job['registered'] and job['model'] == 'm'
+    assert jobs.pop(('c', '1')) is job
+    assert len(jobs) == 0
+
+
+def test_result_before_registration():
+    jobs = JobTable(ttl=10)
+    early = jobs.get(('c', '1'))
+    early['end'] = 1
+    job = jobs.register(('c', '1'))
+    assert job is early
+    assert jobs.status['num_early_result'] == 1
+
+
+def test_evict_only_reports_registered_jobs():
+    jobs = JobTable(ttl=10)
+    jobs.register(('c', '1'))
+    jobs.get(('c', '2'))
+    jobs.register(('c', '3'))
+    make_old(jobs, ('c', '1'))
+    make_old(jobs, ('c', '2'))
+    evicted = jobs.evict()
+    assert [key for key, _ in evicted] == [('c', '1')]
+    assert jobs.was_evicted(('c', '1')) and not jobs.was_evicted(('c', '2'))
+    assert jobs.evicted_job(('c', '1')) is evicted[0][1]
+    assert ('c', '3') in jobs and len(jobs) == 1
+
+
+def test_evicted_record_is_bounded():
+    jobs = JobTable(ttl=10, max_evicted=2)
+    for k in range(3):
+        jobs.register(('c', str(k)), shm_input=str(k))
+        make_old(jobs, ('c', str(k)))
+    assert len(jobs.evict()) == 3
+    assert not jobs.was_evicted(('c', '0'))
+    assert [job['shm_input'] for job in jobs.pop_forgotten()] == ['0']
+    assert jobs.pop_forgotten() == []
@@ -0,0 +1,48 @@
+import time
+
+import pytest
+
+from wkr_serving.server.micro_batching import MicroBatchPolicy, StageMeter
+
+
+def test_invalid_policy():
+    with pytest.raises(ValueError):
+        MicroBatchPolicy(8, 10, policy='fastest')
+
+
+def test_throughput_waits_for_the_window():
+    policy = MicroBatchPolicy(4, 50, policy='throughput')
+    now = time.time()
+    assert 0 < policy.wait_time(now, 1) <= 50
+    assert policy.wait_time(now - 1, 1) == 0
+    assert policy.wait_time(now, 4) is None
+
+
+def test_latency_never_waits():
+    policy = MicroBatchPolicy(4, 50, policy='latency')
+    assert policy.wait_time(time.time(), 1) == 0
+    assert policy.wait_time(time.time(), 4) is None
+
+
+def test_adaptive_follows_arrival_gap_and_predict_time():
+    policy = MicroBatchPolicy(8, 100, policy='throughput', adaptive=True)
+    policy._arrival_gap_ms = 2
+    policy.observe_predict(8, 10)
+    # about predict / gap jobs arrive during one predict
+    assert policy.target_size == 6
+    assert policy.window_ms == 10
+
+    policy = MicroBatchPolicy(8, 100, policy='latency', adaptive=True)
+    policy._arrival_gap_ms = 2
+    policy.observe_predict(8, 10)
+    assert policy.window_ms == 2
+    policy._arrival_gap_ms = 50
+    policy.observe_predict(8, 10)
+    assert policy.window_ms == 0
+
+
+def test_stage_meter_resets_after_each_report():
+    meter = StageMeter(['predict'])
+    meter.add('predict', 3600)
+    assert meter.occupancy() == {'sys_occupancy_predict': 1.0}
+    assert meter.occupancy() == {'sys_occupancy_predict': 0.0}
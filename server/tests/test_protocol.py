@@ -0,0 +1,63 @@
+import pickle
+
+import numpy as np
+import pytest
+from zmq.utils import jsonapi
+
+from wkr_serving.server.protocol import merge_payload, parse_job_info, split_payload
+from wkr_serving.server.shm import SharedMemorySlab
+
+
+def test_parse_job_info():
+    assert parse_job_info(jsonapi.dumps({'priority': 2, 'model': 'm'})) == {'priority': 2, 'model': 'm'}
+    assert parse_job_info(b'not json') == {}
+    assert parse_job_info(jsonapi.dumps([1, 2])) == {}
+
+
+@pytest.mark.parametrize('info', [
+    {'priority': 'high'}, {'priority': True}, {'deadline': float('nan')}, {'deadline': [1]},
+    {'part_size': 0}, {'part_size': 1.5}, {'model': 5},
+])
+def test_parse_job_info_rejects_bad_fields(info):
+    with pytest.raises(ValueError):
+        parse_job_info(jsonapi.dumps(info))
+
+
+def test_split_and_merge_objects():
+    items = [{'i': k} for k in range(5)]
+    info = {'protocol': -1, 'compress': 0, 'batch': 1}
+    parts = split_payload('obj', pickle.dumps(items, -1), info, 2)
+    assert [n for _, _, n in parts] == [2, 2, 1]
+    assert [jsonapi.loads(part_info)['part'] for _, part_info, _ in parts] == [0, 1, 2]
+    merged, merged_info = merge_payload('obj', [(msg, part_info) for msg, part_info, _ in parts])
+    assert pickle.loads(merged) == items
+
+
+def test_split_rejects_a_non_list_batch():
+    with pytest.raises(TypeError):
+        split_payload('obj', pickle.dumps({'i': 1}, -1), {'protocol': -1, 'compress': 0}, 2)
+
+
+def test_split_and_merge_arrays():
+    batch = np.arange(15, dtype=np.float32).reshape(5, 3)
+    info = {'dtype': 'float32', 'shape': batch.shape, 'batch': 1}
+    parts = split_payload('numpy', batch.tobytes(), info, 2)
+    assert [n for _, _, n in parts] == [2, 2, 1]
+    merged, merged_info = merge_payload('numpy', [(np.ascontiguousarray(msg).tobytes(), part_info) for msg, part_info, _ in parts])
+    merged_info = jsonapi.loads(merged_info)
+    assert np.array_equal(np.frombuffer(merged, merged_info['dtype']).reshape(merged_info['shape']), batch)
+
+
+def test_split_and_merge_shared_memory_arrays():
+    slab = SharedMemorySlab(1024, 2)
+    try:
+        batch = np.arange(12, dtype=np.float32).reshape(4, 3)
+        handle = slab.put(batch)
+        parts = split_payload('numpy', handle, {'dtype': 'float32', 'shape': batch.shape, 'shm': 1}, 3)
+        # parts stay handles on the slot of the whole batch
+        assert all(msg.startswith(slab.name.encode()) for msg, _, _ in parts)
+        merged, merged_info = merge_payload('numpy', [(msg, part_info) for msg, part_info, _ in parts])
+        assert np.array_equal(np.frombuffer(merged, np.float32).reshape(4, 3), batch)
+        assert slab.num_used == 0
+    finally:
+        slab.close()
@@ -0,0 +1,46 @@
+import pytest
+
+from wkr_serving.server.scheduler import JobScheduler
+
+
+def drain(queue):
+    jobs = []
+    while queue:
+        jobs.append(queue.pop()[0])
+    return jobs
+
+
+def test_invalid_policy():
+    with pytest.raises(ValueError):
+        JobScheduler('random')
+
+
+def test_fifo():
+    queue = JobScheduler('fifo')
+    for job, priority in [('a', 0), ('b', 5), ('c', 1)]:
+        queue.push(job, priority=priority)
+    assert queue.peek() == 'a'
+    assert drain(queue) == ['a', 'b', 'c']
+
+
+def test_priority_keeps_arrival_order_inside_a_class():
+    queue = JobScheduler('priority')
+    for job, priority in [('a', 0), ('b', 5), ('c', 1), ('d', 5)]:
+        queue.push(job, priority=priority)
+    job, wait_ms, priority = queue.pop()
+    assert (job, priority) == ('b', 5) and wait_ms >= 0
+    assert drain(queue) == ['d', 'c', 'a']
+
+
+def test_sjf():
+    queue = JobScheduler('sjf')
+    for job, size in [('a', 300), ('b', 10), ('c', 20)]:
+        queue.push(job, size=size)
+    assert drain(queue) == ['b', 'c', 'a']
+
+
+def test_edf_puts_jobs_without_deadline_last():
+    queue = JobScheduler('edf')
+    for job, deadline in [('a', None), ('b', 20.0), ('c', 10.0)]:
+        queue.push(job, deadline=deadline)
+    assert drain(queue) == ['c', 'b', 'a']
@@ -0,0 +1,66 @@
+import os
+import signal
+import time
+
+import pytest
+
+from wkr_serving.server import WKRServer, WKRHardWorker
+from wkr_serving.server.helper import get_args_parser
+from wkr_serving.client import WKRClient
+
+
+class Double(WKRHardWorker):
+    def get_model(self, envs, model_dir, model_name, tmp_dir):
+        return {'factor': 2}
+
+    def predict(self, model, input):
+        return [x * model['factor'] for x in input]
+
+
+@pytest.fixture
+def serve(tmp_path):
+    servers, clients = [], []
+
+    def start(port, *extra):
+        args = get_args_parser().parse_args(['-port', str(port), '-port_out', str(port+1), '-num_worker', '2', '-cpu',
+                                             '-model_dir', str(tmp_path), *extra])
+        server = WKRServer(args, hardprocesser=Double).__enter__()
+        servers.append(server)
+        clients.append(WKRClient(port=port, port_out=port+1, timeout=10000))
+        return server, clients[-1]
+
+    yield start
+    for client in clients:
+        client.close()
+    for server in servers:
+        server.close()
+
+
+def wait_for(condition, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if condition():
+            return True
+        time.sleep(0.1)
+    return False
+
+
+@pytest.mark.parametrize('dispatch', ['credit', 'random'])
+def test_killed_worker_is_restarted(serve, dispatch):
+    server, client = serve(18980 if dispatch == 'credit' else 18982, '-dispatch', dispatch)
+    assert client.encode(3) == 6
+    os.kill(server.process_workers[0].get_pid(), signal.SIGKILL)
+    assert wait_for(lambda: server.num_worker_restart == 1)
+    assert [client.encode(k) for k in range(4)] == [0, 2, 4, 6]
+
+
+def test_preload_template_death_keeps_serving(serve):
+    server, client = serve(18984, '-preload', '-dispatch', 'credit')
+    assert client.encode(3) == 6
+    forked = [p.get_pid() for p in server.process_workers]
+    os.kill(server.default_pool.template.pid, signal.SIGKILL)
+    # the next request must not wait on the dead template
+    assert [client.encode(k) for k in range(4)] == [0, 2, 4, 6]
+    assert wait_for(lambda: server.default_pool.template is None)
+    assert server.num_worker_restart == 2
+    assert all(p.get_pid() not in forked for p in server.process_workers)
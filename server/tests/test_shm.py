@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+
+from wkr_serving.server.shm import SharedMemorySlab, check_handle, read_shm, release_shm, sub_handle, take_shm
+
+
+@pytest.fixture
+def slab():
+    slab = SharedMemorySlab(64, 2, threshold=8)
+    yield slab
+    slab.close()
+
+
+def test_put_read_release(slab):
+    handle = slab.put(np.arange(4, dtype=np.int32))
+    assert slab.num_used == 1
+    assert np.frombuffer(read_shm(handle), np.int32).tolist() == [0, 1, 2, 3]
+    assert np.frombuffer(read_shm(sub_handle(handle, 4, 8)), np.int32).tolist() == [1, 2]
+    release_shm(handle)
+    assert slab.num_used == 0
+
+
+def test_put_falls_back_to_inline(slab):
+    # below the threshold, above the slot size, then no free slot left
+    assert slab.put(b'1234') is None
+    assert slab.put(bytes(65)) is None
+    handles = [slab.put(bytes(16)) for _ in range(2)]
+    assert slab.put(bytes(16)) is None
+    assert take_shm(handles[0]) == bytes(16)
+    assert slab.put(bytes(16)) is not None
+
+
+def test_check_handle(slab):
+    handle = slab.put(bytes(16))
+    assert check_handle(handle) == slab.name
+    name, slot, offset, nbytes = handle.decode().split(':')
+    bad = [
+        b'garbage',
+        b'\xff:0:64:8',
+        '/dev/shm/x:{}:{}:{}'.format(slot, offset, nbytes).encode(),
+        'wkr_0000000000000000:{}:{}:{}'.format(slot, offset, nbytes).encode(),
+        '{}:{}:{}:{}'.format(name, slot, offset, 10**12).encode(),
+        '{}:{}:{}:{}'.format(name, offset, offset, nbytes).encode(),
+        '{}:{}:{}:{}'.format(name, slot, offset, -1).encode(),
+    ]
+    for handle in bad:
+        with pytest.raises(ValueError):
+            check_handle(handle)
@@ -1,9 +1,11 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 # Han Xiao <artex.xh@gmail.com> <https://hanxiao.github.io>
+import ipaddress
 import multiprocessing
 import os
 import random
+import signal
 import sys
 import threading
 import time
@@ -21,9 +23,14 @@ from zmq.utils import jsonapi
 
 from .helper import *
 from .protocol import *
-from .zmq_decor import multi_socket
+from .dispatcher import get_dispatcher
+from .pool import PoolRouter, get_worker_pools
+from .template import WKRWorkerTemplate
+from .shm import check_handle, release_shm, shm_nbytes
 
+from .autoscale import IdleScaler, SLOAutoscaler
 from .postsink import WKRSink
+from .sharding import PublishProxy, sink_ports, sink_shard
 from .hard_worker import WKRHardWorker
 from .statistic import ServerStatistic
 
@@ -37,9 +44,18 @@ class WKRServer(threading.Thread):
         if hardprocesser is None:
             hardprocesser = WKRHardWorker
 
-        self.hardprocessor_skeleton = hardprocesser
-        if not issubclass(self.hardprocessor_skeleton, WKRHardWorker):
-            raise AssertionError('hardprocesser must inherit from class WKRHardWorker')
+        # one pool of workers per model, a single worker class is served as the "default" model
+        self.pools = get_worker_pools(args, hardprocesser)
+        for pool in self.pools.values():
+            if pool.hardprocessor_skeleton is None:
+                pool.hardprocessor_skeleton = WKRHardWorker
+            if not issubclass(pool.hardprocessor_skeleton, WKRHardWorker):
+                raise AssertionError('hardprocesser of model "%s" must inherit from class WKRHardWorker' % pool.name)
+        # requests that do not name a model go to the first pool
+        self.default_pool = next(iter(self.pools.values()))
+        # picks the pool of each request among the pools serving its model
+        self.router = PoolRouter(self.pools)
+        self.hardprocessor_skeleton = self.default_pool.hardprocessor_skeleton
 
         if httpprocessor is None:
             if args.http_new:
@@ -58,22 +74,27 @@ class WKRServer(threading.Thread):
 
         self.model_dir = args.model_dir
 
-        self.num_worker = args.num_worker
-        self.device_map = args.device_map
+        self.num_worker = self.default_pool.num_worker
         self.gpu_memory_fraction = args.gpu_memory_fraction
-        self.all_cpu = args.cpu
 
-        self.num_concurrent_postsocket = max(8, args.num_worker * 2)
-        self.batch_size = args.batch_size
+        self.batch_size = self.default_pool.batch_size
+        self.dispatch_mode = self.default_pool.dispatch_mode
+        self.schedule_policy = self.default_pool.args.schedule_policy
 
-        self.total_concurrent_socket = self.num_concurrent_postsocket
+        self.total_concurrent_socket = sum(pool.num_socket for pool in self.pools.values())
 
         self.port = args.port
+        # results are collected by "-num_sink" sink processes, each one serving the clients hashed to it
+        self.num_sink = args.num_sink
+        self.sink_ports = sink_ports(args)
+        self.publish_proxy = None
+        self.max_backlog = args.max_backlog
         self.args = args
         self.transfer_protocol = args.protocol
 
         self.status_args = {k: v for k, v in sorted(vars(args).items())}
         self.status_args.pop('http_api_appender', 'None')
+        self.status_args.pop('pool_args', None)
         self.status_static = {
             'python_version': sys.version,
             'server_version': __version__,
@@ -84,10 +105,38 @@ class WKRServer(threading.Thread):
         self.processes = []
         self.process_workers = []
         self.process_expanded_workers = []
+        # loaded and warm, out of the dispatch set until an expansion activates them
+        self.process_standby_workers = []
 
         # auto scaling policy
         self.num_worker_to_expand = args.num_worker_expanded
         self.device_to_expand = args.device_to_expand
+        self.num_standby = args.num_standby
+        self.cpu_core_budget = args.cpu_core_budget or os.cpu_count()
+        self.cores_per_worker = args.cores_per_worker
+        self.autoscaler = None
+        if args.autoscale == 'slo':
+            self.autoscaler = SLOAutoscaler(self.pools,
+                                            interval_ms=args.autoscale_interval,
+                                            expand_ms=args.duration_expand,
+                                            squeeze_ms=args.duration_squeeze,
+                                            latency_ms=args.slo_latency_ms,
+                                            percentile=args.slo_percentile,
+                                            queue_wait_ms=args.slo_queue_wait_ms,
+                                            queue_per_worker=args.slo_queue_per_worker,
+                                            scale_down_ratio=args.scale_down_ratio,
+                                            log_path=args.autoscale_log)
+        # pools without traffic close all their workers, the next request starts them again
+        self.idle_scaler = IdleScaler(self.pools, args.scale_to_zero_after) if args.scale_to_zero_after > 0 else None
+
+        # shared memory slab -> the client that first handed a handle on it in, see check_shm_input
+        self.shm_owners = {}
+
+        # supervision
+        self.heartbeat_timeout = args.heartbeat_timeout
+        self.worker_failure = args.worker_failure
+        self.max_job_retries = args.max_job_retries
+        self.num_worker_restart = 0
 
         # logging 
         self.logdir = args.log_dir
@@ -99,7 +148,9 @@ class WKRServer(threading.Thread):
 
     def __enter__(self):
         self.start()
-        self.is_ready.wait()
+        while not self.is_ready.wait(timeout=1):
+            if not self.is_alive():
+                raise RuntimeError('the server failed to start, see the log above')
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
@@ -135,91 +186,348 @@ class WKRServer(threading.Thread):
                         'no response from the server (with "timeout"=%d ms), please check the following:'
                         'is the server still online? is the network broken? are "port" correct? ' % args.timeout)
 
-    def generate_worker_process(self, args, worker_id, addr_backend_post_list, addr_sink, device_id):
-        process = self.hardprocessor_skeleton(worker_id, self.args, addr_backend_post_list, addr_sink, device_id)
+    def generate_worker_process(self, pool, worker_id, addr_sink, device_id):
+        process = pool.hardprocessor_skeleton(worker_id, pool.args, pool.dispatcher.addresses, addr_sink, device_id)
         return process
 
     def close_all_worker(self):
         # exited, close all child process
-        for p in self.process_workers:
+        for p in [*self.process_workers, *self.process_expanded_workers, *self.process_standby_workers]:
             p.close()
-        self.process_workers = []
-
-    def start_all_worker(self, addr_backend_post_list, addr_sink):
-        self.device_map_main_worker = self._get_device_map(self.num_worker, self.device_map, self.gpu_memory_fraction, run_all_cpu=self.all_cpu)
-        for idx, device_id in enumerate(self.device_map_main_worker):
-            process = self.generate_worker_process(self.args, idx, addr_backend_post_list, addr_sink, device_id)
+            self.pools[p.pool].dispatcher.remove_worker(p.worker_id)
+        self.process_workers, self.process_expanded_workers, self.process_standby_workers = [], [], []
+        for pool in self.pools.values():
+            if pool.template is not None:
+                pool.template.close()
+                pool.template = None
+
+    def start_all_worker(self, addr_sink):
+        for pool in self.pools.values():
+            self.start_pool_workers(pool, addr_sink)
+        self.device_map_main_worker = self.default_pool.device_map
+
+    def start_pool_workers(self, pool, addr_sink, wait=True):
+        """Start the "-num_worker" workers of `pool` and its standby workers, returns the workers.
+        With `wait=False` a pool with "-preload" only starts its template, the workers are started by
+        `launch_pool_workers` once the template loaded the model
+        """
+        args = pool.args
+        pool.device_map = self._get_device_map(pool.num_worker, args.device_map, args.gpu_memory_fraction, run_all_cpu=args.cpu)
+        # worker ids are only prefixed by their model when the server hosts several models
+        workers = [self.generate_worker_process(pool, idx if len(self.pools) == 1 else '%s-%d' % (pool.name, idx), addr_sink, device_id)
+                   for idx, device_id in enumerate(pool.device_map)]
+        if args.preload:
+            # the template gets the worker objects when it is forked, it loads the model once and forks them in turn
+            pool.template = WKRWorkerTemplate(args, workers, pool.device_map[0])
+            for p in workers:
+                p.template = pool.template
+            pool.template.start()
+            if not wait:
+                return workers
+            pool.template.wait_ready()
+        return self.launch_pool_workers(pool, workers, addr_sink)
+
+    def launch_pool_workers(self, pool, workers, addr_sink):
+        for process in workers:
             self.process_workers.append(process)
             process.start()
-
-    def restart_all_worker(self, addr_backend_post_list, addr_sink):
+        self.fill_standby(pool, addr_sink)
+        return workers
+
+    def close_pool_workers(self, pool):
+        """Close every worker of `pool`, expanded and standby ones included, and its template.
+        Returns the jobs the closed workers had not finished
+        """
+        lost_jobs = []
+        for workers in [self.process_workers, self.process_expanded_workers, self.process_standby_workers]:
+            for p in [p for p in workers if p.pool == pool.name]:
+                lost_jobs += pool.dispatcher.remove_worker(p.worker_id)
+                p.close()
+                workers.remove(p)
+        if pool.template is not None:
+            pool.template.close()
+            pool.template = None
+        return lost_jobs
+
+    def check_shm_input(self, client, handle, peer):
+        """Raises ValueError unless the navigator may read `handle`: the server runs with "-shm", the client
+        is connected through the loopback interface and the handle is on a slab of its own, within its bounds
+        """
+        if not self.args.shm:
+            raise ValueError('shared memory inputs need a server started with "-shm"')
+        try:
+            local = ipaddress.ip_address(peer).is_loopback
+        except ValueError:
+            local = False
+        if not local:
+            raise ValueError('shared memory inputs are only accepted from clients on the server host')
+        name = check_handle(handle)
+        if self.shm_owners.setdefault(name, client) != client:
+            raise ValueError('shared memory slab "{}" belongs to another client'.format(name))
+
+    def find_dead_workers(self):
+        """Workers that exited, that are serving but stopped sending heartbeats, or whose template died"""
+        dead = []
+        now = time.time()
+        for p in [*self.process_workers, *self.process_expanded_workers, *self.process_standby_workers]:
+            if p.template is not None and not p.template.is_alive():
+                # its workers can no longer be watched nor closed through it, all of them are replaced
+                dead.append((p, 'its template exited with code %s' % p.template.exitcode))
+                continue
+            exitcode = p.get_exitcode()
+            if exitcode is not None:
+                dead.append((p, 'exited with code %s' % exitcode))
+            elif self.heartbeat_timeout > 0 and p.is_ready.is_set() and (now - p.heartbeat.value)*1000 > self.heartbeat_timeout:
+                dead.append((p, 'no heartbeat for %.0fms' % ((now - p.heartbeat.value)*1000)))
+        return dead
+
+    def restart_worker(self, p, addr_sink):
+        """Replace a dead worker by a new one with the same id and device, returns the jobs the dead one held"""
+        pool = self.pools[p.pool]
+        lost_jobs = pool.dispatcher.remove_worker(p.worker_id)
+        try:
+            if p.get_exitcode() is None:
+                # a hung worker may not react to SIGTERM, closing it would block the navigator
+                try:
+                    os.kill(p.get_pid(), signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+            p.close()
+        except Exception as e:
+            self.logger.error('can not close WORKER-%s: %s' % (p.worker_id, e))
+        process = self.generate_worker_process(pool, p.worker_id, addr_sink, p.device_id)
+        if not p.active.is_set():
+            process.deactivate()
+        for workers in [self.process_workers, self.process_expanded_workers, self.process_standby_workers]:
+            if p in workers:
+                workers[workers.index(p)] = process
+        # a restarted worker loads its own model, the template only forks the workers it was started with
+        process.start()
+        self.num_worker_restart += 1
+        return lost_jobs
+
+    def worker_memory_status(self):
+        status = {}
+        for p in [*self.process_workers, *self.process_expanded_workers, *self.process_standby_workers]:
+            status[str(p.worker_id)] = {'pid': p.get_pid(), 'startup_ms': p.startup_time.value, **get_process_memory(p.get_pid())}
+        for pool in self.pools.values():
+            if pool.template is not None:
+                name = 'template' if len(self.pools) == 1 else 'template-%s' % pool.name
+                status[name] = {'pid': pool.template.pid, 'load_ms': pool.template.load_time.value,
+                                **get_process_memory(pool.template.pid)}
+        return status
+
+    def restart_all_worker(self, addr_sink):
         self.close_all_worker()
-        self.start_all_worker(addr_backend_post_list, addr_sink)
+        self.start_all_worker(addr_sink)
         for p in self.process_workers:
             p.is_ready.wait()
 
-    def expand_worker(self, addr_backend_post_list, addr_sink):
-        current_expanded_worker = len(self.process_expanded_workers)
+    def expand_worker(self, addr_sink, pool=None):
+        """Start one more worker in `pool`, the default pool by default, returns it or None when it can not"""
+        pool = pool or self.default_pool
+        current_expanded_worker = len([p for p in self.process_expanded_workers if p.pool == pool.name])
         self.logger.warning(f"expand_worker command received, current number expaned worker: {current_expanded_worker}")
 
         if current_expanded_worker >= self.num_worker_to_expand:
             self.logger.warning(f"current number of expanded worker ({current_expanded_worker}) is exeed assigned number ({self.num_worker_to_expand})")
-        else:
-            target_expand_device = self._get_expandable_device(self.device_to_expand, self.gpu_memory_fraction)
-            if target_expand_device is None:
-                self.logger.warning(f"trying to expand worker but no more GPU device is available, looked at devices: {self.device_to_expand} with at least {self.gpu_memory_fraction*100:0.1f}% memory available")
-            else:
-                target_expanded_worker_id = f"E{time.time()}"
-                process = self.generate_worker_process(self.args, target_expanded_worker_id, addr_backend_post_list, addr_sink, target_expand_device)
-                self.process_expanded_workers.append(process)
-                process.start()
-                self.logger.warning(f"started 1 WORKER-{target_expanded_worker_id} at GPU {target_expand_device}")
+            return None
+        standby = [p for p in self.process_standby_workers if p.pool == pool.name]
+        if standby:
+            # a warm one first, a standby still loading its model is ready sooner than a new worker
+            process = next((p for p in standby if p.is_warm.is_set()), standby[0])
+            if process.device_id < 0 and self.cpu_cores_used() + self.cores_per_worker > self.cpu_core_budget:
+                self.logger.warning(f"trying to expand worker but the CPU workers already use {self.cpu_cores_used()} of {self.cpu_core_budget} cores")
+                return None
+            self.process_standby_workers.remove(process)
+            self.process_expanded_workers.append(process)
+            pool.dispatcher.unpark_worker(process.worker_id)
+            process.activate()
+            self.logger.warning(f"activated standby WORKER-{process.worker_id} ({'warm' if process.is_warm.is_set() else 'still loading'})")
+            self.fill_standby(pool, addr_sink)
+            return process
+        target_expand_device = self._get_expand_device(pool)
+        if target_expand_device is None:
+            return None
+        target_expanded_worker_id = f"E{time.time()}" if len(self.pools) == 1 else f"{pool.name}-E{time.time()}"
+        process = self.generate_worker_process(pool, target_expanded_worker_id, addr_sink, target_expand_device)
+        self.process_expanded_workers.append(process)
+        process.start()
+        self.logger.warning(f"started 1 WORKER-{target_expanded_worker_id} at {'cpu' if target_expand_device < 0 else 'GPU %d' % target_expand_device}")
+        return process
 
-    def squeeze_worker(self):
+    def squeeze_worker(self, pool=None, num_worker=None):
+        """Close expanded workers, the last started first: `num_worker` of `pool`, all of them by default.
+        With "-num_standby" and "-dispatch credit" they are sent back to standby instead: the dispatcher stops
+        sending them jobs, they keep running, finish the jobs they hold and keep their model.
+        Returns the jobs the closed workers held, as (pool, job)
+        """
         self.logger.warning("squeeze_worker command received")
-        # kill all expanded worker
-        closed_expanded_worker = 0
-        for p in self.process_expanded_workers:
+        candidates = [p for p in self.process_expanded_workers if pool is None or p.pool == pool.name]
+        closing = candidates[::-1][:num_worker] if num_worker is not None else candidates
+        lost_jobs, num_parked = [], 0
+        for p in closing:
+            self.process_expanded_workers.remove(p)
+            # with "-dispatch random" the jobs queued for a worker leaving the sockets are lost, it is closed
+            if self.num_standby > 0 and self.pools[p.pool].dispatch_mode == 'credit':
+                # it finishes the jobs it holds and keeps its model for the next expansion
+                self.pools[p.pool].dispatcher.park_worker(p.worker_id)
+                p.deactivate()
+                self.process_standby_workers.append(p)
+                lost_jobs += [(self.pools[p.pool], job) for job in self.trim_standby(self.pools[p.pool], keep=p)]
+                num_parked += 1
+                continue
+            # no new job for it, then the jobs it still holds go back to the caller
+            lost_jobs += [(self.pools[p.pool], job) for job in self.pools[p.pool].dispatcher.remove_worker(p.worker_id)]
             p.close()
-            closed_expanded_worker += 1
-        self.process_expanded_workers = []
-        self.logger.warning(f"killed {closed_expanded_worker} expanded worker")
+        self.logger.warning(f"killed {len(closing) - num_parked} and sent back to standby {num_parked} expanded worker")
+        return lost_jobs
+
+    def fill_standby(self, pool, addr_sink):
+        """Start standby workers until `pool` has "-num_standby" of them, they load their model in the background"""
+        while len([p for p in self.process_standby_workers if p.pool == pool.name]) < self.num_standby:
+            # an idle standby uses no core, the core budget is checked when it is activated
+            target_device = -1 if pool.args.cpu or all(device_id < 0 for device_id in pool.device_map) else self._get_expand_device(pool)
+            if target_device is None:
+                return
+            worker_id = f"S{time.time()}" if len(self.pools) == 1 else f"{pool.name}-S{time.time()}"
+            process = self.generate_worker_process(pool, worker_id, addr_sink, target_device)
+            process.deactivate()
+            self.process_standby_workers.append(process)
+            process.start()
+            self.logger.info(f"started standby WORKER-{worker_id} at {'cpu' if target_device < 0 else 'GPU %d' % target_device}")
+
+    def trim_standby(self, pool, keep=None):
+        """Close the standby workers of `pool` over "-num_standby", those still loading first.
+        Returns the jobs a closed worker sent back to standby had not finished yet
+        """
+        standby = [p for p in self.process_standby_workers if p.pool == pool.name and p is not keep]
+        standby.sort(key=lambda p: p.is_warm.is_set())
+        lost_jobs = []
+        for p in standby[:max(0, len(standby) + (keep is not None) - self.num_standby)]:
+            lost_jobs += pool.dispatcher.remove_worker(p.worker_id)
+            p.close()
+            self.process_standby_workers.remove(p)
+        return lost_jobs
+
+    def pool_workers(self, pool):
+        """Current and allowed number of workers of a pool, for the autoscaler"""
+        workers = [p for p in [*self.process_workers, *self.process_expanded_workers] if p.pool == pool.name]
+        return {
+            'num_worker': len(workers),
+            'min_worker': pool.num_worker,
+            'max_worker': pool.num_worker + self.num_worker_to_expand,
+            # time a new worker takes to serve, the horizon of the autoscaler
+            'startup_ms': max([p.startup_time.value for p in workers] or [0]),
+        }
+
+    def cpu_cores_used(self):
+        return self.cores_per_worker * sum(p.device_id < 0 for p in [*self.process_workers, *self.process_expanded_workers])
 
     def run(self):
         self._run()
 
     @zmqd.context()
     @zmqd.socket(zmq.PULL)
-    @zmqd.socket(zmq.PAIR)
-    @multi_socket(zmq.PUSH, num_socket='total_concurrent_socket')
-    def _run(self, _, frontend, sink, *backend_socks):
-
-        def push_new_job(client, req_id, msg_raw, msg_info_raw):
-            # start = time.time()
-            _sock = rand_backend_socket
-            send_to_next_raw(client, req_id, msg_raw, msg_info_raw, _sock)
-            # end = time.time()
-            # self.logger.warning("Push to worker: {}".format(end-start))
+    def _run(self, ctx, frontend):
+        for pool in self.pools.values():
+            pool.dispatcher = get_dispatcher(pool.dispatch_mode, ctx, pool.num_socket)
+        # one PAIR socket per sink shard
+        sinks = [ctx.socket(zmq.PAIR) for _ in range(self.num_sink)]
+        try:
+            self._run_navigator(frontend, sinks)
+        finally:
+            for pool in self.pools.values():
+                pool.dispatcher.close()
+            for sink in sinks:
+                sink.close()
+            if self.publish_proxy is not None:
+                self.publish_proxy.close()
+
+    def _run_navigator(self, frontend, sinks):
+        # jobs registered to the sink but not yet sent back to the client
+        num_inflight_job = 0
+        num_rejected_job = 0
+        # jobs held by a dead worker
+        num_lost_job = 0
+        num_requeued_job = 0
+        # latest counters and statistic samples of the other sink shards, merged in the config reply
+        sink_shard_status = {}
+
+        def sink_of(client):
+            return sinks[sink_shard(client, len(sinks))]
+
+        def push_new_job(pool, client, req_id, msg_raw, msg_info_raw, job_info, cost=1, size=None, attempt=0):
+            size = len(msg_raw) if size is None else size
+            pool.pending_jobs.push((client, req_id, msg_raw, msg_info_raw, job_info, cost, size, attempt),
+                                   priority=job_info.get('priority', 0),
+                                   deadline=job_info.get('deadline'),
+                                   size=size)
+            if self.idle_scaler is not None:
+                self.idle_scaler.touch(pool.name)
+                if self.idle_scaler.at_zero(pool.name):
+                    cold_start(pool)
+            push_pending_jobs(pool)
+
+        def push_pending_jobs(pool):
+            if self.idle_scaler is not None and not self.idle_scaler.serving(pool.name):
+                # kept in the queue until a worker of the pool is ready
+                return
+            pending_jobs, dispatcher = pool.pending_jobs, pool.dispatcher
+            while pending_jobs and dispatcher.has_capacity():
+                job = pending_jobs.peek()
+                client, req_id, msg_raw, msg_info_raw, job_info, cost, _, _ = job
+                deadline = job_info.get('deadline')
+                if deadline and time.time() > deadline:
+                    # nobody is waiting for this result anymore, do not spend worker time on it
+                    pending_jobs.pop()
+                    self.logger.warning('drop expired job\treq id: %s\tclient: %s' % (str(req_id), client))
+                    sink_of(client).send_multipart([client, ServerCmd.deadline_exceeded,
+                                         to_bytes('deadline exceeded while waiting in the navigator queue'), to_bytes(req_id)])
+                    continue
+                if not dispatcher.dispatch(client, req_id, msg_raw, msg_info_raw, cost=cost, job=job):
+                    break
+                _, wait_time, priority = pending_jobs.pop()
+                server_status.update_key('sys_queue_wait_%s' % pending_jobs.policy, wait_time)
+                if self.autoscaler is not None:
+                    self.autoscaler.observe_wait(pool.name, wait_time)
+                if pending_jobs.policy == 'priority':
+                    server_status.update_key('sys_queue_wait_priority_%d' % priority, wait_time)
+                model_status[pool.name].update_key('sys_queue_wait_%s' % pending_jobs.policy, wait_time)
 
         # bind all sockets
         self.logger.info('bind all sockets')
         frontend.bind('tcp://*:%d' % self.port)
-        addr_front2sink = auto_bind(sink)
-
-        addr_backend_post_list = [auto_bind(b) for b in backend_socks]
-        self.logger.info('open %d worker sockets' % len(addr_backend_post_list))
-
-        # start the sink process
-        self.logger.info('start the sink')
-        proc_postsink = WKRSink(self.args, addr_front2sink, addr_backend_post_list)
-        self.processes.append(proc_postsink)
-        proc_postsink.start()
-        addr_sink = sink.recv().decode('ascii')
+        addr_front2sink = [auto_bind(sink) for sink in sinks]
+
+        for pool in self.pools.values():
+            self.logger.info('open %d worker sockets for model %s, dispatch mode: %s' % (len(pool.dispatcher.addresses), pool.name, pool.dispatch_mode))
+        addr_backend_post_list = [addr for pool in self.pools.values() for addr in pool.dispatcher.addresses]
+
+        # start the sink processes
+        self.logger.info('start %d sink(s), results published on port(s): %s' % (self.num_sink, self.sink_ports))
+        publish_addr = None
+        if self.num_sink > 1 and self.args.sink_publish == 'shared':
+            self.publish_proxy = PublishProxy(self.args.port_out)
+            publish_addr = self.publish_proxy.address
+        for shard, addr in enumerate(addr_front2sink):
+            proc_postsink = WKRSink(self.args, addr, addr_backend_post_list, shard=shard, publish_addr=publish_addr)
+            self.processes.append(proc_postsink)
+            proc_postsink.start()
+        # workers get the receiver address of every shard
+        addr_sink = [sink.recv().decode('ascii') for sink in sinks]
 
         # start the post-backend processes
         # WaveWorker: self, id, args, worker_address_list, sink_address, device_id
         self.logger.info('start main-workers')
-        self.start_all_worker(addr_backend_post_list, addr_sink)
+        try:
+            self.start_all_worker(addr_sink)
+        except Exception:
+            # nothing is served yet, the sinks and the workers already started go down with the navigator
+            self.close_all_worker()
+            for p in self.processes:
+                p.close()
+            raise
 
         # start the http-service process
         if self.args.http_port:
@@ -228,8 +536,9 @@ class WKRServer(threading.Thread):
             self.processes.append(proc_proxy)
             proc_proxy.start()
 
-        rand_backend_socket = None
         server_status = ServerStatistic()
+        # requests and queue waits by model
+        model_status = defaultdict(ServerStatistic)
         
         for p in [*self.processes, *self.process_workers]:
             p.is_ready.wait()
@@ -237,16 +546,143 @@ class WKRServer(threading.Thread):
         self.is_ready.set()
         self.logger.info('all set, ready to serve request!')
 
+        def recover_jobs(pool, lost_jobs, error_msg):
+            # jobs held by a worker that is gone, handed to another worker or failed
+            nonlocal num_lost_job, num_requeued_job
+            for client, req_id, msg_raw, msg_info_raw, job_info, cost, size, attempt in lost_jobs:
+                num_lost_job += 1
+                if self.worker_failure == 'requeue' and attempt < self.max_job_retries:
+                    num_requeued_job += 1
+                    self.logger.warning('re-queue job\treq id: %s\tclient: %s\tattempt: %d' % (to_str(req_id), client, attempt+1))
+                    push_new_job(pool, client, req_id, msg_raw, msg_info_raw, job_info, cost=cost, size=size, attempt=attempt+1)
+                else:
+                    self.logger.error('fail job\treq id: %s\tclient: %s' % (to_str(req_id), client))
+                    sink_of(client).send_multipart([client, ServerCmd.worker_lost, to_bytes(error_msg), to_bytes(req_id)])
+
+        def supervise_workers():
+            for p, reason in self.find_dead_workers():
+                if self.idle_scaler is not None and not self.idle_scaler.serving(p.pool):
+                    # a worker that dies during a cold start fails it, see check_cold_starts
+                    continue
+                self.logger.error('WORKER-%s is dead (%s), restarting it' % (p.worker_id, reason))
+                lost_jobs = self.restart_worker(p, addr_sink)
+                recover_jobs(self.pools[p.pool], lost_jobs, 'WORKER-%s died while processing this job (%s)' % (p.worker_id, reason))
+            for pool in self.pools.values():
+                if pool.template is not None and not pool.template.is_alive() and \
+                        (self.idle_scaler is None or self.idle_scaler.serving(pool.name)):
+                    # its workers were all replaced by workers loading their own model
+                    self.logger.error('the template of pool %s exited with code %s' % (pool.name, pool.template.exitcode))
+                    pool.template.close()
+                    pool.template = None
+
+        def scale_to_zero():
+            for name in self.idle_scaler.idle_pools({name: len(pool.pending_jobs) for name, pool in self.pools.items()}):
+                pool = self.pools[name]
+                self.logger.warning('pool %s got no request for %dms, closing all its workers' % (name, self.idle_scaler.idle_ms))
+                lost_jobs = self.close_pool_workers(pool)
+                self.idle_scaler.scaled_to_zero(name)
+                recover_jobs(pool, lost_jobs, 'the workers of the pool were closed while processing this job')
+
+        def cold_start(pool):
+            idle_s = self.idle_scaler.wake(pool.name)
+            self.logger.warning('pool %s was at zero for %.1fs, starting its workers' % (pool.name, idle_s))
+            # the navigator keeps serving the other pools while the workers load, check_cold_starts follows them
+            self.start_pool_workers(pool, addr_sink, wait=False)
+
+        def fail_cold_start(pool, reason):
+            exception_msg = 'the workers of model %s could not be started: %s' % (pool.name, reason)
+            self.logger.error('%s, failing %d waiting job(s)' % (exception_msg, len(pool.pending_jobs)))
+            # nothing was dispatched to a starting pool, there are no lost jobs
+            self.close_pool_workers(pool)
+            self.idle_scaler.failed_start(pool.name)
+            while pool.pending_jobs:
+                (client, req_id, *_), _, _ = pool.pending_jobs.pop()
+                sink_of(client).send_multipart([client, ServerCmd.exception, to_bytes(exception_msg), to_bytes(req_id)])
+
+        def check_cold_starts():
+            for name in self.idle_scaler.starting_pools():
+                pool = self.pools[name]
+                workers = [p for p in self.process_workers if p.pool == name]
+                if pool.template is not None and not workers:
+                    # "-preload": the workers are forked once the template loaded the model
+                    if pool.template.is_ready.is_set():
+                        self.launch_pool_workers(pool, list(pool.template.workers.values()), addr_sink)
+                    elif not pool.template.is_alive():
+                        fail_cold_start(pool, 'the template exited with code %s before loading the model' % pool.template.exitcode)
+                    continue
+                if not any(p.is_ready.is_set() for p in workers):
+                    exited = [(p, p.get_exitcode()) for p in workers]
+                    exited = [(p, exitcode) for p, exitcode in exited if exitcode is not None]
+                    if exited:
+                        fail_cold_start(pool, 'WORKER-%s exited with code %s before it was ready' % (exited[0][0].worker_id, exited[0][1]))
+                    continue
+                cold_start_ms = self.idle_scaler.started(name)
+                server_status.update_key('sys_cold_start_ms', cold_start_ms)
+                model_status[name].update_key('sys_cold_start_ms', cold_start_ms)
+                self.logger.warning('pool %s is serving again after a cold start of %.0fms, %d job(s) were waiting' % (
+                    name, cold_start_ms, len(pool.pending_jobs)))
+                push_pending_jobs(pool)
+
+        def autoscale():
+            # a pool at zero or starting has no worker to add or remove
+            pool_workers = {name: self.pool_workers(pool) for name, pool in self.pools.items()
+                            if self.idle_scaler is None or self.idle_scaler.serving(name)}
+            for event in self.autoscaler.evaluate(pool_workers):
+                pool = self.pools[event['pool']]
+                if event['action'] == 'expand':
+                    event['done'] = self.expand_worker(addr_sink, pool) is not None
+                elif event['action'] == 'squeeze':
+                    for _, job in self.squeeze_worker(pool, num_worker=1):
+                        recover_jobs(pool, [job], 'a worker was removed by the autoscaler while processing this job')
+                    event['done'] = True
+                if event['action'] != 'hold':
+                    self.logger.warning('autoscale %s pool %s%s: %s, pressure %.2f, %d worker(s)' % (
+                        event['action'], pool.name, '' if event['done'] else ' (not possible)',
+                        event['reason'], event['pressure'], event['num_worker']))
+                self.autoscaler.log(event)
+
         poller = zmq.Poller()
         poller.register(frontend, zmq.POLLIN)
-        poller.register(sink, zmq.POLLIN)
+        for sink in sinks:
+            poller.register(sink, zmq.POLLIN)
+        for pool in self.pools.values():
+            pool.dispatcher.register(poller)
+
+        # how often workers are checked, the poll timeout also bounds it when there is no traffic
+        supervise_interval = min(1.0, self.heartbeat_timeout/4000) if self.heartbeat_timeout > 0 else 1.0
+        last_supervise = time.time()
 
         while True:
-            socks = dict(poller.poll())
+            # a starting worker gives no sign on the sockets, it is looked for more often
+            starting = self.idle_scaler is not None and self.idle_scaler.starting_pools()
+            socks = dict(poller.poll(50 if starting else supervise_interval*1000))
+
+            # a failure while looking after the workers is logged, it never stops the navigator
+            try:
+                if time.time() - last_supervise >= supervise_interval:
+                    last_supervise = time.time()
+                    supervise_workers()
+                    if self.idle_scaler is not None:
+                        scale_to_zero()
+
+                if starting:
+                    check_cold_starts()
+
+                if self.autoscaler is not None and self.autoscaler.due():
+                    autoscale()
+            except Exception as e:
+                self.logger.error('can not supervise the workers: %s' % e, exc_info=True)
+
+            for pool in self.pools.values():
+                if pool.dispatcher.handle(socks):
+                    push_pending_jobs(pool)
 
             if socks.get(frontend) == zmq.POLLIN:
                 try:
-                    request = frontend.recv_multipart()
+                    request = frontend.recv_multipart(copy=False)
+                    # only a client on this host may hand in shared memory handles
+                    peer = request[0].get('Peer-Address')
+                    request = [frame.bytes for frame in request]
                     client, req_id, msg, msg_info = request
                     # client, req_id, msg, msg_info = recv_from_prev(self.transfer_protocol, frontend)
                     # request = [client, msg, req_id, msg_info]
@@ -254,63 +690,159 @@ class WKRServer(threading.Thread):
                     exception_msg = 'received a wrongly-formatted request (expected 4 frames, got %d)' % len(request)
                     self.logger.error(exception_msg)
                     self.logger.error('\n'.join('field %d: %s' % (idx, k) for idx, k in enumerate(request)), exc_info=True)
-                    sink.send_multipart([client, ServerCmd.exception, to_bytes(exception_msg), to_bytes(req_id)])
+                    sink_of(client).send_multipart([client, ServerCmd.exception, to_bytes(exception_msg), to_bytes(req_id)])
                 else:
-                    server_status.update(request)
-                    if msg == ServerCmd.terminate:
-                        break
-                    elif msg == ServerCmd.show_config:
-                        self.logger.info('new config request\treq id: %d\tclient: %s' % (int(req_id), client))
-                        status_runtime = {'client': client.decode('ascii'),
-                                        'num_process': len(self.processes) + len(self.process_workers),
-                                        'num_worker_process': len(self.process_workers),
-                                        'num_expanded_worker_process': len(self.process_expanded_workers),
-                                        'navigator -> worker': addr_backend_post_list,
-                                        'worker -> sink': addr_sink,
-                                        'server_current_time': str(datetime.now()),
-                                        'statistic': server_status.value,
-                                        'main_device_map': self.device_map_main_worker,
-                                        'main_batch_size': self.batch_size,
-                                        'protocol': self.transfer_protocol,
-                                        'num_concurrent_socket': self.total_concurrent_socket}
-                        grant_status = {
-                            **status_runtime,
-                            **self.status_args,
-                            **self.status_static
-                        }
-                        sink.send_multipart([client, msg, jsonapi.dumps(grant_status), req_id])
-                    else:
-                        self.logger.info('new encode request\treq id: %s\tclient: %s' %
-                                        (str(req_id), client))
-
-                        # regist job
-                        sink.send_multipart([client, ServerCmd.new_job, 
-                                            jsonapi.dumps({
-                                                'job_parts': '1', 
-                                                'split_info': {}, 
-                                                'time': time.time(),
-                                                'input_byte': len(msg)
-                                            }), to_bytes(req_id)])
-
-                        # pick random socket
-                        rand_backend_socket = random.choice([b for b in backend_socks if b != rand_backend_socket])
-
-                        # push job
-                        push_new_job(client, req_id, msg, msg_info)
+                    try:
+                        server_status.update(request)
+                        job_info = parse_job_info(msg_info)
+                        if job_info.get('shm'):
+                            # msg is a handle on a client slab, checked before the navigator releases or reads it
+                            self.check_shm_input(client, msg, peer)
+                        if msg == ServerCmd.terminate:
+                            break
+                        elif msg == ServerCmd.show_config:
+                            self.logger.info('new config request\treq id: %d\tclient: %s' % (int(req_id), client))
+                            status_runtime = {'client': client.decode('ascii'),
+                                            'num_process': len(self.processes) + len(self.process_workers),
+                                            'num_worker_process': len(self.process_workers),
+                                            'num_expanded_worker_process': len(self.process_expanded_workers),
+                                            'num_standby_worker_process': len(self.process_standby_workers),
+                                            'num_warm_standby_worker': sum(p.is_warm.is_set() for p in self.process_standby_workers),
+                                            # a worker takes requests only once its warm-up is done
+                                            'num_serving_worker': sum(p.is_ready.is_set() for p in [*self.process_workers, *self.process_expanded_workers]),
+                                            'navigator -> worker': addr_backend_post_list,
+                                            'worker -> sink': addr_sink,
+                                            'num_sink': self.num_sink,
+                                            # clients subscribe on every port to get the results of their shard
+                                            'sink_ports': self.sink_ports,
+                                            'server_current_time': str(datetime.now()),
+                                            'statistic': server_status.value,
+                                            'main_device_map': self.device_map_main_worker,
+                                            'main_batch_size': self.batch_size,
+                                            'protocol': self.transfer_protocol,
+                                            'num_concurrent_socket': self.total_concurrent_socket,
+                                            'num_pending_job': sum(len(pool.pending_jobs) for pool in self.pools.values()),
+                                            'num_inflight_job': num_inflight_job,
+                                            'num_rejected_job': num_rejected_job,
+                                            'num_worker_restart': self.num_worker_restart,
+                                            'num_lost_job': num_lost_job,
+                                            'num_requeued_job': num_requeued_job,
+                                            'dispatch_status': self.default_pool.dispatcher.status,
+                                            'model_pools': {name: pool.status for name, pool in self.pools.items()},
+                                            'autoscale_status': self.autoscaler.status if self.autoscaler is not None else None,
+                                            'scale_to_zero_status': self.idle_scaler.status if self.idle_scaler is not None else None,
+                                            'statistic_models': {name: status.value for name, status in model_status.items()},
+                                            'worker_memory': self.worker_memory_status()}
+                            grant_status = {
+                                **status_runtime,
+                                **self.status_args,
+                                **self.status_static
+                            }
+                            if len(sinks) > 1:
+                                grant_status['sink_shards'] = list(sink_shard_status.values())
+                            # the first shard answers, it publishes on "port_out" which every client listens to
+                            sinks[0].send_multipart([client, msg, jsonapi.dumps(grant_status), req_id])
+                        elif self.max_backlog > 0 and num_inflight_job >= self.max_backlog:
+                            # fail fast instead of queueing behind the backlog
+                            num_rejected_job += 1
+                            exception_msg = 'server overloaded: %d jobs in flight, "max_backlog"=%d, please retry later' % (num_inflight_job, self.max_backlog)
+                            self.logger.warning('reject request\treq id: %s\tclient: %s\t%s' % (str(req_id), client, exception_msg))
+                            sink_of(client).send_multipart([client, ServerCmd.overloaded, to_bytes(exception_msg), req_id])
+                            if job_info.get('shm'):
+                                release_shm(msg)
+                        elif job_info.get('model') and job_info['model'] not in self.router.routes:
+                            exception_msg = 'unknown model "%s", this server serves: %s' % (job_info.get('model'), ', '.join(self.router.routes))
+                            self.logger.error('%s\treq id: %s\tclient: %s' % (exception_msg, str(req_id), client))
+                            sink_of(client).send_multipart([client, ServerCmd.exception, to_bytes(exception_msg), req_id])
+                            if job_info.get('shm'):
+                                release_shm(msg)
+                        else:
+                            # payloads of same-host clients stay in their shared memory slab, msg is only the handle
+                            input_byte = shm_nbytes(msg) if job_info.get('shm') else len(msg)
+                            pool = self.router.route(job_info.get('model'), input_byte)
+
+                            self.logger.info('new encode request\treq id: %s\tclient: %s\tpool: %s' %
+                                            (str(req_id), client, pool.name))
+                            model_status[pool.name].update(request, ignore_first=True)
+
+                            job_parts = None
+                            if job_info.get('batch'):
+                                # scatter a batch request over the workers, in parts of one worker batch
+                                try:
+                                    job_parts = split_payload(self.transfer_protocol, msg, job_info, pool.batch_size)
+                                except Exception as e:
+                                    exception_msg = 'can not split batch request: {}'.format(e)
+                                    self.logger.error(exception_msg)
+                                    sink_of(client).send_multipart([client, ServerCmd.exception, to_bytes(exception_msg), req_id])
+                                    if job_info.get('shm'):
+                                        release_shm(msg)
+
+                            if job_parts or not job_info.get('batch'):
+                                # regist job
+                                sink_of(client).send_multipart([client, ServerCmd.new_job, 
+                                                    jsonapi.dumps({
+                                                        'job_parts': str(len(job_parts)) if job_parts else '1', 
+                                                        'split_info': {'part_size': pool.batch_size} if job_parts else {}, 
+                                                        'time': time.time(),
+                                                        'input_byte': input_byte,
+                                                        'deadline': job_info.get('deadline'),
+                                                        'shm_input': to_str(msg) if job_info.get('shm') else None,
+                                                        'shm_client': bool(job_info.get('shm_ok')),
+                                                        'model': pool.name
+                                                    }), to_bytes(req_id)])
+                                num_inflight_job += 1
+
+                            # push job
+                            if job_parts:
+                                num_items = sum(part[2] for part in job_parts)
+                                for part_idx, (part_msg, part_info, part_size) in enumerate(job_parts):
+                                    push_new_job(pool, client, '%s/%d' % (to_str(req_id), part_idx), part_msg, part_info, job_info, cost=part_size,
+                                                 size=input_byte*part_size//max(1, num_items))
+                            elif not job_info.get('batch'):
+                                push_new_job(pool, client, req_id, msg, msg_info, job_info, size=input_byte)
+                    except Exception as e:
+                        # one bad request is answered, it never stops the navigator
+                        exception_msg = 'can not handle the request: {}'.format(e)
+                        self.logger.error('%s\treq id: %s\tclient: %s' % (exception_msg, to_str(req_id), client), exc_info=True)
+                        sink_of(client).send_multipart([client, ServerCmd.exception, to_bytes(exception_msg), to_bytes(req_id)])
             
-            if socks.get(sink) == zmq.POLLIN:
+            for sink in sinks:
+                if socks.get(sink) != zmq.POLLIN:
+                    continue
                 try:
-                    command = sink.recv()
-                    if command == ServerCmd.expand_worker:
-                        self.expand_worker(addr_backend_post_list, addr_sink)
+                    command, *payload = sink.recv_multipart()
+                    if command == ServerCmd.job_done:
+                        num_inflight_job = max(0, num_inflight_job - int(payload[0]))
+                    elif command == ServerCmd.sink_status:
+                        shard_status = jsonapi.loads(payload[0])
+                        sink_shard_status[shard_status['shard']] = shard_status
+                    elif command == ServerCmd.pool_status:
+                        shard, report = payload
+                        for name, pool_report in jsonapi.loads(report).items():
+                            if name not in self.pools:
+                                continue
+                            # predict time per item measured on the workers of each pool, weights the routing
+                            if pool_report.get('predict_ms') is not None:
+                                self.pools[name].predict_ms = pool_report['predict_ms']
+                            if self.autoscaler is not None:
+                                self.autoscaler.observe_pool(name, int(shard), pool_report)
+                            if self.idle_scaler is not None:
+                                self.idle_scaler.observe_pool(name, int(shard), pool_report)
+                    elif command == ServerCmd.expand_worker:
+                        if self.idle_scaler is None or self.idle_scaler.serving(self.default_pool.name):
+                            self.expand_worker(addr_sink)
                     elif command == ServerCmd.squeeze_worker:
-                        self.squeeze_worker()
+                        for pool, job in self.squeeze_worker():
+                            recover_jobs(pool, [job], 'an expanded worker was closed while processing this job')
                 except Exception as e:
                     self.logger.error(e)
                 
         # exited, close all child process
-        for p in [*self.processes, *self.process_workers]:
+        for p in [*self.processes, *self.process_workers, *self.process_expanded_workers, *self.process_standby_workers]:
             p.close()
+        for pool in self.pools.values():
+            if pool.template is not None:
+                pool.template.close()
 
         self.logger.info('terminated!')
         self.server_all_terminated = True
@@ -355,6 +887,22 @@ class WKRServer(threading.Thread):
 
         return device_map
 
+    def _get_expand_device(self, pool):
+        # CPU pools expand within the core budget, GPU pools on a GPU of "-device_to_expand" with enough free memory
+        if pool.args.cpu or all(device_id < 0 for device_id in pool.device_map):
+            if self.cpu_cores_used() + self.cores_per_worker > self.cpu_core_budget:
+                self.logger.warning(f"trying to expand worker but the CPU workers already use {self.cpu_cores_used()} of {self.cpu_core_budget} cores")
+                return None
+            return -1
+        try:
+            target_expand_device = self._get_expandable_device(self.device_to_expand, pool.args.gpu_memory_fraction)
+        except (ImportError, FileNotFoundError):
+            self.logger.warning("trying to expand worker but GPUtil or nvidia-smi is missing")
+            return None
+        if target_expand_device is None:
+            self.logger.warning(f"trying to expand worker but no more GPU device is available, looked at devices: {self.device_to_expand} with at least {pool.args.gpu_memory_fraction*100:0.1f}% memory available")
+        return target_expand_device
+
     def _get_expandable_device(self, target_gpus, per_process_gpu_fragment):
         import GPUtil
         all_physic_gpu = [a.id for a in GPUtil.getGPUs()]
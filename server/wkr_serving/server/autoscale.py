@@ -0,0 +1,294 @@
+import json
+import time
+from collections import deque
+
+import numpy as np
+
+__all__ = ['AUTOSCALE_POLICIES', 'SLOAutoscaler', 'IdleScaler']
+
+# "util": the sink expands/squeezes from its utilisation estimate, "slo": SLOAutoscaler in the navigator
+AUTOSCALE_POLICIES = ['util', 'slo']
+
+
+class PoolSignals:
+    """What the autoscaler measured on one pool since its last decision"""
+
+    def __init__(self, trend_samples=6):
+        self.latencies = []
+        self.waits = []
+        # jobs registered and not yet sent back, by sink shard
+        self.inflight = {}
+        # (time, queue depth) of the last decisions, the trend of the queue
+        self.depths = deque(maxlen=trend_samples)
+        self.above_since = None
+        self.below_since = None
+        self.num_expand = 0
+        self.num_squeeze = 0
+        self.last_event = None
+
+
+class SLOAutoscaler:
+    """Adds or removes one worker of a pool at a time to hold its service level objectives
+
+    Every `interval_ms` each pool gets a pressure, the highest ratio of a signal to its target: the
+    latency percentile measured by the sink, the queue wait percentile measured by the navigator and
+    the queued plus in-flight jobs per worker. The queue depth is projected over the startup time of a
+    worker from its recent trend, so a worker is started while the queue is still building up. A pool
+    above its targets (pressure > 1) for `expand_ms` gets one more worker, a pool that would still be
+    under `scale_down_ratio` with one worker less for `squeeze_ms` loses one. Every decision and its
+    inputs are appended to `log_path` as a line of JSON, to replay them when tuning the policy.
+    """
+
+    def __init__(self, pools, interval_ms=5000, expand_ms=300000, squeeze_ms=600000, latency_ms=0, percentile=95,
+                 queue_wait_ms=0, queue_per_worker=0, scale_down_ratio=0.5, log_path=None):
+        self.pools = pools
+        self.interval_ms = interval_ms
+        self.expand_ms = expand_ms
+        self.squeeze_ms = squeeze_ms
+        self.latency_ms = latency_ms
+        self.percentile = percentile
+        self.queue_wait_ms = queue_wait_ms
+        # 0: one batch of the pool per worker
+        self.queue_per_worker = queue_per_worker
+        self.scale_down_ratio = scale_down_ratio
+        self.log_path = log_path
+        self.signals = {name: PoolSignals() for name in pools}
+        self.last_evaluation = time.time()
+
+    def observe_wait(self, pool, wait_ms):
+        self.signals[pool].waits.append(wait_ms)
+
+    def observe_pool(self, pool, shard, report):
+        """Latency samples and in-flight jobs of a pool, reported by a sink shard"""
+        signals = self.signals[pool]
+        signals.latencies.extend(report.get('latency', []))
+        signals.inflight[shard] = report.get('inflight', 0)
+
+    def due(self):
+        return (time.time() - self.last_evaluation)*1000 >= self.interval_ms
+
+    def evaluate(self, pool_workers):
+        """One decision per pool, `pool_workers` gives the num_worker, min_worker, max_worker and
+        startup_ms of each pool. The caller carries the decisions out and hands them to `log`
+        """
+        now = time.time()
+        self.last_evaluation = now
+        events = []
+        for name, workers in pool_workers.items():
+            signals = self.signals[name]
+            events.append(self.decide(name, signals, workers, now))
+            signals.latencies, signals.waits = [], []
+        return events
+
+    def decide(self, name, signals, workers, now):
+        pool = self.pools[name]
+        num_worker = workers['num_worker']
+        depth = len(pool.pending_jobs) + sum(signals.inflight.values())
+        signals.depths.append((now, depth))
+        trend = self.trend(signals.depths)
+        horizon = max(workers['startup_ms'], self.interval_ms)/1000
+        predicted_depth = max(depth, depth + trend*horizon)
+
+        target_depth = self.queue_per_worker or pool.batch_size
+        ratios = {'queue_depth': predicted_depth/max(1, num_worker)/target_depth}
+        latency = self.get_percentile(signals.latencies)
+        wait = self.get_percentile(signals.waits)
+        if self.latency_ms > 0 and signals.latencies:
+            ratios['latency'] = latency/self.latency_ms
+        if self.queue_wait_ms > 0 and signals.waits:
+            ratios['queue_wait'] = wait/self.queue_wait_ms
+        pressure = max(ratios.values())
+        # the jobs of the removed worker go to the others
+        pressure_after_squeeze = pressure*num_worker/(num_worker-1) if num_worker > 1 else float('inf')
+
+        action, reason = 'hold', None
+        if pressure > 1:
+            signals.below_since = None
+            signals.above_since = signals.above_since or now
+            reason = max(ratios, key=ratios.get)
+            if num_worker >= workers['max_worker']:
+                reason = 'at max_worker, ' + reason
+            elif (now - signals.above_since)*1000 >= self.expand_ms:
+                action = 'expand'
+        elif num_worker > workers['min_worker'] and pressure_after_squeeze < self.scale_down_ratio:
+            signals.above_since = None
+            signals.below_since = signals.below_since or now
+            reason = 'pressure after squeeze %.2f' % pressure_after_squeeze
+            if (now - signals.below_since)*1000 >= self.squeeze_ms:
+                action = 'squeeze'
+        else:
+            signals.above_since = signals.below_since = None
+        if action != 'hold':
+            # the next step needs a new sustained period, one worker at a time
+            signals.above_since = signals.below_since = None
+
+        return {
+            'time': now,
+            'pool': name,
+            'action': action,
+            'reason': reason,
+            'num_worker': num_worker,
+            'min_worker': workers['min_worker'],
+            'max_worker': workers['max_worker'],
+            'startup_ms': workers['startup_ms'],
+            'queue_depth': depth,
+            'queue_depth_trend': trend,
+            'queue_depth_predicted': predicted_depth,
+            'target_queue_per_worker': target_depth,
+            'latency_p%d' % self.percentile: latency,
+            'target_latency_ms': self.latency_ms,
+            'num_latency_sample': len(signals.latencies),
+            'queue_wait_p%d' % self.percentile: wait,
+            'target_queue_wait_ms': self.queue_wait_ms,
+            'num_wait_sample': len(signals.waits),
+            'ratios': ratios,
+            'pressure': pressure,
+            'pressure_after_squeeze': pressure_after_squeeze if num_worker > 1 else None,
+        }
+
+    def log(self, event):
+        """Record a decision once carried out, `done` tells whether it could be"""
+        signals = self.signals[event['pool']]
+        if event.get('done'):
+            if event['action'] == 'expand':
+                signals.num_expand += 1
+            elif event['action'] == 'squeeze':
+                signals.num_squeeze += 1
+        signals.last_event = event
+        if self.log_path:
+            with open(self.log_path, 'a') as f:
+                f.write(json.dumps(event) + '\n')
+
+    def get_percentile(self, values):
+        return float(np.percentile(values, self.percentile)) if values else 0
+
+    @staticmethod
+    def trend(depths):
+        """Queue depth change per second, least squares over the last decisions"""
+        if len(depths) < 2:
+            return 0
+        t, depth = np.array(depths, dtype=float).T
+        if np.ptp(t) == 0:
+            return 0
+        return float(np.polyfit(t - t[0], depth, 1)[0])
+
+    @property
+    def status(self):
+        return {name: {
+            'num_expand': signals.num_expand,
+            'num_squeeze': signals.num_squeeze,
+            'last_event': signals.last_event,
+        } for name, signals in self.signals.items()}
+
+
+class PoolIdleState:
+    """Idle clock and cold start record of one pool"""
+
+    def __init__(self, now):
+        # 'serving', 'zero': all workers closed, 'starting': the first worker after zero is loading
+        self.state = 'serving'
+        self.last_active = now
+        # jobs registered and not yet sent back, by sink shard
+        self.inflight = {}
+        self.zero_since = None
+        self.starting_since = None
+        self.num_scale_to_zero = 0
+        self.num_cold_start = 0
+        self.num_failed_cold_start = 0
+        self.cold_start_ms = deque(maxlen=100)
+        self.idle_at_zero_s = 0
+
+
+class IdleScaler:
+    """Closes every worker of a pool that got no request for `idle_ms`, the first request after that starts them again
+
+    The navigator, the sinks and the HTTP proxy stay up, so the endpoint is kept while the memory of
+    the models is given back. Requests that come while a pool is at zero or starting wait in its
+    queue until one of its workers is ready. The time from the first of those requests to the first
+    ready worker is the cold start latency, reported with the time each pool spent at zero.
+    """
+
+    def __init__(self, pools, idle_ms):
+        self.idle_ms = idle_ms
+        now = time.time()
+        self.pools = {name: PoolIdleState(now) for name in pools}
+
+    def touch(self, pool):
+        self.pools[pool].last_active = time.time()
+
+    def observe_pool(self, pool, shard, report):
+        """In-flight jobs of a pool, reported by a sink shard, a pool is not idle while it has some"""
+        state = self.pools[pool]
+        state.inflight[shard] = report.get('inflight', 0)
+        if state.inflight[shard] > 0:
+            state.last_active = time.time()
+
+    def serving(self, pool):
+        return self.pools[pool].state == 'serving'
+
+    def at_zero(self, pool):
+        return self.pools[pool].state == 'zero'
+
+    def idle_pools(self, num_pending):
+        """Serving pools without queued or in-flight jobs for `idle_ms`, `num_pending` gives the queued jobs of each pool"""
+        now = time.time()
+        return [name for name, state in self.pools.items()
+                if state.state == 'serving' and not num_pending[name] and not any(state.inflight.values())
+                and (now - state.last_active)*1000 >= self.idle_ms]
+
+    def scaled_to_zero(self, pool):
+        state = self.pools[pool]
+        state.state = 'zero'
+        state.zero_since = time.time()
+        state.inflight = {}
+        state.num_scale_to_zero += 1
+
+    def starting_pools(self):
+        return [name for name, state in self.pools.items() if state.state == 'starting']
+
+    def wake(self, pool):
+        """The first request after zero came, returns how long the pool was at zero (in seconds)"""
+        state = self.pools[pool]
+        now = time.time()
+        idle_s = now - state.zero_since
+        state.idle_at_zero_s += idle_s
+        state.state = 'starting'
+        state.starting_since = now
+        state.zero_since = None
+        return idle_s
+
+    def started(self, pool):
+        """A worker of the pool is ready, returns the cold start latency (in milliseconds)"""
+        state = self.pools[pool]
+        cold_start_ms = (time.time() - state.starting_since)*1000
+        state.state = 'serving'
+        state.starting_since = None
+        state.last_active = time.time()
+        state.num_cold_start += 1
+        state.cold_start_ms.append(cold_start_ms)
+        return cold_start_ms
+
+    def failed_start(self, pool):
+        """The workers of the pool could not be started, it is back at zero and the next request tries again"""
+        state = self.pools[pool]
+        state.state = 'zero'
+        state.zero_since = time.time()
+        state.starting_since = None
+        state.num_failed_cold_start += 1
+
+    @property
+    def status(self):
+        now = time.time()
+        return {name: {
+            'state': state.state,
+            'idle_ms': self.idle_ms,
+            'idle_for_ms': (now - state.last_active)*1000 if state.state == 'serving' else None,
+            'num_scale_to_zero': state.num_scale_to_zero,
+            'num_cold_start': state.num_cold_start,
+            'num_failed_cold_start': state.num_failed_cold_start,
+            'last_cold_start_ms': state.cold_start_ms[-1] if state.cold_start_ms else None,
+            'avg_cold_start_ms': float(np.mean(state.cold_start_ms)) if state.cold_start_ms else None,
+            'max_cold_start_ms': max(state.cold_start_ms) if state.cold_start_ms else None,
+            # the current stay at zero included
+            'idle_at_zero_s': state.idle_at_zero_s + (now - state.zero_since if state.zero_since else 0),
+        } for name, state in self.pools.items()}
@@ -0,0 +1,114 @@
+import bisect
+from collections import OrderedDict
+
+import numpy as np
+
+__all__ = ['BUCKET_STRATEGIES', 'BatchBufferPool', 'bucket_key', 'pad_batch', 'unpad']
+
+BUCKET_STRATEGIES = ['none', 'shape', 'length']
+
+
+def bucket_key(strategy, array, boundaries=()):
+    """Key of the bucket an input array goes into
+
+    shape: only arrays of exactly the same shape are batched together, no padding
+    length: arrays whose first axis falls in the same `boundaries` range are batched together and padded
+    """
+    if strategy == 'shape':
+        return array.dtype.str, array.shape
+    elif strategy == 'length':
+        length = array.shape[0] if array.ndim > 0 else 0
+        return array.dtype.str, array.ndim, bisect.bisect_left(boundaries, length)
+    return None
+
+
+class BatchBufferPool:
+    """Reusable batch arrays per (dtype, item shape)
+
+    Items are copied into their slot of a preallocated array instead of being stacked into a new one.
+    `num_slots` arrays are kept per key and handed out in turn, so it must cover every batch that can
+    still be in use when a new one is assembled. Only the `max_keys` most recently used keys are kept.
+    """
+
+    def __init__(self, batch_size, num_slots=1, max_keys=16):
+        self.batch_size = batch_size
+        self.num_slots = num_slots
+        self.max_keys = max_keys
+        self._buffers = OrderedDict()
+        self.num_alloc = 0
+
+    def take(self, dtype, shape, n):
+        """Batch array of `n` items, content is left as it was"""
+        dtype, shape = np.dtype(dtype), tuple(shape)
+        key = (dtype.str, shape)
+        if key not in self._buffers:
+            self._buffers[key] = [[None]*self.num_slots, 0]
+            if len(self._buffers) > self.max_keys:
+                self._buffers.popitem(last=False)
+        self._buffers.move_to_end(key)
+        slots, i = self._buffers[key]
+        self._buffers[key][1] = (i+1) % self.num_slots
+        if slots[i] is None or slots[i].shape[0] < n:
+            slots[i] = np.empty((max(n, self.batch_size),) + shape, dtype=dtype)
+            self.num_alloc += 1
+        return slots[i][:n]
+
+    def stack(self, arrays):
+        batch = self.take(arrays[0].dtype, arrays[0].shape, len(arrays))
+        for slot, a in zip(batch, arrays):
+            slot[...] = a
+        return batch
+
+    def owns(self, array):
+        # a snapshot, batches may be assembled on another thread meanwhile
+        return isinstance(array, np.ndarray) and any(
+            a is not None and np.may_share_memory(array, a) for slots, _ in list(self._buffers.values()) for a in list(slots))
+
+    def detach(self, outputs):
+        """`outputs` (an array or a list of arrays), copied where they are a view on one of the buffers"""
+        if isinstance(outputs, np.ndarray):
+            return outputs.copy() if self.owns(outputs) else outputs
+        return [o.copy() if self.owns(o) else o for o in outputs]
+
+    @property
+    def nbytes(self):
+        return sum(a.nbytes for slots, _ in self._buffers.values() for a in slots if a is not None)
+
+
+def pad_batch(arrays, pad_value=0, pool=None):
+    """Stack arrays of different shapes by padding every axis to the bucket maximum
+
+    returns (batch, mask, padding_waste), mask is True on real elements, padding_waste is the
+    fraction of the batch filled with padding
+    """
+    max_shape = tuple(np.max([a.shape for a in arrays], axis=0)) if arrays[0].ndim > 0 else ()
+    if pool is not None:
+        batch = pool.take(arrays[0].dtype, max_shape, len(arrays))
+        batch[...] = pad_value
+        mask = pool.take(bool, max_shape, len(arrays))
+        mask[...] = False
+    else:
+        batch = np.full((len(arrays),) + max_shape, pad_value, dtype=arrays[0].dtype)
+        mask = np.zeros((len(arrays),) + max_shape, dtype=bool)
+    for i, a in enumerate(arrays):
+        index = (i,) + tuple(slice(0, s) for s in a.shape)
+        batch[index] = a
+        mask[index] = True
+    padding_waste = 1 - mask.sum()/mask.size if mask.size else 0
+    return batch, mask, float(padding_waste)
+
+
+def unpad(output, shape, padded_shape):
+    """Cut padding off one item of the model output
+
+    every leading axis of `output` that kept the padded size is cut back to the original input size,
+    axes the model reduced or reshaped are left as they are
+    """
+    if not isinstance(output, np.ndarray):
+        return output
+    index = []
+    for axis, (size, padded) in enumerate(zip(shape, padded_shape)):
+        if axis >= output.ndim or output.shape[axis] != padded:
+            break
+        index.append(slice(0, size))
+    return output[tuple(index)] if index else output
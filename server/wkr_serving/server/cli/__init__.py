@@ -2,15 +2,23 @@ def main():
     from wkr_serving.server import WKRServer, WKRHardWorker
     from wkr_serving.server.helper import get_run_args, get_cli_start_parser, import_class_from_local
     args = get_run_args(get_cli_start_parser)
-    try:
-        skeleton_class = import_class_from_local(args.worker_class)
-    except Exception as e:
-        raise Exception("{}\nCAN'T IMPORT worker_class: {}".format(e, args.worker_class))
-    else:
+    hardprocesser = {}
+    for worker_class in args.worker_class:
+        # <model>=<filename>.<worker_class_name> when the server hosts several models
+        model, _, worker_class = worker_class.rpartition('=')
+        if not model and len(args.worker_class) > 1:
+            raise Exception('several worker classes given, name each one as <model>=<filename>.<worker_class_name>, your input: {}'.format(worker_class))
+        try:
+            skeleton_class = import_class_from_local(worker_class)
+        except Exception as e:
+            raise Exception("{}\nCAN'T IMPORT worker_class: {}".format(e, worker_class))
         if not issubclass(skeleton_class, WKRHardWorker):
-            raise AssertionError('{} must inherit from class "wkr_serving.server.WKRHardWorker"'.format(worker_class.__name__))
-        with WKRServer(args, hardprocesser=skeleton_class) as server:
-            server.join()
+            raise AssertionError('{} must inherit from class "wkr_serving.server.WKRHardWorker"'.format(skeleton_class.__name__))
+        hardprocesser[model] = skeleton_class
+    if list(hardprocesser) == ['']:
+        hardprocesser = hardprocesser['']
+    with WKRServer(args, hardprocesser=hardprocesser) as server:
+        server.join()
 
 def terminate():
     from wkr_serving.server import WKRServer
@@ -19,6 +27,7 @@ def terminate():
     WKRServer.shutdown(args)
 
 def main_make():
+    import json
     import os
     from wkr_serving.server.helper import get_run_args, get_cli_start_parser, import_class_from_local
 
@@ -39,10 +48,12 @@ def main_make():
             continue
         if k == 'device_map':
             v = ' '.join([str(d) for d in v])
+        if k == 'pool_args':
+            v = "'{}'".format(json.dumps(v))
         opts.append(f"-{k} {v} \\\n")
     opts = ''.join(opts)
     opts = opts[:-3]
-    opts = f'wkr-serving-start \\\n{opts} \\\n{args.worker_class}'
+    opts = f'wkr-serving-start \\\n{opts} \\\n{" ".join(args.worker_class)}'
 
     service_name = args.name
     log_file = 'logs/std.log'
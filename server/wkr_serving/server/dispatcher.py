@@ -0,0 +1,164 @@
+import random
+import time
+
+import zmq
+
+from .helper import auto_bind
+from .protocol import *
+
+__all__ = ['RandomDispatcher', 'CreditDispatcher', 'get_dispatcher']
+
+
+class RandomDispatcher:
+    """Legacy dispatch: every worker connects to all PUSH sockets, the navigator picks one at random."""
+    mode = 'random'
+
+    def __init__(self, ctx, num_socket):
+        self.socks = [ctx.socket(zmq.PUSH) for _ in range(num_socket)]
+        self.addresses = [auto_bind(s) for s in self.socks]
+        self.last_sock = None
+
+    def register(self, poller):
+        pass
+
+    def handle(self, events):
+        return []
+
+    def has_capacity(self):
+        return True
+
+    def dispatch(self, client, req_id, msg, msg_info, cost=1, job=None):
+        self.last_sock = random.choice([s for s in self.socks if s != self.last_sock] or self.socks)
+        send_to_next_raw(client, req_id, msg, msg_info, self.last_sock)
+        return True
+
+    def remove_worker(self, worker_id):
+        # which worker pulled a job is unknown here
+        return []
+
+    def park_worker(self, worker_id):
+        # the jobs queued for a worker can not be held back, squeezing closes it instead
+        pass
+
+    def unpark_worker(self, worker_id):
+        pass
+
+    @property
+    def status(self):
+        return {'mode': self.mode, 'num_socket': len(self.socks)}
+
+    def close(self):
+        for s in self.socks:
+            s.close(linger=0)
+
+
+class CreditDispatcher:
+    """Load-aware dispatch: workers connect a DEALER to one ROUTER and advertise free batch slots as credits.
+
+    Each job goes to the worker with the most free credits (ties broken by the lowest outstanding depth),
+    so a busy worker never gets more than its credit window queued. Workers name the jobs they are done
+    with when they return credits, so the jobs still held by a worker are known if it dies.
+    """
+    mode = 'credit'
+
+    def __init__(self, ctx):
+        self.sock = ctx.socket(zmq.ROUTER)
+        self.sock.setsockopt(zmq.ROUTER_MANDATORY, 1)
+        self.sock.setsockopt(zmq.ROUTER_HANDOVER, 1)
+        self.addresses = [auto_bind(self.sock)]
+        self.credits = {}
+        self.outstanding = {}
+        self.last_seen = {}
+        self.assigned = {}
+        # credits of the workers on standby, given back when they are activated
+        self.parked = {}
+
+    def register(self, poller):
+        poller.register(self.sock, zmq.POLLIN)
+
+    def handle(self, events):
+        """Consume pending credit messages, returns the list of worker ids that reported."""
+        reported = []
+        if events.get(self.sock) != zmq.POLLIN:
+            return reported
+        while True:
+            try:
+                worker, cmd, value, *job_ids = self.sock.recv_multipart(zmq.NOBLOCK)
+            except zmq.error.Again:
+                break
+            if cmd == ServerCmd.credit:
+                num = int(value)
+                if worker in self.parked:
+                    self.parked[worker] += num
+                else:
+                    self.credits[worker] = self.credits.get(worker, 0) + num
+                self.outstanding[worker] = max(0, self.outstanding.get(worker, 0) - num)
+                self.last_seen[worker] = time.time()
+                assigned = self.assigned.get(worker, {})
+                for job_id in job_ids:
+                    assigned.pop(job_id, None)
+                reported.append(worker)
+        return reported
+
+    def has_capacity(self):
+        return any(c > 0 for c in self.credits.values())
+
+    def dispatch(self, client, req_id, msg, msg_info, cost=1, job=None):
+        """`cost` is the number of batch slots the job takes, a worker may go into debt for one large job.
+        `job` is kept until the worker returns the credit of this job, `remove_worker` hands it back.
+        """
+        while self.has_capacity():
+            worker = max((w for w, c in self.credits.items() if c > 0),
+                         key=lambda w: (self.credits[w], -self.outstanding.get(w, 0)))
+            try:
+                self.sock.send_multipart([worker, to_bytes(client), to_bytes(req_id), msg, msg_info])
+            except zmq.error.ZMQError:
+                # worker has gone away, stop sending to it and try the next one, the jobs it
+                # already holds are handed back once the worker is removed
+                self.credits.pop(worker, None)
+                continue
+            self.credits[worker] -= cost
+            self.outstanding[worker] = self.outstanding.get(worker, 0) + cost
+            self.assigned.setdefault(worker, {})[to_bytes(client) + b'#' + to_bytes(req_id)] = job
+            return True
+        return False
+
+    def remove_worker(self, worker_id):
+        """Forget a worker, returns the `job` of every job it had not finished"""
+        worker = worker_id if isinstance(worker_id, bytes) else to_bytes(str(worker_id))
+        self.credits.pop(worker, None)
+        self.parked.pop(worker, None)
+        self.outstanding.pop(worker, None)
+        self.last_seen.pop(worker, None)
+        return list(self.assigned.pop(worker, {}).values())
+
+    def park_worker(self, worker_id):
+        """Stop sending jobs to a worker, it finishes the ones it holds and its credits are kept aside"""
+        worker = worker_id if isinstance(worker_id, bytes) else to_bytes(str(worker_id))
+        self.parked[worker] = self.parked.get(worker, 0) + self.credits.pop(worker, 0)
+
+    def unpark_worker(self, worker_id):
+        worker = worker_id if isinstance(worker_id, bytes) else to_bytes(str(worker_id))
+        if worker in self.parked:
+            self.credits[worker] = self.credits.get(worker, 0) + self.parked.pop(worker)
+
+    @property
+    def status(self):
+        return {
+            'mode': self.mode,
+            'workers': {to_str(w): {
+                'free_credit': self.credits.get(w, 0),
+                'outstanding': self.outstanding.get(w, 0),
+                'assigned': len(self.assigned.get(w, {})),
+                'parked': w in self.parked,
+            } for w in sorted(set(self.credits) | set(self.parked))}
+        }
+
+    def close(self):
+        self.sock.close(linger=0)
+
+
+def get_dispatcher(mode, ctx, num_socket):
+    if mode == 'credit':
+        return CreditDispatcher(ctx)
+    return RandomDispatcher(ctx, num_socket)
@@ -1,4 +1,5 @@
 import argparse
+import json
 import logging
 from logging.handlers import RotatingFileHandler
 import os
@@ -13,7 +14,7 @@ from termcolor import colored
 
 __all__ = ['set_logger', 'get_args_parser', 'LoggerSeperate',
            'check_tf_version', 'auto_bind', 'import_tf', 'import_torch', 'import_mxnet',
-           'get_cli_start_parser', 'import_class_from_local']
+           'get_cli_start_parser', 'import_class_from_local', 'get_process_memory']
 
 def set_logger(context, logger_dir=None, logger_name=None, verbose=False, error_log=False, max_bytes=500*1024*1024, backup_count=10):
     if os.name == 'nt':  # for Windows
@@ -149,7 +150,70 @@ def get_args_parser():
     groupwa.add_argument('-batch_size', type=int, default=10,
                         help='maximum number of sequences handled by each worker')
     groupwa.add_argument('-batch_group_timeout', type=int, default=5,
-                        help='maximum time(ms) for wait for a new request, we all need waveglow to fix input shape, so need to wait a much longer')
+                        help='batch window: maximum time(ms) a worker waits for a batch to fill, counted from the first request of the batch')
+    groupwa.add_argument('-batch_policy', type=str, choices=['latency', 'throughput'], default='throughput',
+                        help='"latency" dispatches a batch as soon as no more requests are queued, \
+                        "throughput" waits up to the batch window for the batch to fill')
+    groupwa.add_argument('-batch_adaptive', action='store_true', default=False,
+                        help='tune the batch window and target batch size from the observed arrival rate and predict latency')
+    groupwa.add_argument('-batch_bucket', type=str, choices=['none', 'shape', 'length'], default='none',
+                        help='how numpy inputs of different shapes are batched. none: stack, every input must have the same shape; '
+                             'shape: one batch per distinct input shape; '
+                             'length: one batch per length range of "-bucket_boundaries", padded to the bucket maximum, '
+                             'the mask goes to "predict_masked" and outputs are un-padded before being sent back')
+    groupwa.add_argument('-bucket_boundaries', type=int, nargs='*', default=[],
+                        help='upper bounds (inclusive) of the first axis length for each bucket when "-batch_bucket length" is used, '
+                             'longer inputs go to a last bucket')
+    groupwa.add_argument('-batch_bisect', action='store_true', default=False,
+                        help='when predict fails on a batch, run it again in halves down to single inputs, '
+                             'so only the inputs that make predict fail get the exception')
+    groupwa.add_argument('-no_batch_buffer', action='store_true', default=False,
+                        help='allocate a new array for every numpy batch instead of copying inputs into reusable batch buffers, '
+                             'use it when predict keeps references to its input after returning')
+    groupwa.add_argument('-dispatch', type=str, choices=['random', 'credit'], default='random',
+                        help='how the navigator picks a worker: "random" pushes to a random worker socket, \
+                        "credit" routes each job to the least-loaded worker based on the free batch slots it advertises')
+    groupwa.add_argument('-credit_batches', type=int, default=2,
+                        help='number of batches a worker may hold (queued + in progress) when "-dispatch credit" is used')
+    groupwa.add_argument('-schedule_policy', type=str, choices=['fifo', 'priority', 'sjf', 'edf'], default='fifo',
+                        help='order in which the navigator hands queued jobs to workers: "fifo" arrival order, \
+                        "priority" strict priority classes set by the client, "sjf" smallest input first, \
+                        "edf" earliest client deadline first. Jobs only queue in the navigator with "-dispatch credit"')
+    groupwa.add_argument('-heartbeat_timeout', type=int, default=0,
+                        help='restart a worker whose predict loop made no progress for this long (in ms), a hung predict stops '
+                             'the heartbeat, so keep it above the slowest batch. A worker that exited is restarted '
+                             'at once. 0 (default) only restarts workers that exited')
+    groupwa.add_argument('-worker_failure', type=str, choices=['requeue', 'fail'], default='requeue',
+                        help='what happens to the jobs held by a dead worker: "requeue" hands them to another worker, '
+                             '"fail" answers them with an error. Jobs can only be traced to a worker with "-dispatch credit"')
+    groupwa.add_argument('-max_job_retries', type=int, default=1,
+                        help='with "-worker_failure requeue", number of times a job is re-queued before it fails')
+    groupwa.add_argument('-preload', action='store_true', default=False,
+                        help='load the model once in a template process and fork the main workers from it, '
+                             'so they share the weights copy-on-write. Meant for CPU workers, expanded workers still load their own model')
+    groupwa.add_argument('-preload_gc_freeze', action='store_true', default=False,
+                        help='with "-preload", freeze the objects of the template with gc.freeze() before forking, '
+                             'so garbage collection in the workers does not copy the pages holding the model')
+    groupwa.add_argument('-warmup_batch_sizes', type=int, nargs='*', default=None,
+                        help='batch sizes run on the inputs of "get_warmup_inputs" before a worker takes requests, '
+                             'default is 1 and "-batch_size"')
+    groupwa.add_argument('-worker_pipeline', action='store_true', default=False,
+                        help='overlap receive/preprocess of the next batch and postprocess/send of the previous batch with predict, using background threads')
+    groupwa.add_argument('-pipeline_depth', type=int, default=2,
+                        help='maximum number of batches waiting between two pipeline stages when "-worker_pipeline" is used')
+    groupwa.add_argument('-worker_threads', type=int, default=1,
+                        help='number of inference threads per worker process sharing one loaded model, fed from the '
+                             'batch queue of the process, for models that release the GIL (ONNX, NumPy)')
+    groupwa.add_argument('-async_concurrency', type=int, default=4,
+                        help='maximum number of batches a worker keeps in flight when its predict is an "async def", '
+                             'for workers waiting on downstream services or disk rather than computing')
+    groupwa.add_argument('-pool_args', type=json.loads, default=None,
+                        help='JSON object of model name -> arguments of that model pool when the server hosts several models, '
+                             'e.g. \'{"ner": {"num_worker": 2, "batch_size": 32, "device_map": [0]}}\', '
+                             'models without an entry use the arguments of the server. Several pools serve the same model when they set '
+                             '"model", e.g. \'{"big": {"model": "ner", "batch_size": 64, "min_input_byte": 65536}, "small": {"model": "ner", "cpu": true}}\', '
+                             'requests go to the pools whose "min_input_byte"/"max_input_byte" range holds their size, weighted by '
+                             'the predict time measured on each pool')
     groupwa.add_argument('-cpu', action='store_true', default=False,
                         help='running on CPU (default on GPU)')
     groupwa.add_argument('-device_map', type=int, nargs='+', default=[-1],
@@ -160,20 +224,77 @@ def get_args_parser():
     groupscale = parser.add_argument_group('Scaling Configs',
                                        'config how server auto scaling')
     groupscale.add_argument('-num_worker_expanded', type=int, default=0,
-                        help='maximum number of worker will expand')
+                        help='maximum number of worker will expand, for each pool with "-autoscale slo"')
+    groupscale.add_argument('-num_standby', type=int, default=0,
+                        help='number of standby workers kept per pool: they load and warm the model up but take no job. '
+                             'Expanding activates one of them and starts a new standby in the background, '
+                             'with "-dispatch credit" squeezing sends workers back to standby instead of closing them: they keep '
+                             'running with their model but are no longer sent jobs')
+    groupscale.add_argument('-scale_to_zero_after', type=int, default=0,
+                        help='close all the workers of a pool that got no request for this long (in ms), the navigator, sinks and '
+                             'HTTP proxy stay up. The next request starts the workers again and waits until one of them is ready. '
+                             '0 never scales to zero')
     groupscale.add_argument('-device_to_expand', type=int, nargs='+', default=[0],
                         help='specify the list of GPU device ids that will be used (id starts from 0) to auto scaling the service')
     groupscale.add_argument('-busy_util_threshold', type=float, default=0.95,
                         help='Service utils threshold to be considered as overflowed')
     groupscale.add_argument('-duration_expand', type=int, default=300000,
-                        help='Max time (milliseconds) to wait until service start to expand, default 300000ms (5min)')
+                        help='Max time (milliseconds) to wait until service start to expand, default 300000ms (5min). '
+                             'With "-autoscale slo", how long a pool stays over its targets before it gets one more worker')
     groupscale.add_argument('-duration_squeeze', type=int, default=600000,
-                        help='Max time (milliseconds) to wait until service start to squeeze (remove all expanded workers), default 600000ms (10min)')
+                        help='Max time (milliseconds) to wait until service start to squeeze (remove all expanded workers), default 600000ms (10min). '
+                             'With "-autoscale slo", how long a pool stays under "-scale_down_ratio" before it loses one worker')
+
+    groupscale.add_argument('-autoscale', type=str, choices=['util', 'slo'], default='util',
+                        help='"util": the sink expands when its utilisation estimate stays over "-busy_util_threshold" and squeezes '
+                             'all expanded workers at once. "slo": the navigator adds or removes one worker of a pool at a time to hold '
+                             '"-slo_latency_ms", "-slo_queue_wait_ms" and "-slo_queue_per_worker", on GPU or CPU within "-cpu_core_budget"')
+    groupscale.add_argument('-autoscale_interval', type=int, default=5000,
+                        help='time (milliseconds) between two decisions of the "slo" autoscaler')
+    groupscale.add_argument('-autoscale_log', type=str, default=None,
+                        help='file the "slo" autoscaler appends every decision and its inputs to, one JSON object per line')
+    groupscale.add_argument('-slo_latency_ms', type=float, default=0,
+                        help='target latency percentile (milliseconds) of a pool, 0 to ignore latency')
+    groupscale.add_argument('-slo_percentile', type=float, default=95,
+                        help='percentile of latency and queue wait compared to their target')
+    groupscale.add_argument('-slo_queue_wait_ms', type=float, default=0,
+                        help='target queue wait percentile (milliseconds) in the navigator, 0 to ignore queue wait')
+    groupscale.add_argument('-slo_queue_per_worker', type=float, default=0,
+                        help='target number of queued and in-flight jobs per worker, projected over the worker startup time. '
+                             '0 is one batch of the pool')
+    groupscale.add_argument('-scale_down_ratio', type=float, default=0.5,
+                        help='a worker is removed when the pressure (highest signal to target ratio) with one worker less '
+                             'stays under this ratio for "-duration_squeeze"')
+    groupscale.add_argument('-cpu_core_budget', type=int, default=0,
+                        help='number of cores all CPU workers may use together, bounds the expansion of CPU pools. 0 is every core of the host')
+    groupscale.add_argument('-cores_per_worker', type=int, default=1,
+                        help='number of cores a CPU worker is counted for in "-cpu_core_budget"')
 
     group3 = parser.add_argument_group('Serving Configs',
                                        'config how server utilizes GPU/CPU resources')
     group3.add_argument('-protocol', type=check_protocol, default='obj',
                         help='server-client tranfer protocol')
+    group3.add_argument('-max_backlog', type=int, default=0,
+                        help='maximum number of in-flight jobs (queued + processing) the navigator accepts, \
+                        requests over this limit are rejected immediately with an "overloaded" reply. 0 means unlimited')
+    group3.add_argument('-job_ttl', type=int, default=600,
+                        help='seconds the sink keeps a registered job whose result never comes back (dropped, crashed worker) '
+                             'before evicting it and giving its admission slot back to the navigator')
+    group3.add_argument('-num_sink', type=int, default=1,
+                        help='number of sink processes, each one collects the results of the clients hashed to it')
+    group3.add_argument('-sink_publish', type=str, choices=['shared', 'per_shard'], default='shared',
+                        help='with several sinks, "shared": all results are published on "port_out" through a forwarder, '
+                             '"per_shard": sink i publishes on "port_out"+i, clients discover the ports from the server config')
+    group3.add_argument('-shm', action='store_true', default=False,
+                        help='workers pass results above "-shm_threshold" to the sink through shared memory, '
+                             'same-host clients created with "shm=True" also receive them that way and send their inputs '
+                             'through their own slab. Handles are only accepted from clients connected through localhost')
+    group3.add_argument('-shm_threshold', type=int, default=64*1024,
+                        help='minimum payload size (bytes) sent through shared memory when "-shm" is used')
+    group3.add_argument('-shm_slot_size', type=int, default=8*1024*1024,
+                        help='size (bytes) of one shared memory slot, larger payloads are sent inline')
+    group3.add_argument('-shm_num_slots', type=int, default=32,
+                        help='number of shared memory slots of each worker, payloads are sent inline while all are in use')
     group3.add_argument('-port', '-port_in', '-port_data', type=int, required=True,
                         help='server port for receiving data from client')
     group3.add_argument('-port_out', '-port_result', type=int, required=True,
@@ -318,7 +439,9 @@ def get_shutdown_parser():
 
 def get_cli_start_parser():
     parser = get_args_parser()
-    parser.add_argument('worker_class', metavar='worker_class', type=str, help='Target worker class')
+    parser.add_argument('worker_class', metavar='worker_class', type=str, nargs='+',
+                        help='Target worker class as <filename>.<worker_class_name>, give several as '
+                             '<model>=<filename>.<worker_class_name> to serve one pool of workers per model')
     return parser
 
 def import_class_from_local(model_name):
@@ -346,3 +469,23 @@ class TimeContext:
     def __exit__(self, typ, value, traceback):
         self.duration = time.perf_counter() - self.start
         print(colored('    [%3.3f secs]' % self.duration, 'green'), flush=True)
+
+
+def get_process_memory(pid):
+    """Resident memory (MB) of a process split into pages only it uses and pages shared with others, Linux only"""
+    try:
+        with open('/proc/%d/smaps_rollup' % pid) as f:
+            lines = f.readlines()
+    except (OSError, TypeError):
+        return {}
+    fields = {}
+    for line in lines:
+        parts = line.split()
+        if len(parts) >= 2 and parts[0].endswith(':') and parts[1].isdigit():
+            fields[parts[0][:-1]] = int(parts[1])/1024
+    return {
+        'rss_mb': fields.get('Rss', 0),
+        'pss_mb': fields.get('Pss', 0),
+        'unique_mb': fields.get('Private_Clean', 0) + fields.get('Private_Dirty', 0),
+        'shared_mb': fields.get('Shared_Clean', 0) + fields.get('Shared_Dirty', 0),
+    }
@@ -3,6 +3,7 @@ from typing import Optional
 from multiprocessing import Process, Event
 from termcolor import colored
 from .helper import set_logger
+from .sharding import sink_ports
 
 import time
 from PIL import Image
@@ -58,7 +59,7 @@ class BertHTTPProxy(Process):
             from fastapi import File, Form, UploadFile, Header, Depends, Request, status
             from fastapi.staticfiles import StaticFiles
             from fastapi.exceptions import RequestValidationError
-            from fastapi.responses import JSONResponse
+            from fastapi.responses import JSONResponse, StreamingResponse
             from fastapi.encoders import jsonable_encoder
             from pydantic import BaseModel
 
@@ -70,7 +71,7 @@ class BertHTTPProxy(Process):
 
         # support up to 10 concurrent HTTP requests
         bc = ConcurrentWKRClient(max_concurrency=self.args.http_max_connect,
-                                  port=self.args.port, port_out=self.args.port_out,
+                                  port=self.args.port, port_out=sink_ports(self.args),
                                   protocol='obj', ignore_all_checks=True)
 
         logger = set_logger(colored('PROXY', 'red'), logger_dir=args.log_dir, logger_name=args.log_name, verbose=args.verbose)
@@ -202,6 +203,27 @@ class BertHTTPProxy(Process):
                         "data": {}
                     }
 
+        @app.post('/encode_json_stream')
+        def encode_query_json_stream(
+            target_json: dict
+        ):
+            # server-sent events, one "data" event per chunk as the worker yields it, then an "end" event,
+            # or an "error" event if the stream fails
+            # curl -N -H "Content-Type: application/json" \
+            # -X POST \
+            # -d '{"data1":"data1"}' \
+            # http://localhost:3000/encode_json_stream
+            def events():
+                try:
+                    for chunk in bc.encode_stream(target_json):
+                        yield 'data: {}\n\n'.format(json.dumps(jsonable_encoder(chunk)))
+                    yield 'event: end\ndata: {}\n\n'
+                except Exception as e:
+                    logger.error('error when handling HTTP request', exc_info=True)
+                    yield 'event: error\ndata: {}\n\n'.format(json.dumps({"error_code": 1, "error_message": str(e)}))
+
+            return StreamingResponse(events(), media_type='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
         @app.middleware("http")
         async def add_process_time_header(request: Request, call_next):
             # print(vars(request))
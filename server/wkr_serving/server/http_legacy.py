@@ -3,6 +3,7 @@ import os
 from multiprocessing import Process, Event
 from termcolor import colored
 from .helper import set_logger
+from .sharding import sink_ports
 
 import time
 from PIL import Image
@@ -71,7 +72,7 @@ class BertHTTPProxy(Process):
 
         # support up to 10 concurrent HTTP requests
         bc = ConcurrentWKRClient(max_concurrency=self.args.http_max_connect,
-                                  port=self.args.port, port_out=self.args.port_out,
+                                  port=self.args.port, port_out=sink_ports(self.args),
                                   protocol='obj', ignore_all_checks=True)
 
         logger = set_logger(colored('PROXY', 'red'), logger_dir=args.log_dir, logger_name=args.log_name, verbose=args.verbose)
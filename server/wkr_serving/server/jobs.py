@@ -0,0 +1,91 @@
+import time
+from collections import OrderedDict
+
+__all__ = ['JobTable']
+
+
+class JobTable:
+    """Jobs the sink is waiting on, by (client, req_id) as received
+
+    Registration, lookup and completion are dict operations, whatever the number of jobs in flight.
+    The navigator and the workers reach the sink on different sockets, so a result may come back
+    before the registration of its job: it then gets an entry of its own, completed by the
+    registration. Entries are kept in arrival order and the ones older than `ttl` seconds, jobs
+    whose result never came back, are evicted from the front. The last `max_evicted` evicted jobs
+    are kept, so a result coming back after all is recognised and dropped. Older ones are handed
+    out once by `pop_forgotten`.
+    """
+
+    def __init__(self, ttl, max_evicted=10000):
+        self.ttl = ttl
+        self.max_evicted = max_evicted
+        self._jobs = OrderedDict()
+        self._evicted = OrderedDict()
+        self._forgotten = []
+        self.num_registered = 0
+        self.num_early = 0
+        self.num_evicted = 0
+
+    def __len__(self):
+        return len(self._jobs)
+
+    def __contains__(self, key):
+        return key in self._jobs
+
+    def register(self, key, **info):
+        """Entry of a new job, with what its result came with when it is already back"""
+        job = self._jobs.get(key)
+        if job is None:
+            job = self._jobs[key] = {'arrival': time.time()}
+        elif 'end' in job or 'part_results' in job:
+            self.num_early += 1
+        job.update(info, registered=True)
+        self.num_registered += 1
+        return job
+
+    def get(self, key):
+        """Entry of a job, created when a result comes back before the registration"""
+        job = self._jobs.get(key)
+        if job is None:
+            job = self._jobs[key] = {'arrival': time.time()}
+        return job
+
+    def pop(self, key):
+        return self._jobs.pop(key, None)
+
+    def was_evicted(self, key):
+        return key in self._evicted
+
+    def evicted_job(self, key):
+        return self._evicted.get(key)
+
+    def pop_forgotten(self):
+        """Evicted jobs dropped from the record since the last call"""
+        forgotten, self._forgotten = self._forgotten, []
+        return forgotten
+
+    def evict(self):
+        """Remove the entries older than `ttl`, returns the registered jobs among them as (key, job)"""
+        now = time.time()
+        evicted = []
+        while self._jobs:
+            key, job = next(iter(self._jobs.items()))
+            if job['arrival'] > now - self.ttl:
+                break
+            self._jobs.popitem(last=False)
+            if job.get('registered'):
+                self._evicted[key] = job
+                if len(self._evicted) > self.max_evicted:
+                    self._forgotten.append(self._evicted.popitem(last=False)[1])
+                evicted.append((key, job))
+        self.num_evicted += len(evicted)
+        return evicted
+
+    @property
+    def status(self):
+        return {
+            'num_tracked_job': len(self._jobs),
+            'num_registered_job': self.num_registered,
+            'num_early_result': self.num_early,
+            'num_evicted_job': self.num_evicted,
+        }
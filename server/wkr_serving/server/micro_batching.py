@@ -0,0 +1,95 @@
+import time
+
+__all__ = ['MicroBatchPolicy', 'StageMeter', 'BATCH_POLICIES']
+
+BATCH_POLICIES = ['latency', 'throughput']
+
+
+class MicroBatchPolicy:
+    """Decides how long a worker keeps assembling a batch after the first job arrived.
+
+    latency: take whatever is already queued and dispatch as soon as the queue is empty
+    throughput: wait for the batch to fill, at most `window_ms` from the first arrival
+
+    With `adaptive=True` the window and the target batch size follow the observed arrival
+    gap and predict latency: during one predict about `predict_ms / gap` new jobs arrive, so
+    that is the batch size worth waiting for, and waiting longer than it takes them to arrive
+    only adds latency.
+    """
+
+    def __init__(self, batch_size, window_ms, policy='throughput', adaptive=False, smoothing=0.1):
+        if policy not in BATCH_POLICIES:
+            raise ValueError('"{}" is an invalid batch policy, must be one of {}'.format(policy, BATCH_POLICIES))
+        self.batch_size = batch_size
+        self.max_window_ms = window_ms
+        self.policy = policy
+        self.adaptive = adaptive
+        self.smoothing = smoothing
+
+        self.window_ms = window_ms
+        self.target_size = batch_size
+        self._arrival_gap_ms = None
+        self._predict_ms = None
+        self._last_arrival = None
+
+    def _ewma(self, old, new):
+        return new if old is None else (1-self.smoothing)*old + self.smoothing*new
+
+    def observe_arrival(self):
+        now = time.time()
+        if self._last_arrival is not None:
+            self._arrival_gap_ms = self._ewma(self._arrival_gap_ms, (now-self._last_arrival)*1000)
+        self._last_arrival = now
+        if self.adaptive:
+            self._tune()
+
+    def observe_predict(self, batch_size, predict_ms):
+        self._predict_ms = self._ewma(self._predict_ms, predict_ms)
+        if self.adaptive:
+            self._tune()
+
+    def _tune(self):
+        if self._arrival_gap_ms is None or self._predict_ms is None:
+            return
+        gap = max(self._arrival_gap_ms, 1e-3)
+        self.target_size = int(max(1, min(self.batch_size, round(self._predict_ms/gap) + 1)))
+        if self.policy == 'latency':
+            # only wait when the next job is expected sooner than a predict would take anyway
+            self.window_ms = min(self.max_window_ms, gap) if gap < self._predict_ms else 0
+        else:
+            self.window_ms = min(self.max_window_ms, gap*(self.target_size-1))
+
+    def wait_time(self, first_arrival, num_collected):
+        """Time (ms) left to wait for the next job, 0 means dispatch now if nothing is queued, None means dispatch now"""
+        if num_collected >= self.target_size:
+            return None
+        remaining = self.window_ms - (time.time()-first_arrival)*1000
+        if self.policy == 'latency' and not self.adaptive:
+            return 0
+        return max(0, remaining)
+
+    @property
+    def status(self):
+        return {
+            'sys_batch_window': self.window_ms,
+            'sys_batch_target': self.target_size,
+        }
+
+
+class StageMeter:
+    """Busy time of each worker pipeline stage, reported as the fraction of wall time since the last report"""
+
+    def __init__(self, stages):
+        self._busy = {s: 0.0 for s in stages}
+        self._last_report = time.time()
+
+    def add(self, stage, seconds):
+        self._busy[stage] += seconds
+
+    def occupancy(self):
+        now = time.time()
+        elapsed = max(now - self._last_report, 1e-6)
+        result = {'sys_occupancy_%s' % s: min(1.0, busy/elapsed) for s, busy in self._busy.items()}
+        self._busy = {s: 0.0 for s in self._busy}
+        self._last_report = now
+        return result
@@ -0,0 +1,144 @@
+import argparse
+from collections import OrderedDict
+
+from .scheduler import JobScheduler
+
+__all__ = ['WorkerPool', 'PoolRouter', 'POOL_ARGS', 'ROUTE_OPTIONS', 'DEFAULT_POOL', 'get_worker_pools']
+
+DEFAULT_POOL = 'default'
+
+# arguments a pool may set for its own workers, everything else is shared by the whole server
+POOL_ARGS = ['num_worker', 'batch_size', 'device_map', 'gpu_memory_fraction', 'cpu',
+             'model_dir', 'model_name', 'tmp_folder',
+             'batch_group_timeout', 'batch_policy', 'batch_adaptive', 'batch_bucket', 'bucket_boundaries',
+             'batch_bisect', 'no_batch_buffer', 'dispatch', 'credit_batches', 'schedule_policy',
+             'preload', 'preload_gc_freeze', 'warmup_batch_sizes', 'worker_pipeline', 'pipeline_depth',
+             'async_concurrency', 'worker_threads']
+
+# how requests reach a pool: the model it serves (the pool name by default) and the range of input
+# sizes (bytes) it takes, several pools may serve the same model
+ROUTE_OPTIONS = ['model', 'min_input_byte', 'max_input_byte']
+
+
+class WorkerPool:
+    """A named pool of workers serving one model: its worker class, the arguments of its workers,
+    the requests it takes, its dispatcher and the jobs waiting for one of its workers
+    """
+
+    def __init__(self, name, hardprocesser, args, model=None, min_input_byte=0, max_input_byte=None):
+        self.name = name
+        self.hardprocessor_skeleton = hardprocesser
+        self.args = args
+        self.model = model or name
+        self.min_input_byte = min_input_byte
+        self.max_input_byte = max_input_byte
+        self.num_worker = args.num_worker
+        self.batch_size = args.batch_size
+        self.dispatch_mode = args.dispatch
+        # jobs waiting for a worker of this pool with free capacity
+        self.pending_jobs = JobScheduler(args.schedule_policy)
+        self.dispatcher = None
+        self.device_map = []
+        self.template = None
+        # average predict time per item of the workers, measured by the sink
+        self.predict_ms = None
+        self.num_routed = 0
+        self._current_weight = 0
+
+    @property
+    def size_routed(self):
+        return self.min_input_byte > 0 or self.max_input_byte is not None
+
+    def accepts(self, input_byte):
+        return input_byte >= self.min_input_byte and (self.max_input_byte is None or input_byte <= self.max_input_byte)
+
+    @property
+    def num_socket(self):
+        return max(8, self.num_worker * 2) if self.dispatch_mode == 'random' else 1
+
+    @property
+    def status(self):
+        return {
+            'model': self.model,
+            'worker_class': self.hardprocessor_skeleton.__name__,
+            'num_worker': self.num_worker,
+            'batch_size': self.batch_size,
+            'device_map': self.device_map,
+            'input_byte_range': [self.min_input_byte, self.max_input_byte],
+            'predict_ms': self.predict_ms,
+            'num_routed_job': self.num_routed,
+            'num_pending_job': len(self.pending_jobs),
+            'dispatch_status': self.dispatcher.status if self.dispatcher is not None else None,
+        }
+
+
+def get_worker_pools(args, hardprocesser):
+    """Build the pools of a server
+
+    `hardprocesser` is either one worker class, served as the "default" pool, or a dict of
+    model name -> worker class, or model name -> dict with the worker class under 'worker' and
+    the arguments of POOL_ARGS the pool sets differently from the server. "-pool_args" gives the same
+    arguments as JSON, by model name. A pool may also set the ROUTE_OPTIONS, its name is then only a
+    pool name and "model" the model it serves. The first pool serves the requests that do not name a model.
+    """
+    if not isinstance(hardprocesser, dict):
+        hardprocesser = {DEFAULT_POOL: hardprocesser}
+    pool_args = getattr(args, 'pool_args', None) or {}
+    unknown = set(pool_args) - set(hardprocesser)
+    if unknown:
+        raise ValueError('"-pool_args" names unknown models: {}'.format(', '.join(sorted(unknown))))
+
+    pools = OrderedDict()
+    for name, spec in hardprocesser.items():
+        spec = dict(spec) if isinstance(spec, dict) else {'worker': spec}
+        worker_class = spec.pop('worker', None)
+        overrides = {**spec, **pool_args.get(name, {})}
+        route = {k: overrides.pop(k) for k in ROUTE_OPTIONS if k in overrides}
+        invalid = set(overrides) - set(POOL_ARGS)
+        if invalid:
+            raise ValueError('model "{}" can not set {}, a pool may only set: {}'.format(
+                name, ', '.join(sorted(invalid)), ', '.join(POOL_ARGS)))
+        pools[name] = WorkerPool(name, worker_class, argparse.Namespace(**{**vars(args), **overrides, 'pool': name}), **route)
+    return pools
+
+
+class PoolRouter:
+    """Picks the pool of a request among the pools serving its model
+
+    A request whose size falls in the "min_input_byte"/"max_input_byte" range of some pools goes to
+    those pools only, other requests go to the pools without a range (to every pool of the model when
+    all of them have one). The candidate pools get requests in proportion to their throughput, `num_worker` over the
+    predict time per item measured on their workers, with smooth weighted round robin: the order is
+    deterministic and a pool never gets a burst of consecutive requests beyond its share.
+    """
+
+    def __init__(self, pools):
+        self.routes = OrderedDict()
+        for pool in pools.values():
+            self.routes.setdefault(pool.model, []).append(pool)
+        # requests that do not name a model go to the model of the first pool
+        self.default_model = next(iter(self.routes))
+
+    def weight(self, pool, candidates):
+        measured = [p.predict_ms for p in candidates if p.predict_ms]
+        # a pool that has not reported yet is assumed to be as fast as the average of the others
+        predict_ms = pool.predict_ms or (sum(measured)/len(measured) if measured else 1)
+        return pool.num_worker / predict_ms
+
+    def route(self, model, input_byte):
+        """The pool a request goes to, None when no pool serves `model`"""
+        pools = self.routes.get(model or self.default_model)
+        if not pools:
+            return None
+        candidates = [p for p in pools if p.size_routed and p.accepts(input_byte)] \
+            or [p for p in pools if not p.size_routed] or pools
+        if len(candidates) == 1:
+            pool = candidates[0]
+        else:
+            weights = [self.weight(p, candidates) for p in candidates]
+            for p, w in zip(candidates, weights):
+                p._current_weight += w
+            pool = max(candidates, key=lambda p: p._current_weight)
+            pool._current_weight -= sum(weights)
+        pool.num_routed += 1
+        return pool
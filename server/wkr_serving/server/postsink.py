@@ -24,12 +24,19 @@ from .protocol import *
 from .http import BertHTTPProxy
 from .zmq_decor import multi_socket
 
+from .jobs import JobTable
 from .statistic import ServerStatistic
+from .shm import release_shm, take_shm
 
 class WKRSink(Process):
-    def __init__(self, args, nav_to_sink_addr, worker_socket_addrs):
+    def __init__(self, args, nav_to_sink_addr, worker_socket_addrs, shard=0, publish_addr=None):
         super().__init__()
-        self.port = args.port_out
+        # with several sinks, each one collects the results of the clients hashed to its shard
+        self.shard = shard
+        self.num_sink = args.num_sink
+        # shards connect to the forwarder of the navigator when they share "port_out"
+        self.publish_addr = publish_addr
+        self.port = args.port_out + shard if args.sink_publish == 'per_shard' else args.port_out
         self.exit_flag = multiprocessing.Event()
         self.nav_to_sink_addr = nav_to_sink_addr
         self.verbose = args.verbose
@@ -42,8 +49,13 @@ class WKRSink(Process):
         self.current_jobnum = 0
         self.maximum_jobnum = 0
         self.total_processed = 0
+        self.total_rejected = 0
+        self.total_expired = defaultdict(int)
+        # registered jobs without result for that long (seconds) are evicted
+        self.job_ttl = args.job_ttl
 
-        # auto scaling policy
+        # auto scaling policy, with "slo" the navigator decides from the pool reports
+        self.autoscale = args.autoscale
         self.busy_util_threshold = args.busy_util_threshold
         self.duration_expand = args.duration_expand
         self.duration_squeeze = args.duration_squeeze
@@ -56,9 +68,20 @@ class WKRSink(Process):
         self.system_squeezed = True
         self.util_history = []
 
+        # how often the measured predict time, latencies and in-flight jobs of each pool are sent to the navigator
+        self.pool_report_interval_ms = 1000
+        self.pool_report_num_sample = 100
+        self.pool_report_max_latency = 1000
+        self.pool_last_report_timestamp = time.time()
+        # latencies since the last report and registered jobs not yet sent back, by pool
+        self.recent_latency = defaultdict(list)
+        self.inflight_by_model = defaultdict(int)
+        self.shard_last_report_timestamp = time.time()
+
         self.logdir = args.log_dir
         self.logname = args.log_name
-        self.logger = set_logger(colored('SINK', 'green'), logger_dir=self.logdir, logger_name=self.logname, verbose=args.verbose)
+        self.name = 'SINK' if self.num_sink == 1 else 'SINK-%d' % shard
+        self.logger = set_logger(colored(self.name, 'green'), logger_dir=self.logdir, logger_name=self.logname, verbose=args.verbose)
 
     def close(self):
         self.logger.info('shutting down...')
@@ -85,7 +108,8 @@ class WKRSink(Process):
             return 0
             
         maximum_request_per_second = self.get_ideal_maxload(statistic_status)
-        current_util = max(0, min(1, self.current_jobnum/maximum_request_per_second))
+        # the first shard drives the scaling, clients are spread evenly so it sees 1/num_sink of the jobs
+        current_util = max(0, min(1, self.current_jobnum*self.num_sink/maximum_request_per_second))
         return current_util
 
     def check_internal_utils(self, statistic_status, navigator_sink, logger):
@@ -143,6 +167,66 @@ class WKRSink(Process):
             # nothing to check when not in checking interval
             pass
         
+    def report_pool_status(self, model_status, navigator_sink):
+        current_timestamp = time.time()
+        if (current_timestamp - self.pool_last_report_timestamp)*1000 < self.pool_report_interval_ms:
+            return
+        self.pool_last_report_timestamp = current_timestamp
+        pool_status = {}
+        for pool in set(model_status) | set(self.inflight_by_model):
+            report = pool_status[pool] = {'inflight': self.inflight_by_model[pool], 'latency': self.recent_latency.pop(pool, [])}
+            # recent samples only, so the navigator follows a pool that slows down or speeds up,
+            # worker statistics only reach the first shard
+            predict = model_status[pool]._other_statistic.get('sys_predict') if pool in model_status else None
+            if predict:
+                report['predict_ms'] = np.mean(predict[-self.pool_report_num_sample:])
+        if pool_status:
+            navigator_sink.send_multipart([ServerCmd.pool_status, to_bytes(str(self.shard)), jsonapi.dumps(pool_status)])
+
+    def job_counters(self, jobs):
+        return {
+            'total_job_in_queue': self.current_jobnum,
+            'maximum_job_in_queue': self.maximum_jobnum,
+            'total_processed_job': self.total_processed,
+            'total_rejected_job': self.total_rejected,
+            'expired_job': dict(self.total_expired),
+            **jobs.status,
+        }
+
+    def shard_status(self, jobs, sink_status, model_status, num_sample=100):
+        return {
+            'shard': self.shard,
+            'counters': self.job_counters(jobs),
+            'statistic': sink_status.snapshot(num_sample),
+            'models': {model: status.snapshot(num_sample) for model, status in model_status.items()},
+        }
+
+    def report_shard_status(self, jobs, sink_status, model_status, navigator_sink):
+        # the first shard answers the config requests, the other ones keep the navigator up to date
+        current_timestamp = time.time()
+        if (current_timestamp - self.shard_last_report_timestamp)*1000 < self.pool_report_interval_ms:
+            return
+        self.shard_last_report_timestamp = current_timestamp
+        status = self.shard_status(jobs, sink_status, model_status)
+        navigator_sink.send_multipart([ServerCmd.sink_status, jsonapi.dumps(status)])
+
+    @staticmethod
+    def merge_shard_status(shard_statuses):
+        """Job counters summed, statistics and statistics by model merged over all shards"""
+        counters, expired = defaultdict(int), defaultdict(int)
+        statistic, models = ServerStatistic(), defaultdict(ServerStatistic)
+        for status in shard_statuses:
+            for key, value in status['counters'].items():
+                if key == 'expired_job':
+                    for stage, num in value.items():
+                        expired[stage] += num
+                else:
+                    counters[key] += value
+            statistic.merge(status['statistic'])
+            for model, snapshot in status['models'].items():
+                models[model].merge(snapshot)
+        return {**counters, 'expired_job': dict(expired)}, statistic, models
+
     @zmqd.socket(zmq.PULL)
     @zmqd.socket(zmq.PAIR)
     @zmqd.socket(zmq.PUB)
@@ -150,7 +234,10 @@ class WKRSink(Process):
 
         receiver_addr = auto_bind(receiver)
         frontend.connect(self.nav_to_sink_addr)
-        sender.bind('tcp://*:%d' % self.port)
+        if self.publish_addr:
+            sender.connect(self.publish_addr)
+        else:
+            sender.bind('tcp://*:%d' % self.port)
 
         poller = zmq.Poller()
         poller.register(frontend, zmq.POLLIN)
@@ -161,120 +248,305 @@ class WKRSink(Process):
         
         # Windows does not support logger in MP environment, thus get a new logger
         # inside the process for better compability
-        logger = set_logger(colored('SINK', 'green'), logger_dir=self.logdir, logger_name=self.logname, verbose=self.verbose)
-        logger_error = set_logger(colored('SINK-ERROR', 'red'), logger_dir=self.logdir, logger_name=self.logname, verbose=self.verbose, error_log=True)
+        logger = set_logger(colored(self.name, 'green'), logger_dir=self.logdir, logger_name=self.logname, verbose=self.verbose)
+        logger_error = set_logger(colored('%s-ERROR' % self.name, 'red'), logger_dir=self.logdir, logger_name=self.logname, verbose=self.verbose, error_log=True)
         logger.info('ready')
         self.is_ready.set()
 
         sink_status = ServerStatistic()
-        latency_status = defaultdict(lambda: {'start': -1, 'end': -1})
-
-        def check_status(sink_status, latency_status):
-            result = []
-            removed_keys = []
-            for k, status in latency_status.items():
-                if status['start'] != -1 and status['end'] != -1:
-                    latency = (status['end']-status['start'])*1000
-                    result.append(latency)
-                    removed_keys.append(k)
-            for k in removed_keys:
-                latency_status.pop(k)
-            for res in result:
-                sink_status.update_key('latency', res)
-            # print('\n',dict(latency_status), '\n', result, '\n')
+        # worker statistics and latency by model
+        model_status = defaultdict(ServerStatistic)
+        # registered jobs, by (client, req_id)
+        jobs = JobTable(self.job_ttl)
+
+        def record_latency(job):
+            latency = (job['end']-job['start'])*1000
+            sink_status.update_key('latency', latency)
+            if job.get('model'):
+                model_status[job['model']].update_key('latency', latency)
+                recent = self.recent_latency[job['model']]
+                recent.append(latency)
+                if len(recent) > self.pool_report_max_latency:
+                    recent.pop(0)
+
+        def gather_part(client, req_id, msg, msg_info):
+            # parts of a scattered batch request come back as <req_id>/<part>, reply once all parts are in
+            base_req_id, _, part_idx = req_id.rpartition(b'/')
+            job = jobs.get((client, base_req_id))
+            job.setdefault('part_results', {})[int(part_idx)] = (msg, msg_info)
+            return merge_parts(base_req_id, job)
+
+        def merge_parts(base_req_id, job):
+            part_results = job.get('part_results', {})
+            if 'parts' not in job or len(part_results) < job['parts']:
+                return None
+            failed = [r for r in part_results.values() if r[1] in [ServerCmd.exception, ServerCmd.deadline_exceeded, ServerCmd.worker_lost]]
+            if failed:
+                release_parts(job)
+                return (base_req_id,) + failed[0]
+            merged_msg, merged_info = merge_payload(self.transfer_protocol, [part_results[k] for k in sorted(part_results)])
+            return base_req_id, merged_msg, merged_info
+
+        def release_parts(job):
+            for part_msg, part_info in job.get('part_results', {}).values():
+                if is_shm(part_info):
+                    release_shm(part_msg)
+
+        def is_shm(msg_info):
+            # results above "-shm_threshold" are a handle on the worker slab
+            return b'"shm"' in msg_info and parse_job_info(msg_info).get('shm')
+
+        def is_chunk(msg_info):
+            # a chunk of a streamed output, the end of stream marker completes the job as a result does
+            return b'"seq"' in msg_info and b'"eos"' not in msg_info
+
+        def forward_chunk(client, req_id, msg, msg_info):
+            if jobs.was_evicted((client, req_id)):
+                if is_shm(msg_info):
+                    release_shm(msg)
+                return
+            job = jobs.get((client, req_id))
+            if 'first_chunk' not in job:
+                job['first_chunk'] = time.time()
+                if job.get('registered'):
+                    # time to first byte of a streamed request
+                    first_chunk = (job['first_chunk']-job['start'])*1000
+                    sink_status.update_key('sys_first_chunk', first_chunk)
+                    if job.get('model'):
+                        model_status[job['model']].update_key('sys_first_chunk', first_chunk)
+            if is_shm(msg_info) and not job.get('shm_client'):
+                msg = take_shm(msg)
+                msg_info = jsonapi.dumps({k: v for k, v in jsonapi.loads(msg_info).items() if k != 'shm'})
+            send_to_next_raw(client, req_id, msg, msg_info, sender)
+            logger.info('streamed chunk\tjob id: {}#{}'.format(client, req_id))
+
+        def is_part(client, req_id):
+            # parts of a scattered batch request are <req_id>/<part>, they are never registered themselves
+            base_req_id, sep, part_idx = req_id.rpartition(b'/')
+            return sep and part_idx.isdigit() and (client, req_id) not in jobs
+
+        def deliver_job(client, req_id, msg, msg_info, stage):
+            """Send a finished job (result, exception or dropped) back to the client, returns the number of completed jobs"""
+            part = is_part(client, req_id)
+            if jobs.was_evicted((client, req_id.rpartition(b'/')[0] if part else req_id)):
+                # the sink already gave up on the job and answered the client
+                logger_error.warning('dropped late result {}#{}'.format(client, req_id))
+                if is_shm(msg_info):
+                    release_shm(msg)
+                job = jobs.evicted_job((client, req_id.rpartition(b'/')[0] if part else req_id))
+                job['unanswered'] -= 1
+                if job['unanswered'] <= 0:
+                    release_input(job)
+                return 0
+            if part:
+                gathered = gather_part(client, req_id, msg, msg_info)
+                if gathered is None:
+                    logger.info("collected part {}#{}".format(client, req_id))
+                    return 0
+                req_id, msg, msg_info = gathered
+            return finish_job(client, req_id, jobs.get((client, req_id)), msg, msg_info, stage)
+
+        def finish_job(client, req_id, job, msg, msg_info, stage):
+            job_deadline = job.get('deadline')
+            job_expired = msg_info == ServerCmd.deadline_exceeded
+            if job_expired:
+                # dropped before predict
+                self.total_expired[stage] += 1
+            elif job_deadline and time.time() > job_deadline:
+                # result came back too late, the client already gave up on it
+                if is_shm(msg_info):
+                    release_shm(msg)
+                msg = to_bytes('deadline exceeded before the result was delivered, job id: {}#{}'.format(to_str(client), to_str(req_id)))
+                msg_info = ServerCmd.deadline_exceeded
+                job_expired = True
+                self.total_expired['sink'] += 1
+
+            if job_expired:
+                logger.info("expired {}#{}".format(client, req_id))
+            elif msg_info in [ServerCmd.exception, ServerCmd.worker_lost]:
+                # exception
+                logger_error.error("exception processing {}#{}\n{}".format(client, req_id, msg))
+                sink_status.update([
+                    to_bytes(client), 
+                    ServerCmd.exception, 
+                    to_bytes(req_id), 
+                    b'1'
+                ])
+            else:
+                # embeding
+                logger.info("collected {}#{}".format(client, req_id))
+                sink_status.update([
+                    to_bytes(client), 
+                    b'<new_request>', 
+                    to_bytes(req_id), 
+                    b'1'
+                ])
+            # sink_status.update_key('sys_output_byte', len(msg))
+
+            if not job_expired and is_shm(msg_info) and not job.get('shm_client'):
+                # the client can not map the worker slab, send the payload itself
+                msg = take_shm(msg)
+                msg_info = jsonapi.dumps({k: v for k, v in jsonapi.loads(msg_info).items() if k != 'shm'})
+
+            send_to_next_raw(client, req_id, msg, msg_info, sender)
+
+            job['end'] = time.time()
+            job['expired'] = job_expired
+            if job.get('registered'):
+                complete_job(client, req_id, job)
+            if not job_expired:
+                self.total_processed += 1
+
+            self.current_jobnum -= 1
+            logger.info('send back\tjob id: {}#{} \tleft: {}'.format(client, req_id, self.current_jobnum))
+            return 1
+
+        def complete_job(client, req_id, job):
+            # delivered and registered, whichever came last
+            jobs.pop((client, req_id))
+            if job.get('model'):
+                self.inflight_by_model[job['model']] -= 1
+            # the input slot of a same-host client is reclaimed once the job is delivered
+            release_input(job)
+            if not job['expired']:
+                record_latency(job)
+
+        def release_input(job):
+            if job.get('shm_input'):
+                release_shm(to_bytes(job.pop('shm_input')))
+
+        def evict_jobs():
+            # jobs whose result never came back, their admission slots are given back to the navigator
+            num_evicted = 0
+            for (client, req_id), job in jobs.evict():
+                # results or worker losses still to come, a worker may read the input slot until the last one
+                job['unanswered'] = job.get('parts', 1) - len(job.get('part_results', {}))
+                release_parts(job)
+                job.pop('part_results', None)
+                if job.get('model'):
+                    self.inflight_by_model[job['model']] -= 1
+                exception_msg = 'no result after {}s, the job was given up'.format(self.job_ttl)
+                logger_error.warning('evicted job {}#{}: {}'.format(client, req_id, exception_msg))
+                send_to_next_raw(client, req_id, to_bytes(exception_msg), ServerCmd.worker_lost, sender)
+                if job['unanswered'] <= 0:
+                    release_input(job)
+                self.current_jobnum -= 1
+                num_evicted += 1
+            for job in jobs.pop_forgotten():
+                # no word for `max_evicted` evictions, long past any worker
+                release_input(job)
+            return num_evicted
 
         while not self.exit_flag.is_set():
             try:
                 socks = dict(poller.poll(1000))
+                num_job_done = 0
 
                 if socks.get(receiver) == zmq.POLLIN:
-                    client, req_id, msg, msg_info = recv_from_prev_raw(receiver)
-
-                    if msg_info == ServerCmd.statistic:
-                        # record statistic value
-                        stat_info = jsonapi.loads(msg)
-                        for k, v in stat_info.items():
-                            sink_status.update_key(k, v)
-                        logger.info('Update statistic\tjob id: {}#{}'.format(client, req_id))
+                    frames = receiver.recv_multipart(copy=False)
+                    if frames[0].bytes == ServerCmd.batch_result:
+                        # all outputs of a worker batch, payload frames go to the clients as they are
+                        for client, req_id, msg, msg_info in unpack_batch(frames):
+                            if is_chunk(msg_info):
+                                forward_chunk(client, req_id, msg, msg_info)
+                            else:
+                                num_job_done += deliver_job(client, req_id, msg, msg_info, 'worker')
                     else:
-                        # main processing flow
-                        # _start_stat = time.time()
-                        if msg_info == ServerCmd.exception:
-                            # exception
-                            logger_error.error("exception processing {}#{}\n{}".format(client, req_id, msg))
-                            sink_status.update([
-                                to_bytes(client), 
-                                ServerCmd.exception, 
-                                to_bytes(req_id), 
-                                b'1'
-                            ])
+                        client, req_id, msg, msg_info = [f.bytes for f in frames]
+                        if msg_info == ServerCmd.statistic:
+                            # record statistic value
+                            stat_info = jsonapi.loads(msg)
+                            for k, v in stat_info.items():
+                                sink_status.update_key(k, v)
+                                if client:
+                                    model_status[to_str(client)].update_key(k, v)
+                            logger.info('Update statistic\tjob id: {}#{}'.format(client, req_id))
                         else:
-                            # embeding
-                            logger.info("collected {}#{}".format(client, req_id))
-                            sink_status.update([
-                                to_bytes(client), 
-                                b'<new_request>', 
-                                to_bytes(req_id), 
-                                b'1'
-                            ])
-                        # sink_status.update_key('sys_output_byte', len(msg))
-                        # _end_stat = time.time()
-                        # logger.warning(f"stat: {_end_stat-_start_stat}s")
-
-                        # _start = time.time()
-                        send_to_next_raw(client, req_id, msg, msg_info, sender)
-                        # logger.warning(f"sent: {time.time()-_start}s")
-                        # logger.warning(f"hwm: {sender.get_hwm()}s")
-
-                        # update latency
-                        job_id = to_str(client) + '#' + to_str(req_id)
-                        latency_status[job_id]['end'] = time.time()
-                        check_status(sink_status, latency_status)
-
-                        self.current_jobnum -= 1
-                        self.total_processed += 1
-                        logger.info('send back\tjob id: {}#{} \tleft: {}'.format(client, req_id, self.current_jobnum))
+                            # main processing flow
+                            num_job_done += deliver_job(client, req_id, msg, msg_info, 'worker')
 
                 if socks.get(frontend) == zmq.POLLIN:
                     request = frontend.recv_multipart()
                     client_addr, msg_type, msg_info, req_id = request
                     if msg_type == ServerCmd.new_job:
-                        job_id = to_str(client_addr) + '#' + to_str(req_id)
                         self.current_jobnum += 1
                         self.maximum_jobnum = max(self.current_jobnum, self.maximum_jobnum)
                         job_info = jsonapi.loads(msg_info)
 
-                        # update latency
-                        latency_status[job_id]['start'] = job_info['time']
-                        check_status(sink_status, latency_status)
+                        job = jobs.register((client_addr, req_id),
+                                            start=job_info['time'],
+                                            deadline=job_info.get('deadline'),
+                                            shm_input=job_info.get('shm_input'),
+                                            shm_client=job_info.get('shm_client'),
+                                            model=job_info.get('model'))
+                        if job_info['split_info']:
+                            job['parts'] = int(job_info['job_parts'])
+                        if job.get('model'):
+                            self.inflight_by_model[job['model']] += 1
                         sink_status.update_key('sys_input_byte', job_info['input_byte'])
+                        logger.info('registed job\tjob id: {}#{}\tleft: {}'.format(client_addr, req_id, self.current_jobnum))
 
-                        logger.info('registed job\tjob id: {}\tleft: {}'.format(job_id, self.current_jobnum))
+                        # the result, or every part of it, came back before the registration
+                        if 'end' in job:
+                            complete_job(client_addr, req_id, job)
+                        elif 'parts' in job:
+                            gathered = merge_parts(req_id, job)
+                            if gathered is not None:
+                                num_job_done += finish_job(client_addr, gathered[0], job, gathered[1], gathered[2], 'worker')
 
                     elif msg_type == ServerCmd.show_config:
                         time.sleep(0.1)  # dirty fix of slow-joiner: sleep so that client receiver can connect.
                         sink_status.update(request)
                         logger.info('send config\tclient %s' % client_addr)
                         prev_status = jsonapi.loads(msg_info)
-                        
+                        # the last report of every other shard, at most one report interval old
+                        shard_statuses = prev_status.pop('sink_shards', [])
+
                         ideal_maxload = self.get_ideal_maxload(sink_status)
                         current_util = self.get_current_utils(sink_status)
+                        counters, merged_status, merged_models = self.job_counters(jobs), sink_status, model_status
+                        if shard_statuses:
+                            own_status = self.shard_status(jobs, sink_status, model_status, num_sample=sink_status._other_statistic_limit)
+                            shard_statuses = [own_status, *shard_statuses]
+                            counters, merged_status, merged_models = self.merge_shard_status(shard_statuses)
                         status={
                             'statistic_postsink': {**{
-                                'total_job_in_queue': self.current_jobnum,
-                                'maximum_job_in_queue': self.maximum_jobnum,
-                                'total_processed_job': self.total_processed,
+                                **counters,
+                                'total_expired_job': sum(counters['expired_job'].values()),
                                 'util': current_util,
                                 'ideal_maxload': ideal_maxload,
-                            }, **sink_status.value}
+                            }, **merged_status.value},
+                            'statistic_postsink_models': {model: status.other_statistic_stat for model, status in merged_models.items()}
                         }
+                        if shard_statuses:
+                            status['statistic_postsink_shards'] = {str(s['shard']): s['counters'] for s in shard_statuses}
                         send_to_next('obj', client_addr, req_id, {**prev_status, **status}, sender)
                     elif msg_type == ServerCmd.exception:
                         # not yet registed to the server
                         send_to_next_raw(client_addr, req_id, msg_info, ServerCmd.exception, sender)
                         logger_error.error("exception received {}#{}\{}".format(client_addr, req_id, msg_info))
-
-                self.check_internal_utils(sink_status, frontend, logger)
+                    elif msg_type == ServerCmd.deadline_exceeded:
+                        # registed job dropped by the navigator before reaching any worker
+                        num_job_done += deliver_job(client_addr, req_id, msg_info, ServerCmd.deadline_exceeded, 'navigator')
+                    elif msg_type == ServerCmd.worker_lost:
+                        # registed job held by a worker that died, and not re-queued by the navigator
+                        num_job_done += deliver_job(client_addr, req_id, msg_info, ServerCmd.worker_lost, 'navigator')
+                    elif msg_type == ServerCmd.overloaded:
+                        # rejected by the navigator admission control, never registed
+                        self.total_rejected += 1
+                        send_to_next_raw(client_addr, req_id, msg_info, ServerCmd.overloaded, sender)
+
+                num_job_done += evict_jobs()
+                if num_job_done > 0:
+                    # let the navigator release the admission slots
+                    frontend.send_multipart([ServerCmd.job_done, to_bytes(str(num_job_done))])
+
+                if self.shard == 0 and self.autoscale == 'util':
+                    # worker statistics only reach the first shard
+                    self.check_internal_utils(sink_status, frontend, logger)
+                if self.shard > 0:
+                    self.report_shard_status(jobs, sink_status, model_status, frontend)
+                self.report_pool_status(model_status, frontend)
 
             except Exception as e:
                 logger_error.error('{}'.format(e), exc_info=True)
@@ -5,13 +5,25 @@ import numpy as np
 import zmq
 from zmq.utils import jsonapi
 
-__all__ = ['ServerCmd', 'ProcessingError', 'DecodeObjectException',
+from .shm import read_shm, release_shm, sub_handle
+
+__all__ = ['ServerCmd', 'ProcessingError', 'ServerOverloadedError', 'DeadlineExceededError', 'WorkerLostError', 'DecodeObjectException',
            'send_to_next', 'recv_from_prev',
            'to_bytes', 'to_str', 
-           'send_object', 'recv_object', 'send_ndarray', 'decode_ndarray', 'decode_object', 'send_to_next_raw', 'recv_from_prev_raw']
+           'send_object', 'recv_object', 'send_ndarray', 'decode_ndarray', 'decode_object', 'send_to_next_raw', 'recv_from_prev_raw',
+           'send_batch', 'unpack_batch',
+           'parse_job_info', 'split_payload', 'merge_payload']
 
 class DecodeObjectException(Exception):
-    pass    
+    """An input that can not be decoded, `client`, `req_id` and the raw `msg_info` tell whose it is"""
+    pass
+
+def _decode_error(e, client, req_id, msg_info):
+    decode_exp = DecodeObjectException(str(e))
+    decode_exp.client = client
+    decode_exp.req_id = req_id
+    decode_exp.msg_info = msg_info
+    return decode_exp
 
 class ServerCmd:
     terminate = b'TERMINATION'
@@ -22,6 +34,14 @@ class ServerCmd:
     data_embed = b'EMBEDDINGS'
     exception = b'EXCEPTION'
     statistic = b'STATISTIC'
+    credit = b'CREDIT'
+    job_done = b'JOB_DONE'
+    overloaded = b'OVERLOADED'
+    deadline_exceeded = b'DEADLINE_EXCEEDED'
+    worker_lost = b'WORKER_LOST'
+    batch_result = b'BATCH_RESULT'
+    pool_status = b'POOL_STATUS'
+    sink_status = b'SINK_STATUS'
 
     expand_worker = b'EXPAND_WORKER'
     squeeze_worker = b'SQUEEZE_WORKER'
@@ -32,27 +52,52 @@ class ServerCmd:
 
 class ProcessingError(Exception):
     "Raised when eception happend on server side"
+    error_code = 1
+
     def __init__(self, msg, client_id, req_id):
         super(ProcessingError, self).__init__(msg)
         self.client_id = client_id
         self.req_id = req_id
         self.raw_msg = msg
 
-def send_to_next(protocol, client, job_id, msg, dst, flags=0):
+class ServerOverloadedError(ProcessingError):
+    "Raised when the server rejected a request because its backlog is full"
+    error_code = 2
+
+class DeadlineExceededError(ProcessingError):
+    "Raised when the server dropped a request because its deadline passed before the result was ready"
+    error_code = 3
+
+class WorkerLostError(ProcessingError):
+    "Raised when the worker processing a request died and the request was not retried"
+    error_code = 4
+
+def raise_for_reply(client, req_id, msg, msg_info):
+    # msg may be a zmq.Frame when received with copy=False
+    if msg_info == ServerCmd.exception:
+        raise ProcessingError(to_str(bytes(msg)), to_str(client), to_str(req_id))
+    elif msg_info == ServerCmd.overloaded:
+        raise ServerOverloadedError(to_str(bytes(msg)), to_str(client), to_str(req_id))
+    elif msg_info == ServerCmd.deadline_exceeded:
+        raise DeadlineExceededError(to_str(bytes(msg)), to_str(client), to_str(req_id))
+    elif msg_info == ServerCmd.worker_lost:
+        raise WorkerLostError(to_str(bytes(msg)), to_str(client), to_str(req_id))
+
+def send_to_next(protocol, client, job_id, msg, dst, flags=0, info=None, slab=None):
     assert protocol in ['obj', 'numpy'], "{} is an invalid transfer protocol, must be 'obj' or 'numpy'".format(protocol)
     
     if protocol == 'obj':
-        send_object(dst, client, job_id, msg, flags=flags)
+        send_object(dst, client, job_id, msg, flags=flags, info=info, slab=slab)
     else:
-        send_ndarray(dst, client, job_id, msg, flags=flags)
+        send_ndarray(dst, client, job_id, msg, flags=flags, info=info, slab=slab)
 
-def recv_from_prev(protocol, src):
+def recv_from_prev(protocol, src, copy=True):
     assert protocol in ['obj', 'numpy'], "{} is an invalid transfer protocol, must be 'obj' or 'numpy'".format(protocol)
 
     if protocol == 'obj':
         client, req_id, msg, msg_info = recv_object(src)
     else:
-        client, req_id, msg, msg_info = recv_ndarray(src)
+        client, req_id, msg, msg_info = recv_ndarray(src, copy=copy)
 
     return client, req_id, msg, msg_info
 
@@ -63,24 +108,65 @@ def recv_from_prev_raw(src):
     client, req_id, msg, msg_info = src.recv_multipart()
     return client, req_id, msg, msg_info
 
-def send_ndarray(dst, client, job_id, array, flags=0, copy=True, track=False):
-    md = dict(dtype=str(array.dtype), shape=array.shape)
+def send_batch(protocol, jobs, outputs, dst, slab=None, infos=None):
+    """Send the outputs of a whole batch in one multipart message, `jobs` is the (client, req_id) of each output
+
+    frames: [batch_result, [[client, req_id], ...], payload, msg_info, payload, msg_info, ...]
+    numpy payloads are sent without copy, each one is a view on its row of the batch output.
+    `infos` are added to the msg_info of each output, the sequence number of a streamed chunk for instance.
+    """
+    frames = [ServerCmd.batch_result, jsonapi.dumps([[to_str(c), to_str(r)] for c, r in jobs])]
+    for k, output in enumerate(outputs):
+        if protocol == 'obj':
+            payload, info = pickle.dumps(output, -1), dict(protocol=-1, compress=0)
+        else:
+            payload = np.asarray(output)
+            if not payload.flags.c_contiguous:
+                payload = np.ascontiguousarray(payload)
+            info = dict(dtype=str(payload.dtype), shape=payload.shape)
+        if infos is not None:
+            info.update(infos[k])
+        handle = slab.put(payload) if slab is not None else None
+        if handle is not None:
+            payload, info['shm'] = handle, 1
+        frames += [payload, jsonapi.dumps(info)]
+    dst.send_multipart(frames, copy=False)
+
+def unpack_batch(frames):
+    """Split a message of `send_batch` into (client, req_id, payload, msg_info) tuples, payloads are not decoded"""
+    jobs = jsonapi.loads(frames[1].bytes)
+    return [(to_bytes(client), to_bytes(req_id), frames[2+2*k], frames[3+2*k].bytes) for k, (client, req_id) in enumerate(jobs)]
+
+def send_ndarray(dst, client, job_id, array, flags=0, copy=True, track=False, info=None, slab=None):
+    md = dict(dtype=str(array.dtype), shape=array.shape, **(info or {}))
+    # large payloads go through the shared memory slab, only the handle is sent
+    handle = slab.put(array) if slab is not None else None
+    if handle is not None:
+        array, md['shm'] = handle, 1
     msg_info = jsonapi.dumps(md)
     send_to_next_raw(client, job_id, array, msg_info, dst, flags=flags, copy=copy, track=track )
 
-def recv_ndarray(src):
-    msg = src.recv_multipart()
+def recv_ndarray(src, copy=True):
+    # with copy=False the array is a read-only view on the received zmq frame
+    msg = src.recv_multipart(copy=copy)
     client, req_id, msg, msg_info = msg
-    if msg_info == ServerCmd.exception:
-        raise ProcessingError(to_str(msg), to_str(client), to_str(req_id))
-    arr_info, arr_val = jsonapi.loads(msg_info), msg
-    array = decode_ndarray(arr_val, arr_info)
+    if not copy:
+        client, req_id, msg_info = client.bytes, req_id.bytes, msg_info.bytes
+    raise_for_reply(client, req_id, msg, msg_info)
+    try:
+        arr_info, arr_val = jsonapi.loads(msg_info), msg
+        if arr_info.get('shm'):
+            # a view on the sender slab, the sink releases it once the job is delivered
+            arr_val = read_shm(arr_val)
+        array = decode_ndarray(arr_val, arr_info)
+    except Exception as e:
+        raise _decode_error(e, client, req_id, msg_info)
     return to_str(client), to_str(req_id), array, arr_info
 
 def decode_ndarray(buffer, info):
     return np.frombuffer(memoryview(buffer), dtype=info['dtype']).reshape(info['shape'])
 
-def send_object(dst, client, job_id, obj, flags=0, copy=True, track=False, protocol=-1, need_compress=0):
+def send_object(dst, client, job_id, obj, flags=0, copy=True, track=False, protocol=-1, need_compress=0, info=None, slab=None):
     # start = time.time()
     if need_compress == 1:
         p = pickle.dumps(obj, protocol)
@@ -89,23 +175,24 @@ def send_object(dst, client, job_id, obj, flags=0, copy=True, track=False, proto
         z = pickle.dumps(obj, protocol)
     end = time.time()
     # print("encode ", end-start)
-    obj_info = jsonapi.dumps(dict(protocol=protocol, compress=need_compress))
+    obj_info = dict(protocol=protocol, compress=need_compress, **(info or {}))
+    handle = slab.put(z) if slab is not None else None
+    if handle is not None:
+        z, obj_info['shm'] = handle, 1
+    obj_info = jsonapi.dumps(obj_info)
     send_to_next_raw(client, job_id, z, obj_info, dst, flags=flags, copy=copy, track=track)
 
 def recv_object(src):
     msg = src.recv_multipart()
     client, req_id, msg, msg_info = msg
-    if msg_info == ServerCmd.exception:
-        raise ProcessingError(to_str(msg), to_str(client), to_str(req_id))
+    raise_for_reply(client, req_id, msg, msg_info)
     try:
         obj_info, obj_buffer = jsonapi.loads(msg_info), msg
+        if obj_info.get('shm'):
+            obj_buffer = read_shm(obj_buffer)
         obj = decode_object(obj_buffer, obj_info)
     except Exception as e:
-        raw_exp_e = str(e)
-        decode_exp = DecodeObjectException(raw_exp_e)
-        decode_exp.client = client
-        decode_exp.req_id = req_id
-        raise decode_exp
+        raise _decode_error(e, client, req_id, msg_info)
 
     return to_str(client), to_str(req_id), obj, obj_info
 
@@ -119,6 +206,74 @@ def decode_object(buffer, info):
         obj = pickle.loads(buffer)
     return obj
 
+def parse_job_info(msg_info):
+    """Extra job fields (priority, deadline...) carried along the protocol fields in msg_info.
+    Raises ValueError when a field the navigator queues the job by has the wrong type
+    """
+    try:
+        info = jsonapi.loads(msg_info)
+    except Exception:
+        return {}
+    if not isinstance(info, dict):
+        return {}
+    for key in ['priority', 'deadline', 'part_size']:
+        value = info.get(key)
+        if value is not None and (isinstance(value, bool) or not isinstance(value, (int, float)) or value != value):
+            raise ValueError('"{}" must be a number, got {!r}'.format(key, value))
+    if info.get('part_size') is not None and (info['part_size'] < 1 or info['part_size'] != int(info['part_size'])):
+        raise ValueError('"part_size" must be a positive integer, got {!r}'.format(info['part_size']))
+    if info.get('model') is not None and not isinstance(info['model'], str):
+        raise ValueError('"model" must be a string, got {!r}'.format(info['model']))
+    return info
+
+def split_payload(protocol, msg, info, part_size):
+    """Split a batch request (list for 'obj', stacked ndarray for 'numpy') into parts of at most `part_size` items.
+
+    Returns a list of (part payload, part msg_info, number of items), the part index is kept in msg_info.
+    """
+    extra = {k: v for k, v in info.items() if k not in ['protocol', 'compress', 'dtype', 'shape', 'shm']}
+    buffer = read_shm(msg) if info.get('shm') else msg
+    if protocol == 'obj':
+        items = decode_object(buffer, info)
+        if not isinstance(items, (list, tuple)):
+            raise TypeError('batch request must be a list, got {}'.format(type(items).__name__))
+    else:
+        items = decode_ndarray(buffer, info)
+    parts = []
+    for k, start in enumerate(range(0, max(len(items), 1), part_size)):
+        part = items[start:start+part_size]
+        part_info = dict(extra, part=k, part_size=len(part))
+        if protocol == 'obj':
+            parts.append((pickle.dumps(list(part), -1), jsonapi.dumps(dict(protocol=-1, compress=0, **part_info)), len(part)))
+        elif info.get('shm'):
+            # parts stay in the client slab, each one is a handle on its own byte range
+            part_handle = sub_handle(msg, start*part[:1].nbytes, part.nbytes)
+            parts.append((part_handle, jsonapi.dumps(dict(dtype=str(part.dtype), shape=part.shape, shm=1, **part_info)), len(part)))
+        else:
+            # slicing along the first axis keeps a contiguous view, no copy here
+            parts.append((part, jsonapi.dumps(dict(dtype=str(part.dtype), shape=part.shape, **part_info)), len(part)))
+    return parts
+
+def merge_payload(protocol, parts):
+    """Merge the raw (payload, msg_info) results of all parts, in part order, into one payload"""
+    decoded, handles = [], []
+    for msg, msg_info in parts:
+        info = jsonapi.loads(msg_info)
+        if info.get('shm'):
+            handles.append(msg)
+            msg = read_shm(msg)
+        decoded.append(decode_object(msg, info) if protocol == 'obj' else decode_ndarray(msg, info))
+    if protocol == 'obj':
+        merged = [v for part in decoded for v in part]
+        merged, merged_info = pickle.dumps(merged, -1), jsonapi.dumps(dict(protocol=-1, compress=0))
+    else:
+        merged = np.concatenate(decoded, axis=0)
+        merged_info = jsonapi.dumps(dict(dtype=str(merged.dtype), shape=merged.shape))
+    # the merged payload is a copy, the part slots can be reused
+    for handle in handles:
+        release_shm(handle)
+    return merged, merged_info
+
 def to_bytes(bytes_or_str):
     if isinstance(bytes_or_str, str):
         value = bytes_or_str.encode() # uses 'utf-8' for encoding
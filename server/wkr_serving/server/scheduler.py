@@ -0,0 +1,48 @@
+import heapq
+import itertools
+import time
+
+__all__ = ['JobScheduler', 'SCHEDULE_POLICIES']
+
+SCHEDULE_POLICIES = ['fifo', 'priority', 'sjf', 'edf']
+
+
+class JobScheduler:
+    """Queue of jobs waiting in the navigator for a worker with free capacity.
+
+    policies:
+        fifo: arrival order
+        priority: strict priority classes, higher `priority` first, arrival order inside a class
+        sjf: shortest job first, smallest `input_byte` first
+        edf: earliest deadline first, jobs without deadline go last
+    """
+
+    def __init__(self, policy='fifo'):
+        if policy not in SCHEDULE_POLICIES:
+            raise ValueError('"{}" is an invalid schedule policy, must be one of {}'.format(policy, SCHEDULE_POLICIES))
+        self.policy = policy
+        self._heap = []
+        self._counter = itertools.count()
+
+    def _key(self, priority, deadline, size):
+        if self.policy == 'priority':
+            return -priority
+        elif self.policy == 'sjf':
+            return size
+        elif self.policy == 'edf':
+            return deadline if deadline is not None else float('inf')
+        return 0
+
+    def push(self, job, priority=0, deadline=None, size=0):
+        heapq.heappush(self._heap, (self._key(priority, deadline, size), next(self._counter), time.time(), priority, job))
+
+    def peek(self):
+        return self._heap[0][-1]
+
+    def pop(self):
+        """Pop the next job, returns (job, time waited in queue in ms, priority class)"""
+        _, _, enqueue_time, priority, job = heapq.heappop(self._heap)
+        return job, (time.time()-enqueue_time)*1000, priority
+
+    def __len__(self):
+        return len(self._heap)
@@ -0,0 +1,90 @@
+import threading
+import zlib
+
+import zmq
+from zmq.utils import jsonapi
+
+from .helper import auto_bind
+from .protocol import ServerCmd, to_bytes
+
+__all__ = ['SINK_PUBLISH_MODES', 'sink_shard', 'sink_ports', 'ShardedSink', 'PublishProxy']
+
+SINK_PUBLISH_MODES = ['shared', 'per_shard']
+
+
+def sink_shard(client, num_sink):
+    """Sink shard of a client, the hash is the same in every process"""
+    if num_sink <= 1:
+        return 0
+    return zlib.crc32(to_bytes(client)) % num_sink
+
+
+def sink_ports(args):
+    """Ports the clients receive their results on, the first one also answers the config requests"""
+    if args.num_sink > 1 and args.sink_publish == 'per_shard':
+        return [args.port_out + shard for shard in range(args.num_sink)]
+    return [args.port_out]
+
+
+class ShardedSink:
+    """One PUSH socket per sink shard, used by the workers in place of their single sink socket
+
+    A message goes to the shard of its client, the outputs of a batch are split between the shards
+    of their clients and worker statistics all go to the first shard, which reports the pool status
+    and drives the auto scaling.
+    """
+
+    def __init__(self, ctx, addresses):
+        self.socks = []
+        for addr in addresses:
+            sock = ctx.socket(zmq.PUSH)
+            sock.connect(addr)
+            self.socks.append(sock)
+
+    def send_multipart(self, frames, flags=0, copy=True, track=False):
+        if frames[0] == ServerCmd.batch_result:
+            # frames: [batch_result, [[client, req_id], ...], payload, msg_info, ...], see send_batch
+            jobs = jsonapi.loads(frames[1])
+            by_shard = {}
+            for k, (client, _) in enumerate(jobs):
+                by_shard.setdefault(sink_shard(client, len(self.socks)), []).append(k)
+            for shard, ks in by_shard.items():
+                shard_frames = [frames[0], jsonapi.dumps([jobs[k] for k in ks])]
+                for k in ks:
+                    shard_frames += frames[2+2*k:4+2*k]
+                self.socks[shard].send_multipart(shard_frames, flags, copy=copy, track=track)
+        elif frames[3] == ServerCmd.statistic:
+            self.socks[0].send_multipart(frames, flags, copy=copy, track=track)
+        else:
+            self.socks[sink_shard(frames[0], len(self.socks))].send_multipart(frames, flags, copy=copy, track=track)
+
+    def close(self, linger=None):
+        for sock in self.socks:
+            sock.close(linger)
+
+
+class PublishProxy:
+    """Forwards what all the sink shards publish to the clients on a single port
+
+    The shards connect their PUB socket to `address`, client subscriptions go the other way.
+    The proxy runs in a thread of its own context, so the navigator context can terminate without it.
+    """
+
+    def __init__(self, port):
+        self.ctx = zmq.Context()
+        self.frontend = self.ctx.socket(zmq.XSUB)
+        self.address = auto_bind(self.frontend)
+        self.backend = self.ctx.socket(zmq.XPUB)
+        self.backend.bind('tcp://*:%d' % port)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        try:
+            zmq.proxy(self.frontend, self.backend)
+        except zmq.ZMQError:
+            # closed, destroying the context closes the sockets under the proxy
+            pass
+
+    def close(self):
+        self.ctx.destroy(linger=0)
@@ -0,0 +1,143 @@
+import mmap
+import os
+import re
+import uuid
+from multiprocessing import shared_memory
+
+import numpy as np
+
+__all__ = ['SharedMemorySlab', 'read_shm', 'release_shm', 'take_shm', 'shm_nbytes', 'sub_handle', 'check_handle']
+
+# buffers of the segments mapped by this process, by name
+_attached = {}
+
+# names of the segments created by a SharedMemorySlab, no other segment is ever mapped from a handle
+SLAB_NAME = re.compile(r'^wkr_[0-9a-f]{16}$')
+
+
+class SharedMemorySlab:
+    """Fixed-size payload slots in one shared memory segment, for participants on the same host
+
+    The writer (the process that created the slab) puts a payload into a free slot and sends the small
+    handle `<segment>:<slot>:<offset>:<nbytes>` instead of the payload. The first bytes of the segment hold one
+    in-use flag per slot: only the writer sets a flag, only the consumer that is done with the payload
+    clears it again (`release_shm`), so no lock is needed across processes.
+    """
+
+    def __init__(self, slot_size, num_slots, threshold=0):
+        self.slot_size = slot_size
+        self.num_slots = num_slots
+        self.threshold = threshold
+        self.header_size = (num_slots + 63)//64*64
+        self.shm = shared_memory.SharedMemory(name='wkr_%s' % uuid.uuid4().hex[:16], create=True,
+                                              size=self.header_size + slot_size*num_slots)
+        self.shm.buf[:num_slots] = bytes(num_slots)
+        self._next_slot = 0
+        # a reader in the same process uses this mapping
+        _attached[self.name] = self.shm.buf
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    @property
+    def num_used(self):
+        return sum(self.shm.buf[:self.num_slots])
+
+    def put(self, data):
+        """Copy `data` into a free slot, returns its handle, or None when it should be sent inline"""
+        if isinstance(data, np.ndarray):
+            data = np.ascontiguousarray(data)
+        view = memoryview(data).cast('B')
+        if view.nbytes < self.threshold or view.nbytes > self.slot_size:
+            return None
+        flags = self.shm.buf
+        for k in range(self.num_slots):
+            slot = (self._next_slot + k) % self.num_slots
+            if flags[slot] == 0:
+                flags[slot] = 1
+                self._next_slot = slot + 1
+                offset = self.header_size + slot*self.slot_size
+                self.shm.buf[offset:offset+view.nbytes] = view
+                return ('%s:%d:%d:%d' % (self.name, slot, offset, view.nbytes)).encode('ascii')
+        # every slot is still in use, fall back to sending inline
+        return None
+
+    def close(self):
+        _attached.pop(self.name, None)
+        try:
+            self.shm.close()
+        except BufferError:
+            # views on the slab are still alive, the segment is unmapped at exit
+            pass
+        self.shm.unlink()
+
+
+def _attach(name):
+    if name not in _attached:
+        # mapped without SharedMemory: it registers every attach with the resource tracker, which
+        # would unlink the segment under its writer when this process exits
+        fd = shared_memory._posixshmem.shm_open('/' + name, os.O_RDWR, mode=0o600)
+        try:
+            _attached[name] = memoryview(mmap.mmap(fd, os.fstat(fd).st_size))
+        finally:
+            os.close(fd)
+    return _attached[name]
+
+
+def _parse_handle(handle):
+    name, slot, offset, nbytes = bytes(handle).decode('ascii').split(':')
+    return name, int(slot), int(offset), int(nbytes)
+
+
+def check_handle(handle):
+    """Raises ValueError unless `handle` names a slab and its slot and byte range lie inside the segment,
+    returns the slab name. Handles received from a peer must pass it before any other function here
+    """
+    try:
+        name, slot, offset, nbytes = _parse_handle(handle)
+    except (UnicodeDecodeError, ValueError):
+        raise ValueError('malformed shared memory handle')
+    if not SLAB_NAME.match(name):
+        raise ValueError('"{}" is not a shared memory slab'.format(name))
+    try:
+        size = len(_attach(name))
+    except OSError:
+        raise ValueError('shared memory slab "{}" does not exist'.format(name))
+    # the in-use flags are in the header, before the payload of their slot
+    if not (0 <= slot < offset and nbytes >= 0 and offset + nbytes <= size):
+        raise ValueError('shared memory handle out of the bounds of slab "{}"'.format(name))
+    return name
+
+
+def shm_nbytes(handle):
+    return _parse_handle(handle)[3]
+
+
+def sub_handle(handle, start, nbytes):
+    """Handle on a byte range of the payload of `handle`, releasing it releases the whole slot"""
+    name, slot, offset, _ = _parse_handle(handle)
+    return ('%s:%d:%d:%d' % (name, slot, offset+start, nbytes)).encode('ascii')
+
+
+def read_shm(handle):
+    """Zero-copy view on the payload of a handle, valid until the handle is released"""
+    name, _, offset, nbytes = _parse_handle(handle)
+    return _attach(name)[offset:offset+nbytes]
+
+
+def release_shm(handle):
+    """Give the slot of a handle back to its writer"""
+    name, slot, _, _ = _parse_handle(handle)
+    try:
+        _attach(name)[slot] = 0
+    except FileNotFoundError:
+        # the writer is gone together with its slab
+        pass
+
+
+def take_shm(handle):
+    """Copy the payload of a handle out and release its slot"""
+    payload = bytes(read_shm(handle))
+    release_shm(handle)
+    return payload
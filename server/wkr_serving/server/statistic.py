@@ -79,6 +79,34 @@ class ServerStatistic:
         if len(self._other_statistic[key]) > self._other_statistic_limit:
             self._other_statistic[key].pop(0)
 
+    def snapshot(self, num_sample=100):
+        """Counters and the latest `num_sample` samples of each key, JSON-able, see `merge`"""
+        return {
+            'hist_client': {to_str(k): v for k, v in self._hist_client.items()},
+            'client_last_active_time': {to_str(k): v for k, v in self._client_last_active_time.items()},
+            'num_data_req': self._num_data_req,
+            'num_sys_req': self._num_sys_req,
+            'num_except_req': self._num_except_req,
+            'num_total_seq': self._num_total_seq,
+            'last_two_req_interval': self._last_two_req_interval[-num_sample:],
+            'other_statistic': {k: v[-num_sample:] for k, v in self._other_statistic.items()},
+        }
+
+    def merge(self, snapshot):
+        """Add the counters and samples of a `snapshot` taken in another process, a sink shard for instance"""
+        for client, num in snapshot['hist_client'].items():
+            self._hist_client[to_bytes(client)] += num
+        for client, active_time in snapshot['client_last_active_time'].items():
+            client = to_bytes(client)
+            self._client_last_active_time[client] = max(self._client_last_active_time[client], active_time)
+        self._num_data_req += snapshot['num_data_req']
+        self._num_sys_req += snapshot['num_sys_req']
+        self._num_except_req += snapshot['num_except_req']
+        self._num_total_seq += snapshot['num_total_seq']
+        self._last_two_req_interval.extend(snapshot['last_two_req_interval'])
+        for key, values in snapshot['other_statistic'].items():
+            self._other_statistic[key].extend(values)
+
     @property
     def other_statistic_stat(self):
         result = {}
@@ -0,0 +1,171 @@
+import gc
+import multiprocessing
+import os
+import signal
+import threading
+import time
+
+from termcolor import colored
+
+from .helper import set_logger
+
+__all__ = ['WKRWorkerTemplate']
+
+
+def fork_context():
+    """The "fork" start method, the only one sharing the memory of the template with the workers"""
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        raise RuntimeError('"-preload" forks the workers from a template process, this platform can not fork')
+    return multiprocessing.get_context('fork')
+
+
+class WKRWorkerTemplate:
+    """Loads the model once, then forks the workers from itself so they share the weights copy-on-write.
+
+    The worker objects are created by the navigator before the template starts, so the template, the
+    workers and the navigator all share their events. The navigator starts and closes them through
+    `start_worker` / `close_worker`, the template is the parent of every worker it forks.
+    """
+
+    def __init__(self, args, workers, device_id):
+        self.ctx = fork_context()
+        self.workers = {str(p.worker_id): p for p in workers}
+        self.device_id = device_id
+        self.gc_freeze = args.preload_gc_freeze
+        self.is_ready = self.ctx.Event()
+        self.load_time = self.ctx.Value('d', 0)
+        self._conn, self._child_conn = self.ctx.Pipe()
+        self._lock = threading.Lock()
+        # daemonic processes can not have children
+        self.process = self.ctx.Process(target=self.run, name='TEMPLATE', daemon=False)
+
+        self.logdir = args.log_dir
+        self.logname = args.log_name
+        self.verbose = args.verbose
+        self.logger = set_logger(colored('TEMPLATE', 'yellow'), logger_dir=self.logdir, logger_name=self.logname, verbose=self.verbose)
+
+    @property
+    def pid(self):
+        return self.process.pid
+
+    @property
+    def exitcode(self):
+        return self.process.exitcode
+
+    def is_alive(self):
+        return self.process.is_alive()
+
+    def _command(self, cmd, worker_id=None, poll_interval=1):
+        """Send a command to the template and wait for its answer, raises RuntimeError if the template is gone"""
+        with self._lock:
+            try:
+                self._conn.send((cmd, None if worker_id is None else str(worker_id)))
+                while not self._conn.poll(poll_interval):
+                    if not self.is_alive():
+                        raise EOFError
+                return self._conn.recv()
+            except (EOFError, OSError):
+                raise RuntimeError('the template exited with code {} while running "{}"'.format(self.exitcode, cmd))
+
+    def kill_orphan(self, worker_id):
+        # the workers forked by a dead template are not children of the navigator, they are killed by pid
+        pid = self.workers[str(worker_id)].forked_pid
+        if pid is None:
+            return
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+    def start(self):
+        self.process.start()
+        # the navigator keeps only its own end, so a crashed template shows up as EOFError instead of a hang
+        self._child_conn.close()
+
+    def wait_ready(self, poll_interval=1):
+        """Block until the model is loaded, raises RuntimeError if the template exits before"""
+        while not self.is_ready.wait(timeout=poll_interval):
+            if not self.is_alive():
+                raise RuntimeError('the template exited with code {} before loading the model, '
+                                   'see its log above'.format(self.exitcode))
+
+    def start_worker(self, worker_id):
+        """Fork a preloaded worker, returns its pid"""
+        return self._command('start', worker_id)
+
+    def close_worker(self, worker_id):
+        if not self.is_alive():
+            return self.kill_orphan(worker_id)
+        return self._command('close', worker_id)
+
+    def worker_exitcode(self, worker_id):
+        """Exit code of a forked worker, None while it runs or once the template is gone and it can not be known"""
+        if not self.is_alive():
+            return None
+        return self._command('exitcode', worker_id)
+
+    def close(self):
+        self.logger.info('shutting down...')
+        if self.is_alive():
+            try:
+                self._command('terminate')
+            except RuntimeError as e:
+                self.logger.error(e)
+            self.process.join()
+        else:
+            for worker_id in self.workers:
+                self.kill_orphan(worker_id)
+        self.logger.info('terminated!')
+
+    def run_worker(self, worker, envs, model):
+        # a worker holding the template end of the pipe would keep the navigator from seeing the template die
+        self._child_conn.close()
+        worker.template = None
+        worker.preloaded = (envs, model)
+        worker.run()
+
+    def run(self):
+        logger = set_logger(colored('TEMPLATE', 'yellow'), logger_dir=self.logdir, logger_name=self.logname, verbose=self.verbose)
+        worker = next(iter(self.workers.values()))
+
+        if self.gc_freeze:
+            # no collection between loading and fork, so the model objects stay where they are
+            gc.disable()
+        start = time.time()
+        envs = worker.get_env(self.device_id, worker.tmp_folder)
+        model = worker.get_model(envs, worker.model_dir, worker.model_name, worker.tmp_folder)
+        self.load_time.value = (time.time()-start)*1000
+        if self.gc_freeze:
+            # move everything loaded so far out of the collector reach, a collection in a worker
+            # would otherwise write to the gc headers and copy the pages holding the model
+            gc.freeze()
+        logger.info('model loaded in {:0.4f}ms, ready to fork {} workers'.format(self.load_time.value, len(self.workers)))
+        self.is_ready.set()
+
+        # the worker objects were created by the navigator, each one runs in a process forked here
+        processes = {}
+        while True:
+            cmd, worker_id = self._child_conn.recv()
+            if cmd == 'start':
+                p = self.ctx.Process(target=self.run_worker, args=(self.workers[worker_id], envs, model),
+                                     name='WORKER-%s' % worker_id, daemon=True)
+                p.start()
+                processes[worker_id] = p
+                self._child_conn.send(p.pid)
+            elif cmd == 'exitcode':
+                p = processes.get(worker_id)
+                self._child_conn.send(None if p is None else p.exitcode)
+            elif cmd == 'close':
+                p = processes.pop(worker_id, None)
+                if p is not None:
+                    p.terminate()
+                    p.join()
+                self._child_conn.send(None)
+            elif cmd == 'terminate':
+                for worker_id, p in processes.items():
+                    self.workers[worker_id].exit_flag.set()
+                    if p.is_alive():
+                        p.terminate()
+                        p.join()
+                self._child_conn.send(None)
+                break
@@ -1,8 +1,12 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 # Han Xiao <artex.xh@gmail.com> <https://hanxiao.github.io>
+import asyncio
+import gc
+import inspect
 import multiprocessing
 import os
+import queue
 import random
 import sys
 import threading
@@ -23,6 +27,18 @@ from .helper import *
 from .protocol import *
 from .http import BertHTTPProxy
 from .zmq_decor import multi_socket
+from .micro_batching import MicroBatchPolicy, StageMeter
+from .bucketing import BatchBufferPool, bucket_key, pad_batch, unpad
+from .shm import SharedMemorySlab
+from .sharding import ShardedSink
+
+
+async def maybe_await(value):
+    # pre/post-processing of an async worker may be plain functions or coroutine functions
+    if inspect.isawaitable(value):
+        return await value
+    return value
+
 
 class WKRWorkerSkeleton(Process):
     def __init__(self, id, args, worker_address_list, sink_address, device_id, gpu_fraction, model_name, batch_size, batch_timeout, tmp_dir, name='WORKER', color='yellow'):
@@ -31,13 +47,18 @@ class WKRWorkerSkeleton(Process):
         self.color = color
         self.worker_id = id
         self.device_id = device_id
+        # name of the model pool the worker belongs to
+        self.pool = getattr(args, 'pool', None)
         self.transfer_proto = args.protocol
 
         self.daemon = True
         self.exit_flag = multiprocessing.Event()
         self.worker_address = worker_address_list
-        self.num_concurrent_socket = len(self.worker_address)
-        self.sink_address = sink_address
+        self.dispatch_mode = args.dispatch
+        # in credit mode the worker talks to the navigator through a single DEALER socket
+        self.num_concurrent_socket = len(self.worker_address) if self.dispatch_mode == 'random' else 0
+        # one address per sink shard
+        self.sink_address = [sink_address] if isinstance(sink_address, str) else list(sink_address)
 
         self.gpu_memory_fraction = gpu_fraction
         self.model_dir = args.model_dir
@@ -50,22 +71,87 @@ class WKRWorkerSkeleton(Process):
 
         self.batch_size = batch_size
         self.batch_group_timeout = batch_timeout
+        self.batch_policy = args.batch_policy
+        self.batch_adaptive = args.batch_adaptive
+        self.batch_bucket = args.batch_bucket
+        self.bucket_boundaries = sorted(args.bucket_boundaries)
+        self.batch_bisect = args.batch_bisect
+        self.pipeline = args.worker_pipeline
+        self.pipeline_depth = args.pipeline_depth
+        # an `async def predict` keeps up to "-async_concurrency" batches in flight on an event loop
+        self.is_async = inspect.iscoroutinefunction(self.predict) or inspect.iscoroutinefunction(self.predict_masked)
+        self.async_concurrency = args.async_concurrency
+        self.loop = None
+        # inference threads sharing the model, for models that release the GIL
+        self.worker_threads = args.worker_threads
+        # a generator predict yields its outputs step by step, requests made as streams get each step as it comes
+        self.is_stream = inspect.isgeneratorfunction(self.predict) or inspect.isgeneratorfunction(self.predict_masked)
+        self.stat_lock = threading.RLock()
+        # each batch the worker runs at once needs its own credits
+        self.credit_window = batch_size * args.credit_batches * (self.async_concurrency if self.is_async else self.worker_threads)
+        self.use_batch_buffer = not args.no_batch_buffer
+        self.use_shm = args.shm
+        self.shm_config = (args.shm_slot_size, args.shm_num_slots, args.shm_threshold)
+        self.shm_slab = None
+        self.warmup_batch_sizes = sorted(set(args.warmup_batch_sizes or [1, batch_size]))
 
         # self.use_fp16 = args.fp16
         self.is_ready = multiprocessing.Event()
+        # a standby worker loads and warms its model up, then waits to be activated before taking jobs.
+        # It is only waited for at startup, a worker sent back to standby keeps receiving from its socket
+        self.active = multiprocessing.Event()
+        self.active.set()
+        self.is_warm = multiprocessing.Event()
+        self.startup_time = multiprocessing.Value('d', 0)
+        # last time the loop running predict was between batches or waiting for one, the navigator restarts
+        # a ready worker whose heartbeat is older than "-heartbeat_timeout", a hung predict stops it
+        self.heartbeat = multiprocessing.Value('d', time.time())
+        self.heartbeat_interval = max(args.heartbeat_timeout/4000, 0.1)
+
+        # set when the worker is forked from a WKRWorkerTemplate holding the loaded model
+        self.template = None
+        self.preloaded = None
+        self.forked_pid = None
 
         self.logdir = args.log_dir
         self.logname = args.log_name
         self.logger = set_logger(colored('%s-%s' % (self.name, str(self.worker_id)), self.color), logger_dir=self.logdir, logger_name=self.logname, verbose=self.verbose)
 
+    def start(self):
+        if self.template is not None:
+            self.forked_pid = self.template.start_worker(self.worker_id)
+        else:
+            super().start()
+
     def close(self):
         self.logger.info('shutting down...')
         self.exit_flag.set()
         self.is_ready.clear()
-        self.terminate()
-        self.join()
+        if self.template is not None:
+            self.template.close_worker(self.worker_id)
+        else:
+            self.terminate()
+            self.join()
         self.logger.info('terminated!')
 
+    def get_pid(self):
+        return self.forked_pid or self.pid
+
+    def activate(self):
+        self.active.set()
+
+    def deactivate(self):
+        """Mark the worker as standby. Before it started, it waits in `wait_active` once warm; a running worker
+        does not watch this event, squeezing it only stops the navigator sending it jobs, see CreditDispatcher.park_worker
+        """
+        self.active.clear()
+
+    def wait_active(self):
+        while not self.active.wait(timeout=1):
+            if self.exit_flag.is_set():
+                return False
+        return True
+
     def get_env(self, device_id, tmp_dir):
         return []
 
@@ -85,16 +171,77 @@ class WKRWorkerSkeleton(Process):
     def predict(self, model, input):
         return input
 
+    def get_warmup_inputs(self, envs):
+        # list of inputs, as a client would send them, run through the model before the worker takes requests
+        return None
+
+    def warm_up(self, envs, model, input_preprocessor, output_postprocessor, logger):
+        inputs = self.get_warmup_inputs(envs)
+        if not inputs:
+            return
+        start = time.time()
+        for batch_size in self.warmup_batch_sizes:
+            try:
+                batch_raw = [inputs[i % len(inputs)] for i in range(batch_size)]
+                batch, _ = self.stack_batch(batch_raw)
+                outputs = self.run_sync(self.predict(model, self.run_sync(input_preprocessor(batch))))
+                if inspect.isgenerator(outputs):
+                    for step in outputs:
+                        output_postprocessor(step)
+                else:
+                    self.run_sync(output_postprocessor(outputs))
+            except Exception as e:
+                logger.error('warm-up with batch size {} failed: {}'.format(batch_size, e), exc_info=True)
+        warmup_time = (time.time()-start)*1000
+        logger.info('warm-up on batch sizes {} done in {:0.4f}ms'.format(self.warmup_batch_sizes, warmup_time))
+        self.record_statistic({'sys_warmup': warmup_time})
+
+    def run_sync(self, value):
+        # result of an async predict or pre/post-processing called outside of the event loop
+        if inspect.isawaitable(value):
+            return self.loop.run_until_complete(value)
+        return value
+
+    def predict_masked(self, model, input, mask):
+        # padded batch from "-batch_bucket length", mask is True on real elements
+        return self.predict(model, input)
+
     def batching(self, list_input):
         if self.transfer_proto == 'obj':
             return list_input
         else:
             processed = [np.expand_dims(a, axis=0) for a in list_input]
             return np.vstack(processed)
+
+    def stack_batch(self, list_input):
+        """Batch received inputs, returns (batch, number of arrays allocated for it)"""
+        if self.transfer_proto == 'numpy' and self.batch_buffers is not None \
+                and len(set((a.dtype.str, a.shape) for a in list_input)) == 1:
+            num_alloc = self.batch_buffers.num_alloc
+            batch = self.batch_buffers.stack(list_input)
+            return batch, self.batch_buffers.num_alloc - num_alloc
+        return self.batching(list_input), 1
+
+    def bucketing(self, datas):
+        if self.transfer_proto != 'numpy' or self.batch_bucket == 'none':
+            return [datas]
+        buckets = {}
+        for d in datas:
+            buckets.setdefault(bucket_key(self.batch_bucket, d['client_msg'], self.bucket_boundaries), []).append(d)
+        return list(buckets.values())
             
     def load_raw_msg(self, sock):
-        client, req_id, msg, msg_info = recv_from_prev(self.transfer_proto, sock)
-        return client, req_id, msg
+        # numpy inputs stay on the received frame until they are copied into their batch slot
+        client, req_id, msg, msg_info = recv_from_prev(self.transfer_proto, sock, copy=False)
+        return client, req_id, msg, msg_info
+
+    def connect_sink(self, ctx):
+        # a sharded sink gets one socket per shard, each output goes to the shard of its client
+        if len(self.sink_address) > 1:
+            return ShardedSink(ctx, self.sink_address)
+        sock = ctx.socket(zmq.PUSH)
+        sock.connect(self.sink_address[0])
+        return sock
 
     def new_logger(self):
         name = '%s-%s' % (self.name, str(self.worker_id))
@@ -102,14 +249,26 @@ class WKRWorkerSkeleton(Process):
         return LoggerSeperate(name, color, logger_dir=self.logdir, logger_name=self.logname, verbose=self.verbose)
 
     def run(self):
+        self.run_start = time.time()
         self._run()
 
-    def process_output(self, data, client, req_id, target_sink):
-        send_to_next(self.transfer_proto, client, req_id, data, target_sink)
+    def beat(self):
+        self.heartbeat.value = time.time()
+
+    def get_exitcode(self):
+        if self.template is not None:
+            return self.template.worker_exitcode(self.worker_id)
+        return self.exitcode
+
+    def process_outputs(self, client_ids, outputs, target_sink):
+        # one message for the whole batch instead of one per output
+        jobs = [client_id.split('#') for client_id in client_ids]
+        send_batch(self.transfer_proto, jobs, outputs, target_sink, slab=self.shm_slab)
 
     @zmqd.socket(zmq.PUSH)
+    @zmqd.socket(zmq.DEALER)
     @multi_socket(zmq.PULL, num_socket='num_concurrent_socket')
-    def _run(self, sink_embed, *receivers):
+    def _run(self, sink_embed, dispatcher, *receivers):
         # Windows does not support logger in MP environment, thus get a new logger
         # inside the process for better compatibility
         logger = self.new_logger()
@@ -117,67 +276,539 @@ class WKRWorkerSkeleton(Process):
         logger.info('use device %s, load graph from %s/%s' %
                     ('cpu' if self.device_id < 0 else ('gpu: %d' % self.device_id), self.model_dir, self.model_name))
 
-        envs = self.get_env(self.device_id, self.tmp_folder)
+        if self.preloaded is not None:
+            envs, model = self.preloaded
+            # the template may have disabled the collector to keep the model pages shared
+            gc.enable()
+        else:
+            envs = self.get_env(self.device_id, self.tmp_folder)
+            model = None
         input_preprocessor = self.get_preprocess(envs)
         output_postprocessor = self.get_postprocess(envs)
-        model = self.get_model(envs, self.model_dir, self.model_name, self.tmp_folder)
+        if model is None:
+            model = self.get_model(envs, self.model_dir, self.model_name, self.tmp_folder)
+
+        if len(self.sink_address) > 1:
+            sink_embed = self.connect_sink(zmq.Context.instance())
+        else:
+            sink_embed.connect(self.sink_address[0])
+        if self.use_shm:
+            slot_size, num_slots, threshold = self.shm_config
+            self.shm_slab = SharedMemorySlab(slot_size, num_slots, threshold=threshold)
+
+        def grant_credit(num, job_ids=()):
+            # tell the navigator how many batch slots became free and which jobs are done with
+            if self.dispatch_mode == 'credit' and num > 0:
+                dispatcher.send_multipart([ServerCmd.credit, to_bytes(str(num)), *[to_bytes(j) for j in job_ids]])
 
-        for sock, addr in zip(receivers, self.worker_address):
-            sock.connect(addr)
-        sink_embed.connect(self.sink_address)
+        self.grant_credit = grant_credit
 
         def record_statistic(diction):
             push_dic = {}
             for k, v in diction.items():
                 push_dic[str(k)] = float(v)
-            send_to_next_raw(to_bytes(''), to_bytes(''), jsonapi.dumps(push_dic), ServerCmd.statistic, sink_embed)
+            # inference threads share the socket
+            with self.stat_lock:
+                send_to_next_raw(to_bytes(self.pool or ''), to_bytes(''), jsonapi.dumps(push_dic), ServerCmd.statistic, sink_embed)
 
         self.record_statistic = record_statistic
 
-        generator = self.input_fn_builder(receivers, input_preprocessor, sink_embed)
+        self.micro_batch = MicroBatchPolicy(self.batch_size, self.batch_group_timeout, policy=self.batch_policy, adaptive=self.batch_adaptive)
+        self.batch_buffers = None
+        if self.use_batch_buffer:
+            # a pipelined batch can sit in both queues, in predict, in send and in assembly at the same time
+            if self.pipeline:
+                num_slots = 2*self.pipeline_depth + 4
+            elif self.is_async or self.worker_threads > 1:
+                # the batches in flight, the ones waiting for a free slot or thread and one in assembly
+                num_slots = 2*max(self.async_concurrency if self.is_async else 0, self.worker_threads) + 2
+            else:
+                num_slots = 1
+            self.batch_buffers = BatchBufferPool(self.batch_size, num_slots=num_slots)
+
+        if self.is_async:
+            self.loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self.loop)
+
+        # the navigator only sees this worker once it is warm, so no request pays for lazy initialisation
+        self.warm_up(envs, model, input_preprocessor, output_postprocessor, logger)
+        self.startup_time.value = (time.time()-self.run_start)*1000
+        logger.info('started in {:0.4f}ms'.format(self.startup_time.value))
+        record_statistic({'sys_startup': self.startup_time.value})
+        self.is_warm.set()
+        if not self.active.is_set():
+            logger.info('standby, waiting to be activated')
+            if not self.wait_active():
+                return
+            logger.info('activated')
+        if self.dispatch_mode == 'credit':
+            dispatcher.setsockopt(zmq.IDENTITY, to_bytes(str(self.worker_id)))
+            dispatcher.connect(self.worker_address[0])
+            receivers = [dispatcher]
+        else:
+            for sock, addr in zip(receivers, self.worker_address):
+                sock.connect(addr)
+
+        grant_credit(self.credit_window)
+        if self.is_async:
+            self.loop.run_until_complete(self._run_async(model, receivers, input_preprocessor, output_postprocessor, sink_embed, logger))
+            return
+        if self.worker_threads > 1:
+            self._run_threaded(model, receivers, input_preprocessor, output_postprocessor, logger)
+            return
+        if self.pipeline and not self.is_stream:
+            self._run_pipelined(model, receivers, input_preprocessor, output_postprocessor, logger)
+            return
+
+        # receive and predict share this thread, the input loop beats between batches and while waiting
+        generator = self.input_fn_builder(receivers, input_preprocessor, sink_embed, beat=self.beat)
         for msg in generator():
-            client_ids, input_data = msg['client_ids'], msg['input_data']
-            try:
-                start = time.time()
-                outputs = self.predict(model, input_data)
-                end = time.time()
-                predict_time = (end-start)*1000
-                predict_time_per_input = predict_time/len(input_data)
-                logger.info('predict {} input in {:0.4f}ms, avg/item: {:0.4f}ms'.format(len(input_data), predict_time, predict_time_per_input))
-
-                record_statistic({
-                    'sys_batchsize': len(input_data),
-                    'sys_predict': predict_time_per_input
-                })
-
-                if len(outputs) != len(input_data):
-                    raise Exception("Output after process by predict func not match. input: {}, output: {}".format(input_data, outputs))
-
-                outputs = output_postprocessor(outputs)
-                for client_id, output in zip(client_ids, outputs):
-                    cliend, req_id = client_id.split('#')
-                    self.process_output(output, cliend, req_id, sink_embed)
-                    logger.info('sent to sink\tjob id: {}#{}'.format(cliend, req_id))
-                    
-            except Exception as e:
-                import traceback
-                tb = traceback.format_exc()
-                logger.error('{}'.format(e), exc_info=True)
-
-                # building exception message
-                cids = list(set([client_id.split('#')[0] for client_id in client_ids]))
-                exception_msg = 'Exception when processing input batch of {} elements, from {} different client ids ({}). Please check your input.'.format(len(input_data), len(cids), ', '.join(cids))
-                exception_msg = '{}\n{}\n{}'.format(tb, e, exception_msg)
-                # send exception for all client in batches
-                for client_id in client_ids:
-                    cliend, req_id = client_id.split('#')
-                    send_to_next_raw(to_bytes(cliend), to_bytes(req_id), to_bytes(exception_msg), ServerCmd.exception, sink_embed)
+            if self.is_stream:
+                # each step goes out as soon as predict yields it
+                try:
+                    self.predict_stream(model, msg, output_postprocessor, sink_embed, logger, beat=self.beat)
+                except Exception as e:
+                    self.send_exception(msg, e, sink_embed, logger)
+                grant_credit(msg.get('cost', len(msg['client_ids'])), msg['client_ids'])
+                if self.exit_flag.is_set():
+                    break
+                continue
+
+            for batch_msg, outputs, error in self.predict_isolated(model, msg, input_preprocessor, logger):
+                try:
+                    if error is not None:
+                        raise error
+                    self.send_outputs(batch_msg, outputs, output_postprocessor, sink_embed, logger)
+                except Exception as e:
+                    self.send_exception(batch_msg, e, sink_embed, logger)
+
+            grant_credit(msg.get('cost', len(msg['client_ids'])), msg['client_ids'])
 
             # Prepare to shutdown this process
             if self.exit_flag.is_set():
                 break
 
-    def input_fn_builder(self, socks, input_preprocessor, sink_embed):
+    def _run_pipelined(self, model, receivers, input_preprocessor, output_postprocessor, logger):
+        # receive/decode/preprocess of batch N+1 and postprocess/send of batch N-1 run on
+        # background threads while predict runs on batch N, bounded queues give backpressure
+        ctx = zmq.Context.instance()
+        batch_queue = queue.Queue(maxsize=self.pipeline_depth)
+        output_queue = queue.Queue(maxsize=self.pipeline_depth)
+        meter = StageMeter(['receive', 'predict', 'send'])
+
+        # only the receive thread may touch the navigator socket, other stages hand it their credits
+        credit_inbox_addr = 'inproc://credit-%s' % str(self.worker_id)
+        credit_inbox = ctx.socket(zmq.PULL)
+        credit_inbox.bind(credit_inbox_addr)
+
+        def receive_stage():
+            sink_sock = self.connect_sink(ctx)
+            generator = self.input_fn_builder(receivers, input_preprocessor, sink_sock, credit_inbox=credit_inbox)
+            last_put = 0
+            for msg in generator():
+                meter.add('receive', time.time()-max(msg['first_arrival'], last_put))
+                batch_queue.put(msg)
+                last_put = time.time()
+
+        def send_stage():
+            sink_sock = self.connect_sink(ctx)
+            credit_sock = ctx.socket(zmq.PUSH)
+            credit_sock.connect(credit_inbox_addr)
+            while True:
+                msg, outputs, error = output_queue.get()
+                start = time.time()
+                try:
+                    if error is not None:
+                        raise error
+                    self.send_outputs(msg, outputs, output_postprocessor, sink_sock, logger)
+                except Exception as e:
+                    self.send_exception(msg, e, sink_sock, logger)
+                meter.add('send', time.time()-start)
+                if self.dispatch_mode == 'credit':
+                    credit_sock.send_multipart([to_bytes(str(msg.get('cost', len(msg['client_ids'])))),
+                                                *[to_bytes(j) for j in msg['client_ids']]])
+
+        for stage in [receive_stage, send_stage]:
+            threading.Thread(target=stage, daemon=True).start()
+
+        while not self.exit_flag.is_set():
+            self.beat()
+            try:
+                msg = batch_queue.get(timeout=self.heartbeat_interval)
+            except queue.Empty:
+                continue
+            start = time.time()
+            # the send stage raises errors again to report them with the batch they belong to
+            results = self.predict_isolated(model, msg, input_preprocessor, logger)
+            meter.add('predict', time.time()-start)
+            for result in results:
+                output_queue.put(result)
+            self.record_statistic({
+                **meter.occupancy(),
+                'sys_queue_batch': batch_queue.qsize(),
+                'sys_queue_output': output_queue.qsize(),
+            })
+
+    def _run_threaded(self, model, receivers, input_preprocessor, output_postprocessor, logger):
+        # one receive thread assembles the batches into a single queue, "-worker_threads" inference threads
+        # take them and run pre-processing, predict and post-processing on the one loaded model
+        ctx = zmq.Context.instance()
+        batch_queue = queue.Queue(maxsize=self.worker_threads)
+        threads = ['thread_%d' % idx for idx in range(self.worker_threads)]
+        meter = StageMeter(threads)
+        # the worker heartbeat is the one of its slowest inference thread
+        last_beat = {thread: time.time() for thread in threads}
+
+        # only the receive thread may touch the navigator socket, inference threads hand it their credits
+        credit_inbox_addr = 'inproc://credit-%s' % str(self.worker_id)
+        credit_inbox = ctx.socket(zmq.PULL)
+        credit_inbox.bind(credit_inbox_addr)
+
+        def receive_stage():
+            sink_sock = self.connect_sink(ctx)
+            generator = self.input_fn_builder(receivers, lambda batch: batch, sink_sock, credit_inbox=credit_inbox)
+            for msg in generator():
+                batch_queue.put(msg)
+
+        def inference_thread(thread):
+            sink_sock = self.connect_sink(ctx)
+            credit_sock = ctx.socket(zmq.PUSH)
+            credit_sock.connect(credit_inbox_addr)
+
+            def beat():
+                last_beat[thread] = time.time()
+
+            while True:
+                beat()
+                try:
+                    msg = batch_queue.get(timeout=self.heartbeat_interval)
+                except queue.Empty:
+                    continue
+                start = time.time()
+                try:
+                    msg['input_data'] = input_preprocessor(msg['input_data'])
+                    if self.is_stream:
+                        self.predict_stream(model, msg, output_postprocessor, sink_sock, logger, beat=beat)
+                        results = []
+                    else:
+                        results = self.predict_isolated(model, msg, input_preprocessor, logger)
+                except Exception as e:
+                    results = [(msg, None, e)]
+                for batch_msg, outputs, error in results:
+                    try:
+                        if error is not None:
+                            raise error
+                        self.send_outputs(batch_msg, outputs, output_postprocessor, sink_sock, logger)
+                    except Exception as e:
+                        self.send_exception(batch_msg, e, sink_sock, logger)
+                meter.add(thread, time.time()-start)
+                if self.dispatch_mode == 'credit':
+                    credit_sock.send_multipart([to_bytes(str(msg.get('cost', len(msg['client_ids'])))),
+                                                *[to_bytes(j) for j in msg['client_ids']]])
+
+        threading.Thread(target=receive_stage, daemon=True).start()
+        for thread in threads:
+            threading.Thread(target=inference_thread, args=(thread,), daemon=True).start()
+
+        while not self.exit_flag.is_set():
+            time.sleep(min(1, self.heartbeat_interval))
+            self.heartbeat.value = min(last_beat.values())
+            occupancy = meter.occupancy()
+            self.record_statistic({
+                **occupancy,
+                'sys_thread_util': sum(occupancy.values())/len(occupancy),
+                'sys_queue_batch': batch_queue.qsize(),
+            })
+
+    async def _run_async(self, model, receivers, input_preprocessor, output_postprocessor, sink_embed, logger):
+        # a receive thread assembles the batches, the event loop runs predict on up to
+        # "-async_concurrency" of them at once, each one sent as soon as its own predict is done
+        ctx = zmq.Context.instance()
+        loop = self.loop
+        inbox = asyncio.Queue(maxsize=1)
+        slots = asyncio.Semaphore(self.async_concurrency)
+        # batches in flight and when they started
+        inflight = {}
+
+        # only the receive thread may touch the navigator socket, the event loop hands it the credits
+        credit_inbox_addr = 'inproc://credit-%s' % str(self.worker_id)
+        credit_inbox = ctx.socket(zmq.PULL)
+        credit_inbox.bind(credit_inbox_addr)
+        credit_sock = ctx.socket(zmq.PUSH)
+        credit_sock.connect(credit_inbox_addr)
+
+        def receive_stage():
+            sink_sock = self.connect_sink(ctx)
+            # pre-processing may be a coroutine, it runs on the event loop with predict
+            generator = self.input_fn_builder(receivers, lambda batch: batch, sink_sock, credit_inbox=credit_inbox)
+            for msg in generator():
+                asyncio.run_coroutine_threadsafe(inbox.put(msg), loop).result()
+
+        async def handle(msg):
+            try:
+                msg['input_data'] = await maybe_await(input_preprocessor(msg['input_data']))
+                results = await self.predict_isolated_async(model, msg, input_preprocessor, logger)
+            except Exception as e:
+                results = [(msg, None, e)]
+            for batch_msg, outputs, error in results:
+                try:
+                    if error is not None:
+                        raise error
+                    outputs = await maybe_await(output_postprocessor(outputs))
+                    self.send_outputs(batch_msg, outputs, lambda output: output, sink_embed, logger)
+                except Exception as e:
+                    self.send_exception(batch_msg, e, sink_embed, logger)
+            if self.dispatch_mode == 'credit':
+                credit_sock.send_multipart([to_bytes(str(msg.get('cost', len(msg['client_ids'])))),
+                                            *[to_bytes(j) for j in msg['client_ids']]])
+
+        def done(task):
+            inflight.pop(task, None)
+            slots.release()
+
+        async def keep_beating():
+            # runs on the event loop, a predict blocking the loop or a batch stuck in predict stops it
+            while not self.exit_flag.is_set():
+                self.heartbeat.value = min([time.time(), *inflight.values()])
+                await asyncio.sleep(self.heartbeat_interval)
+
+        threading.Thread(target=receive_stage, daemon=True).start()
+        loop.create_task(keep_beating())
+        while not self.exit_flag.is_set():
+            await slots.acquire()
+            msg = await inbox.get()
+            task = loop.create_task(handle(msg))
+            inflight[task] = time.time()
+            task.add_done_callback(done)
+            self.record_statistic({'sys_async_inflight': len(inflight)})
+
+    def predict_isolated(self, model, msg, input_preprocessor, logger):
+        """Run predict on one assembled batch, returns a list of (batch msg, outputs, error)
+
+        With "-batch_bisect", a failed batch is run again in halves, down to single inputs, so only
+        the inputs that make predict fail get the error and the rest of the batch still gets results
+        """
+        try:
+            return [(msg, self.predict_batch(model, msg, logger), None)]
+        except Exception as e:
+            if not self.batch_bisect or msg.get('is_part', False) or len(msg['client_ids']) < 2:
+                return [(msg, None, e)]
+        logger.warning('predict failed on a batch of {} inputs, looking for the failing ones'.format(len(msg['client_ids'])))
+
+        start = time.time()
+        results = []
+        num_rerun = 0
+
+        def bisect(lo, hi):
+            nonlocal num_rerun
+            num_rerun += 1
+            sub_msg = dict(msg, client_ids=msg['client_ids'][lo:hi], input_data=input_preprocessor(msg['input_raw'][lo:hi]))
+            if msg.get('mask') is not None:
+                sub_msg.update({'mask': msg['mask'][lo:hi], 'shapes': msg['shapes'][lo:hi]})
+            try:
+                results.append((sub_msg, self.predict_batch(model, sub_msg, logger, record=False), None))
+            except Exception as e:
+                if hi - lo == 1:
+                    results.append((sub_msg, None, e))
+                else:
+                    bisect(lo, (lo+hi)//2)
+                    bisect((lo+hi)//2, hi)
+
+        bisect(0, len(msg['client_ids'])//2)
+        bisect(len(msg['client_ids'])//2, len(msg['client_ids']))
+        self.record_bisect(msg, results, num_rerun, start, logger)
+        return results
+
+    async def predict_isolated_async(self, model, msg, input_preprocessor, logger):
+        """Same as `predict_isolated` for an `async def predict`"""
+        try:
+            return [(msg, await self.predict_batch_async(model, msg, logger), None)]
+        except Exception as e:
+            if not self.batch_bisect or msg.get('is_part', False) or len(msg['client_ids']) < 2:
+                return [(msg, None, e)]
+        logger.warning('predict failed on a batch of {} inputs, looking for the failing ones'.format(len(msg['client_ids'])))
+
+        start = time.time()
+        results = []
+        num_rerun = 0
+
+        async def bisect(lo, hi):
+            nonlocal num_rerun
+            num_rerun += 1
+            sub_msg = dict(msg, client_ids=msg['client_ids'][lo:hi], input_data=await maybe_await(input_preprocessor(msg['input_raw'][lo:hi])))
+            if msg.get('mask') is not None:
+                sub_msg.update({'mask': msg['mask'][lo:hi], 'shapes': msg['shapes'][lo:hi]})
+            try:
+                results.append((sub_msg, await self.predict_batch_async(model, sub_msg, logger, record=False), None))
+            except Exception as e:
+                if hi - lo == 1:
+                    results.append((sub_msg, None, e))
+                else:
+                    await bisect(lo, (lo+hi)//2)
+                    await bisect((lo+hi)//2, hi)
+
+        await bisect(0, len(msg['client_ids'])//2)
+        await bisect(len(msg['client_ids'])//2, len(msg['client_ids']))
+        self.record_bisect(msg, results, num_rerun, start, logger)
+        return results
+
+    def record_bisect(self, msg, results, num_rerun, start, logger):
+        bisect_time = (time.time()-start)*1000
+        num_failed = sum(len(sub_msg['client_ids']) for sub_msg, _, error in results if error is not None)
+        logger.warning('isolated {} failing inputs out of {} in {:0.4f}ms'.format(num_failed, len(msg['client_ids']), bisect_time))
+        self.record_statistic({
+            'sys_bisect_time': bisect_time,
+            'sys_bisect_rerun': num_rerun,
+            'sys_bisect_failed': num_failed,
+            'sys_bisect_rescued': len(msg['client_ids']) - num_failed,
+        })
+
+    def predict_batch(self, model, msg, logger, record=True):
+        """Run predict on one assembled batch, returns the raw outputs"""
+        input_data = msg['input_data']
+        start = time.time()
+        if msg.get('mask') is not None:
+            outputs = self.predict_masked(model, input_data, msg['mask'])
+        else:
+            outputs = self.predict(model, input_data)
+        return self.check_outputs(msg, input_data, outputs, start, logger, record)
+
+    async def predict_batch_async(self, model, msg, logger, record=True):
+        input_data = msg['input_data']
+        start = time.time()
+        if msg.get('mask') is not None:
+            outputs = await self.predict_masked(model, input_data, msg['mask'])
+        else:
+            outputs = await self.predict(model, input_data)
+        return self.check_outputs(msg, input_data, outputs, start, logger, record)
+
+    def check_outputs(self, msg, input_data, outputs, start, logger, record):
+        end = time.time()
+        predict_time = (end-start)*1000
+        predict_time_per_input = predict_time/len(input_data)
+        logger.info('predict {} input in {:0.4f}ms, avg/item: {:0.4f}ms'.format(len(input_data), predict_time, predict_time_per_input))
+        if record:
+            # a re-run of a failed batch would skew the batching statistics
+            self.record_predict(msg, len(input_data), predict_time)
+
+        if len(outputs) != len(input_data):
+            raise Exception("Output after process by predict func not match. input: {}, output: {}".format(input_data, outputs))
+        return outputs
+
+    def predict_stream(self, model, msg, output_postprocessor, target_sink, logger, beat=None):
+        """Run a generator predict on one assembled batch and send its outputs step by step
+
+        Each step yields one chunk per input, None when an input has nothing new at that step. Requests
+        made as streams get every chunk as soon as its step is done, numbered by 'seq', then an end of
+        stream marker ('eos') once predict returns. Other requests get all their chunks at once, a list
+        for "obj" protocol, concatenated on the first axis for "numpy" protocol.
+        """
+        input_data = msg['input_data']
+        # parts of a scattered batch request are gathered by the sink, they are never streamed
+        streams = [False]*len(input_data) if msg.get('is_part') else msg.get('streams') or [False]*len(input_data)
+        jobs = [client_id.split('#') for client_id in msg['client_ids']]
+        seqs = [0]*len(input_data)
+        collected = [[] for _ in input_data]
+        start = time.time()
+        if msg.get('mask') is not None:
+            steps = self.predict_masked(model, input_data, msg['mask'])
+        else:
+            steps = self.predict(model, input_data)
+        for step in steps:
+            # a stream making progress is not a hung predict
+            if beat is not None:
+                beat()
+            if len(step) != len(input_data):
+                raise Exception("Step yielded by predict func not match. input: {}, step: {}".format(len(input_data), len(step)))
+            step = output_postprocessor(step)
+            chunks = []
+            for idx, chunk in enumerate(step):
+                if chunk is None:
+                    continue
+                if streams[idx]:
+                    chunks.append((idx, chunk))
+                else:
+                    collected[idx].append(chunk)
+            if chunks and self.transfer_proto == 'numpy' and self.batch_buffers is not None:
+                # sent without copy, the next batch must not overwrite them
+                idxs, arrays = zip(*chunks)
+                chunks = list(zip(idxs, self.batch_buffers.detach(list(arrays))))
+            if chunks:
+                send_batch(self.transfer_proto, [jobs[idx] for idx, _ in chunks], [chunk for _, chunk in chunks], target_sink,
+                           slab=self.shm_slab, infos=[{'seq': seqs[idx]} for idx, _ in chunks])
+                for idx, _ in chunks:
+                    seqs[idx] += 1
+        self.record_predict(msg, len(input_data), (time.time()-start)*1000)
+
+        ended = [idx for idx, stream in enumerate(streams) if stream]
+        if ended:
+            empty = None if self.transfer_proto == 'obj' else np.empty(0)
+            send_batch(self.transfer_proto, [jobs[idx] for idx in ended], [empty]*len(ended), target_sink,
+                       infos=[{'seq': seqs[idx], 'eos': 1} for idx in ended])
+        rest = [idx for idx, stream in enumerate(streams) if not stream]
+        if rest:
+            outputs = [self.join_chunks(collected[idx]) for idx in rest]
+            rest_msg = dict(msg, client_ids=[msg['client_ids'][idx] for idx in rest] if not msg.get('is_part') else msg['client_ids'])
+            if msg.get('shapes') is not None:
+                rest_msg['shapes'] = [msg['shapes'][idx] for idx in rest]
+            self.send_outputs(rest_msg, outputs, lambda output: output, target_sink, logger)
+        logger.info('streamed {} outputs, {} chunks'.format(len(ended), sum(seqs)))
+
+    def join_chunks(self, chunks):
+        if self.transfer_proto == 'obj':
+            return chunks
+        return np.concatenate([np.atleast_1d(c) for c in chunks]) if chunks else np.empty(0)
+
+    def record_predict(self, msg, batch_size, predict_time):
+        with self.stat_lock:
+            self.micro_batch.observe_predict(batch_size, predict_time)
+        stats = {
+            'sys_batchsize': batch_size,
+            'sys_predict': predict_time/batch_size,
+            'sys_batch_wait': msg.get('batch_wait', 0),
+            **self.micro_batch.status
+        }
+        if 'padding_waste' in msg:
+            stats['sys_padding_waste'] = msg['padding_waste']
+        if 'num_alloc' in msg:
+            stats['sys_batch_alloc'] = msg['num_alloc']
+        if self.batch_buffers is not None:
+            stats['sys_batch_buffer_mb'] = self.batch_buffers.nbytes/1024/1024
+        if self.shm_slab is not None:
+            stats['sys_shm_slot_used'] = self.shm_slab.num_used
+        self.record_statistic(stats)
+
+    def send_outputs(self, msg, outputs, output_postprocessor, target_sink, logger):
+        client_ids = msg['client_ids']
+        outputs = output_postprocessor(outputs)
+        if self.transfer_proto == 'numpy' and self.batch_buffers is not None:
+            # outputs are sent without copy, a later batch must not overwrite them before they are out
+            outputs = self.batch_buffers.detach(outputs)
+        if msg.get('is_part', False):
+            # one part of a scattered batch request, send back all outputs at once for the sink to gather
+            outputs = [self.batching(list(outputs))]
+        elif msg.get('shapes') is not None:
+            padded_shape = msg['mask'].shape[1:]
+            outputs = [unpad(output, shape, padded_shape) for output, shape in zip(outputs, msg['shapes'])]
+        self.process_outputs(client_ids, outputs, target_sink)
+        logger.info('sent to sink\t{} outputs, job ids: {}'.format(len(client_ids), ', '.join(client_ids)))
+
+    def send_exception(self, msg, e, target_sink, logger):
+        import traceback
+        client_ids, input_data = msg['client_ids'], msg['input_data']
+        tb = traceback.format_exc()
+        logger.error('{}'.format(e), exc_info=True)
+
+        # building exception message
+        cids = list(set([client_id.split('#')[0] for client_id in client_ids]))
+        exception_msg = 'Exception when processing input batch of {} elements, from {} different client ids ({}). Please check your input.'.format(len(input_data), len(cids), ', '.join(cids))
+        exception_msg = '{}\n{}\n{}'.format(tb, e, exception_msg)
+        # send exception for all client in batches
+        for client_id in client_ids:
+            cliend, req_id = client_id.split('#')
+            send_to_next_raw(to_bytes(cliend), to_bytes(req_id), to_bytes(exception_msg), ServerCmd.exception, target_sink)
+
+    def input_fn_builder(self, socks, input_preprocessor, sink_embed, credit_inbox=None, beat=None):
         def gen():
             # Windows does not support logger in MP environment, thus get a new logger
             # inside the process for better compatibility
@@ -186,56 +817,142 @@ class WKRWorkerSkeleton(Process):
             poller = zmq.Poller()
             for sock in socks:
                 poller.register(sock, zmq.POLLIN)
-
+            if credit_inbox is not None:
+                poller.register(credit_inbox, zmq.POLLIN)
+
+            def forward_credit():
+                # credits freed by the other pipeline stages
+                while True:
+                    try:
+                        num, *job_ids = credit_inbox.recv_multipart(zmq.NOBLOCK)
+                        self.grant_credit(int(num), job_ids)
+                    except zmq.error.Again:
+                        break
+
+            # a standby worker may have waited long, the navigator checks the heartbeat from now on
+            self.beat()
             self.is_ready.set()
             logger.info('ready and listening!')
 
             def get_single_data(timeout=20):
+                poll_deadline = time.time() + timeout/1000
                 events = dict(poller.poll(timeout=timeout))
+                while credit_inbox in events:
+                    forward_credit()
+                    events.pop(credit_inbox)
+                    if not events:
+                        remaining = (poll_deadline-time.time())*1000
+                        events = dict(poller.poll(timeout=remaining)) if remaining > 0 else {}
                 if events:
                     for sock_idx, sock in enumerate(socks):
                         if sock in events:
                             try:
-                                client, req_id, msg = self.load_raw_msg(sock)
+                                client, req_id, msg, msg_info = self.load_raw_msg(sock)
+                                self.micro_batch.observe_arrival()
                                 logger.info('new job\tsocket: {}\tclient: {}#{}'.format(sock_idx, client, req_id))
                                 return {
                                     'client_id': client+'#'+req_id,
-                                    'client_msg': msg
+                                    'client_msg': msg,
+                                    'deadline': msg_info.get('deadline'),
+                                    # a part of a scattered batch request is a whole batch on its own
+                                    'is_part': 'part' in msg_info,
+                                    'cost': msg_info.get('part_size', 1),
+                                    'stream': bool(msg_info.get('stream'))
                                 }
                             except DecodeObjectException as e:
-                                # return error to client
-                                client, req_id = e.client, e.req_id
-                                exception_msg = '''
-                                {}
-                                \n
-                                Error while decoding input from client: {}#{}
-                                '''.format(e, to_str(client), to_str(req_id))
-                                send_to_next_raw(to_bytes(client), to_bytes(req_id), to_bytes(exception_msg), ServerCmd.exception, sink_embed)
-                                raise e
-                            except Exception as e:
-                                raise e
+                                # answered here, the jobs already in the batch window go on
+                                logger.error('can not decode input of client {}#{}: {}'.format(to_str(e.client), to_str(e.req_id), e))
+                                try:
+                                    cost = parse_job_info(e.msg_info).get('part_size') or 1
+                                except ValueError:
+                                    cost = 1
+                                fail_jobs([{'client_id': to_str(e.client) + '#' + to_str(e.req_id), 'cost': cost}],
+                                          'Error while decoding input: {}'.format(e))
+                                return None
                 return None
 
+            def fail_jobs(datas, exception_msg):
+                # every job taken from the navigator gets a reply and gives its credits back
+                for d in datas:
+                    client, req_id = d['client_id'].split('#', 1)
+                    send_to_next_raw(to_bytes(client), to_bytes(req_id), to_bytes(exception_msg), ServerCmd.exception, sink_embed)
+                self.grant_credit(sum(d['cost'] for d in datas), [d['client_id'] for d in datas])
+
+            def drop_expired(datas):
+                # do not spend predict time on jobs whose client already gave up
+                now = time.time()
+                expired = [d for d in datas if d['deadline'] and now > d['deadline']]
+                for d in expired:
+                    cliend, req_id = d['client_id'].split('#')
+                    logger.info('drop expired job\tclient: {}#{}'.format(cliend, req_id))
+                    send_to_next_raw(to_bytes(cliend), to_bytes(req_id), to_bytes('deadline exceeded before predict'), ServerCmd.deadline_exceeded, sink_embed)
+                self.grant_credit(sum(d['cost'] for d in expired), [d['client_id'] for d in expired])
+                return [d for d in datas if not (d['deadline'] and now > d['deadline'])]
+
             while not self.exit_flag.is_set():
+                if beat is not None:
+                    beat()
+                # jobs of the batch window not handed to predict yet, answered if the window fails
+                unanswered = []
                 try:
-                    datas = []
-                    for _ in range(self.batch_size):
-                        d = get_single_data(timeout=self.batch_group_timeout)
-                        if d is not None:
-                            datas.append(d)
-                    if len(datas) > 0:
-                        client_ids = [d['client_id'] for d in datas]
-                        batch_raw = [d['client_msg'] for d in datas]
-                        batch = self.batching(batch_raw)
-                        batch_processed = input_preprocessor(batch)
-                        yield {
+                    # block until the first job arrives, the batch window starts from there
+                    d = get_single_data(timeout=100)
+                    if d is None:
+                        continue
+                    datas = unanswered = [d]
+                    first_arrival = time.time()
+                    while True:
+                        wait_time = self.micro_batch.wait_time(first_arrival, len(datas))
+                        if wait_time is None:
+                            break
+                        d = get_single_data(timeout=wait_time)
+                        if d is None:
+                            # queue is empty and the window is over
+                            break
+                        datas.append(d)
+                    batch_wait = (time.time()-first_arrival)*1000
+                    datas = drop_expired(datas)
+                    unanswered = list(datas)
+                    for d in [d for d in datas if d['is_part']]:
+                        msg = {
+                            'client_ids': [d['client_id']],
+                            'input_data': input_preprocessor(d['client_msg']),
+                            'is_part': True,
+                            'cost': d['cost'],
+                            'batch_wait': batch_wait,
+                            'first_arrival': first_arrival
+                        }
+                        unanswered = [u for u in unanswered if u is not d]
+                        yield msg
+                    datas = [d for d in datas if not d['is_part']]
+                    buckets = self.bucketing(datas) if len(datas) > 0 else []
+                    for bucket in buckets:
+                        client_ids = [d['client_id'] for d in bucket]
+                        batch_raw = [d['client_msg'] for d in bucket]
+                        msg = {
                             'client_ids': client_ids,
-                            'input_data': batch_processed
+                            'streams': [d['stream'] for d in bucket],
+                            'batch_wait': batch_wait,
+                            'first_arrival': first_arrival
                         }
+                        if self.batch_bucket == 'length':
+                            num_alloc = self.batch_buffers.num_alloc if self.batch_buffers is not None else 0
+                            batch, mask, padding_waste = pad_batch(batch_raw, pool=self.batch_buffers)
+                            num_alloc = self.batch_buffers.num_alloc - num_alloc if self.batch_buffers is not None else 2
+                            msg.update({'mask': mask, 'shapes': [a.shape for a in batch_raw], 'padding_waste': padding_waste})
+                        else:
+                            batch, num_alloc = self.stack_batch(batch_raw)
+                        msg['input_data'] = input_preprocessor(batch)
+                        if self.batch_bisect:
+                            # kept to preprocess halves of the batch again if predict fails on it
+                            msg['input_raw'] = batch
+                        msg['num_alloc'] = num_alloc
+                        unanswered = [u for u in unanswered if all(u is not d for d in bucket)]
+                        yield msg
                 except Exception as e:
                     import traceback
                     tb=traceback.format_exc()
                     logger.error('{}\n{}'.format(e, tb))
-                    # TODO: handler crash report here
+                    fail_jobs(unanswered, 'Error while preparing the batch: {}'.format(e))
 
         return gen
\ No newline at end of file